@@ -103,6 +103,43 @@ def estimateScaleFactor(bamFilesList, binLength, numberOfSamples,
     except Exception as detail:
         exit("*ERROR*: {}".format(detail))
 
+    return scaleFactorsFromCounts(num_reads_per_bin, sizeFactorBasedOnMappedReads, avg_method)
+
+
+def estimateScaleFactorFromBinCounts(binCounts, binLength, numberOfSamples, mappingStatsList,
+                                     avg_method='median', chrsToSkip=[]):
+    """
+    Like estimateScaleFactor, but the reads of each sampled window are not
+    counted again. Instead, the coverage of the consecutive bins of a
+    binCounts.BinCounts object closest to binLength is summed, for
+    numberOfSamples windows evenly spread over the genome. A read
+    overlapping several bins is counted in each of them.
+    """
+    sizeFactorBasedOnMappedReads = np.array(mappingStatsList, dtype='float64')
+    sizeFactorBasedOnMappedReads = sizeFactorBasedOnMappedReads.min() / sizeFactorBasedOnMappedReads
+
+    binsPerWindow = max(1, int(round(float(binLength) / binCounts.parameters['binSize'])))
+    windows = []
+    for chrom, start, end, counts in binCounts.chunks():
+        if chrom in chrsToSkip:
+            continue
+        nWindows = counts.shape[0] // binsPerWindow
+        counts = counts[:nWindows * binsPerWindow].astype('float64')
+        windows.append(np.nansum(counts.reshape(nWindows, binsPerWindow, -1), axis=1))
+    if sum(len(x) for x in windows) == 0:
+        exit("*ERROR*: There are no bins to sample in {}".format(binCounts.fileName))
+    num_reads_per_bin = np.concatenate(windows)
+    num_reads_per_bin = num_reads_per_bin[::max(1, len(num_reads_per_bin) // numberOfSamples)]
+
+    return scaleFactorsFromCounts(num_reads_per_bin, sizeFactorBasedOnMappedReads, avg_method)
+
+
+def scaleFactorsFromCounts(num_reads_per_bin, sizeFactorBasedOnMappedReads, avg_method='median'):
+    """
+    Computes the dict returned by estimateScaleFactor from the
+    (windows x 2) array with the number of reads of each file in the
+    sampled windows.
+    """
     sitesSampled = len(num_reads_per_bin)
 
     # the transpose is taken to easily iterate by columns which are now
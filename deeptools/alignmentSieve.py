@@ -6,7 +6,8 @@ import sys
 
 from deeptools import parserCommon
 from deeptools.bamHandler import openBam
-from deeptools.mapReduce import mapReduce
+from deeptools.mapReduce import mapReduce, getFileHandle, restoresSettings, setExecutor
+from deeptools.readFilter import ReadFilter
 from deeptools.utilities import getTLen, smartLabels, getTempFileName
 from importlib.metadata import version
 
@@ -37,6 +38,8 @@ def parseArguments():
                          default=1,
                          required=False)
 
+    parserCommon.executorOptions(general)
+
     general.add_argument('--filterMetrics',
                          metavar="FILE.log",
                          help="The number of entries in total and filtered are saved to this file")
@@ -209,7 +212,7 @@ def shiftRead(b, chromDict, args):
 
 def filterWorker(arglist):
     chrom, start, end, args, chromDict = arglist
-    fh = openBam(args.bam)
+    fh = getFileHandle(openBam, args.bam)
     mode = 'wb'
     oname = getTempFileName(suffix='.bam')
     if args.filteredOutReads:
@@ -222,111 +225,17 @@ def filterWorker(arglist):
     else:
         ofiltered = None
 
-    prev_pos = set()
-    lpos = None
-
-    nFiltered = 0
-    total = 0
+    readFilter = ReadFilter.fromArgs(args)
     for read in fh.fetch(chrom, start, end):
         if read.pos < start:
             # ensure that we never double count (in case distanceBetweenBins == 0)
             continue
 
-        total += 1
-        if read.flag & 4:
-            # Ignore unmapped reads, they were counted already
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-
-        if args.minMappingQuality and read.mapq < args.minMappingQuality:
-            nFiltered += 1
+        if not readFilter.keep(read):
             if ofiltered:
                 ofiltered.write(read)
             continue
 
-        if args.samFlagInclude and read.flag & args.samFlagInclude != args.samFlagInclude:
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-        if args.samFlagExclude and read.flag & args.samFlagExclude != 0:
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-
-        tLen = getTLen(read)
-        if args.minFragmentLength > 0 and tLen < args.minFragmentLength:
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-        if args.maxFragmentLength > 0 and tLen > args.maxFragmentLength:
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-
-        if args.ignoreDuplicates:
-            # Assuming more or less concordant reads, use the fragment bounds, otherwise the start positions
-            if tLen >= 0:
-                s = read.pos
-                e = s + tLen
-            else:
-                s = read.pnext
-                e = s - tLen
-            if read.reference_id != read.next_reference_id:
-                e = read.pnext
-            if lpos is not None and lpos == read.reference_start \
-                    and (s, e, read.next_reference_id, read.is_reverse) in prev_pos:
-                nFiltered += 1
-                if ofiltered:
-                    ofiltered.write(read)
-                continue
-            if lpos != read.reference_start:
-                prev_pos.clear()
-            lpos = read.reference_start
-            prev_pos.add((s, e, read.next_reference_id, read.is_reverse))
-
-        # filterRNAstrand
-        if args.filterRNAstrand:
-            if read.is_paired:
-                if args.filterRNAstrand == 'forward':
-                    if read.flag & 144 == 128 or read.flag & 96 == 64:
-                        pass
-                    else:
-                        nFiltered += 1
-                        if ofiltered:
-                            ofiltered.write(read)
-                        continue
-                elif args.filterRNAstrand == 'reverse':
-                    if read.flag & 144 == 144 or read.flag & 96 == 96:
-                        pass
-                    else:
-                        nFiltered += 1
-                        if ofiltered:
-                            ofiltered.write(read)
-                        continue
-            else:
-                if args.filterRNAstrand == 'forward':
-                    if read.flag & 16 == 16:
-                        pass
-                    else:
-                        nFiltered += 1
-                        if ofiltered:
-                            ofiltered.write(read)
-                        continue
-                elif args.filterRNAstrand == 'reverse':
-                    if read.flag & 16 == 0:
-                        pass
-                    else:
-                        nFiltered += 1
-                        if ofiltered:
-                            ofiltered.write(read)
-                        continue
-
         if args.shift:
             read = shiftRead(read, chromDict, args)
             if not read:
@@ -335,13 +244,16 @@ def filterWorker(arglist):
         # Read survived filtering
         ofh.write(read)
 
+    # unmapped reads are counted as filtered
+    total = readFilter.counts["total"]
+    nFiltered = readFilter.counts["unmapped"] + readFilter.counts["filtered"]
+
     # The results from the workers will get sorted, so get the TID
     tid = fh.get_tid(chrom)
 
     ofh.close()
     if ofiltered:
         ofiltered.close()
-    fh.close()
     return tid, start, total, nFiltered, oname, onameFiltered
 
 
@@ -374,8 +286,10 @@ def convertBED(oname, tmpFiles, chromDict):
     ofile.close()
 
 
+@restoresSettings
 def main(args=None):
     args = parseArguments().parse_args(args)
+    setExecutor(args.executor)
     if args.shift:
         if len(args.shift) not in [2, 4]:
             sys.exit("The --shift option can accept either 2 or 4 values only.")
@@ -2,17 +2,22 @@
 # -*- coding: utf-8 -*-
 
 import argparse  # to parse command line arguments
+import json
+import os
 import numpy as np
 import sys
 
 # my packages
 from deeptools import writeBedGraph
-from deeptools.SES_scaleFactor import estimateScaleFactor
+from deeptools.SES_scaleFactor import estimateScaleFactor, estimateScaleFactorFromBinCounts
 from deeptools import parserCommon
+from deeptools import mapReduce
 from deeptools import bamHandler
 from deeptools.getRatio import getRatio
 from deeptools.getScaleFactor import get_num_kept_reads
 from deeptools.getScaleFactor import get_scale_factor
+from deeptools.getScaleFactor import fraction_kept_from_tallies
+from deeptools.binCounts import BinCounts
 debug = 0
 old_settings = np.seterr(all='ignore')
 
@@ -23,7 +28,7 @@ def parseArguments():
     normalizationParser = parserCommon.normalization_options()
     requiredArgs = getRequiredArgs()
     optionalArgs = getOptionalArgs()
-    outputParser = parserCommon.output()
+    outputParser = parserCommon.output(coverageOptions=True)
     parser = argparse.ArgumentParser(
         parents=[requiredArgs, outputParser, optionalArgs,
                  parentParser, normalizationParser, bamParser],
@@ -151,6 +156,20 @@ def getOptionalArgs():
                           'is added.',
                           action='store_true')
 
+    optional.add_argument('--countsFile',
+                          metavar='FILE',
+                          help='File in which the coverage of both BAM files in each bin is kept, '
+                          'before any scaling. If the file exists and was computed from the same BAM '
+                          'files with the same --binSize, --region, --blackListFileName and read '
+                          'options, the coverage is taken from it instead of the BAM files. Otherwise '
+                          'it is computed and written to the file. The scale factors and the output are '
+                          'computed from this coverage, so that e.g. --operation, --pseudocount, '
+                          '--scaleFactorsMethod or --outFileFormat can be changed without reading the '
+                          'BAM files again. With SES, the sampled regions are made of the bins in the '
+                          'file, so the scale factors can differ slightly from those computed without '
+                          'this option. With --exactScaling and without --blackListFileName, the reads '
+                          'kept by the filters are also counted in the file.')
+
     return parser
 
 
@@ -179,10 +198,22 @@ def process_args(args=None):
 # while get_scale_factor is used for depth normalization
 
 
-def get_scale_factors(args, statsList, mappedList):
-
+def get_scale_factors(args, statsList, mappedList, binCounts=None):
+    """
+    If binCounts is given, the BinCounts of --countsFile, the scale factors
+    are computed from it instead of from a sample of the reads.
+    """
     if args.scaleFactors:
         scale_factors = list(map(float, args.scaleFactors.split(":")))
+    elif args.scaleFactorsMethod == 'SES' and binCounts is not None:
+        scalefactors_dict = estimateScaleFactorFromBinCounts(
+            binCounts, args.sampleLength, args.numberOfSamples,
+            mappedList, chrsToSkip=args.ignoreForNormalization)
+
+        scale_factors = scalefactors_dict['size_factors']
+
+        if args.verbose:
+            print("Size factors using SES: {}".format(scale_factors))
     elif args.scaleFactorsMethod == 'SES':
         scalefactors_dict = estimateScaleFactor(
             [args.bamfile1, args.bamfile2],
@@ -212,10 +243,10 @@ def get_scale_factors(args, statsList, mappedList):
         args.scaleFactor = 1.0
         # get num of kept reads for bam file 1
         args.bam = args.bamfile1
-        bam1_mapped, _ = get_num_kept_reads(args, statsList[0])
+        bam1_mapped, _ = get_num_kept_reads(args, statsList[0], getFractionKept(args, binCounts, 0))
         # get num of kept reads for bam file 2
         args.bam = args.bamfile2
-        bam2_mapped, _ = get_num_kept_reads(args, statsList[1])
+        bam2_mapped, _ = get_num_kept_reads(args, statsList[1], getFractionKept(args, binCounts, 1))
 
         mapped_reads = [bam1_mapped, bam2_mapped]
 
@@ -231,6 +262,61 @@ def get_scale_factors(args, statsList, mappedList):
     return scale_factors
 
 
+def getFractionKept(args, binCounts, i):
+    """
+    Returns the fraction of the reads of the i-th BAM file kept by the
+    filters, as tallied in binCounts, or None without binCounts, in which
+    case fraction_kept is used. The tallies count all the reads, so they
+    are only used with --exactScaling, as fraction_kept otherwise samples
+    the reads and the output would differ from that of a run without
+    --countsFile. With a blacklist, the reads tallied in the bins are not
+    those fraction_kept counts around the blacklisted regions, so None is
+    returned as well.
+    """
+    if binCounts is None or not args.exactScaling or args.blackListFileName:
+        return None
+    return fraction_kept_from_tallies(args, binCounts.tallies[i])
+
+
+def getCountsParameters(args):
+    """
+    Returns what the coverage in --countsFile depends on: the BAM files
+    and blacklist, identified by their path, size and modification time,
+    and the options used to count the reads.
+    """
+    options = ['binSize', 'region', 'extendReads', 'minMappingQuality', 'ignoreDuplicates', 'centerReads',
+               'skipNonCoveredRegions', 'samFlagInclude', 'samFlagExclude', 'minFragmentLength',
+               'maxFragmentLength']
+    parameters = {x: getattr(args, x) for x in options}
+    parameters['bamFiles'] = [bamHandler.fileKey(args.bamfile1), bamHandler.fileKey(args.bamfile2)]
+    parameters['blackListFile'] = bamHandler.fileKey(args.blackListFileName)
+    # as read back from the file
+    return json.loads(json.dumps(parameters))
+
+
+def getBinCounts(args, wr):
+    """
+    Returns the BinCounts of --countsFile, which is first computed with the
+    WriteBedGraph object wr if it does not exist or was computed from other
+    BAM files or options.
+    """
+    parameters = getCountsParameters(args)
+    if os.path.exists(args.countsFile):
+        try:
+            binCounts = BinCounts(args.countsFile)
+        except ValueError as detail:
+            sys.exit("*Error*: {}. Please remove it or choose another --countsFile.".format(detail))
+        if binCounts.parameters == parameters:
+            sys.stderr.write("Using the coverage in {}\n".format(args.countsFile))
+            return binCounts
+        sys.stderr.write("{} was computed from other BAM files or options and is "
+                         "computed again.\n".format(args.countsFile))
+
+    wr.write_counts(args.countsFile, parameters, blackListFileName=args.blackListFileName)
+    return BinCounts(args.countsFile)
+
+
+@mapReduce.restoresSettings
 def main(args=None):
     """
     The algorithm is composed of two steps.
@@ -249,6 +335,8 @@ def main(args=None):
 
     """
     args = process_args(args)
+    mapReduce.setExecutor(args.executor)
+    mapReduce.setCheckpointDir(args.checkpointDir, [args.outFileName])
 
     if args.normalizeUsing == "RPGC":
         sys.exit("RPGC normalization (--normalizeUsing RPGC) is not supported with bamCompare!")
@@ -263,16 +351,42 @@ def main(args=None):
     bam2, mapped2, unmapped2, stats2 = bamHandler.openBam(args.bamfile2, returnStats=True, nThreads=args.numberOfProcessors)
     bam2.close()
 
-    scale_factors = get_scale_factors(args, [stats1, stats2], [mapped1, mapped2])
+    wr = writeBedGraph.WriteBedGraph([args.bamfile1, args.bamfile2], args.binSize, 0,
+                                     stepSize=args.binSize,
+                                     region=args.region,
+                                     numberOfProcessors=args.numberOfProcessors,
+                                     extendReads=args.extendReads,
+                                     blackListFileName=args.blackListFileName,
+                                     minMappingQuality=args.minMappingQuality,
+                                     ignoreDuplicates=args.ignoreDuplicates,
+                                     center_read=args.centerReads,
+                                     zerosToNans=args.skipNonCoveredRegions,
+                                     skipZeroOverZero=args.skipZeroOverZero,
+                                     samFlag_include=args.samFlagInclude,
+                                     samFlag_exclude=args.samFlagExclude,
+                                     minFragmentLength=args.minFragmentLength,
+                                     maxFragmentLength=args.maxFragmentLength,
+                                     chrsToSkip=args.ignoreForNormalization,
+                                     verbose=args.verbose
+                                     )
+
+    # with --countsFile, the coverage is counted once, or taken from a
+    # previous run, and both the scale factors and the output are computed
+    # from it
+    binCounts = None
+    if args.countsFile:
+        binCounts = getBinCounts(args, wr)
+
+    scale_factors = get_scale_factors(args, [stats1, stats2], [mapped1, mapped2], binCounts)
     if scale_factors is None:
         # check whether one of the depth norm methods are selected
         if args.normalizeUsing is not None:
             args.scaleFactor = 1.0
             # if a normalization is required then compute the scale factors
             args.bam = args.bamfile1
-            scale_factor_bam1 = get_scale_factor(args, stats1)
+            scale_factor_bam1 = get_scale_factor(args, stats1, getFractionKept(args, binCounts, 0))
             args.bam = args.bamfile2
-            scale_factor_bam2 = get_scale_factor(args, stats2)
+            scale_factor_bam2 = get_scale_factor(args, stats2, getFractionKept(args, binCounts, 1))
             scale_factors = [scale_factor_bam1, scale_factor_bam2]
         else:
             scale_factors = [1, 1]
@@ -288,26 +402,14 @@ def main(args=None):
                  'pseudocount': args.pseudocount
                  }
 
-    wr = writeBedGraph.WriteBedGraph([args.bamfile1, args.bamfile2], args.binSize, 0,
-                                     stepSize=args.binSize,
-                                     region=args.region,
-                                     numberOfProcessors=args.numberOfProcessors,
-                                     extendReads=args.extendReads,
-                                     blackListFileName=args.blackListFileName,
-                                     minMappingQuality=args.minMappingQuality,
-                                     ignoreDuplicates=args.ignoreDuplicates,
-                                     center_read=args.centerReads,
-                                     zerosToNans=args.skipNonCoveredRegions,
-                                     skipZeroOverZero=args.skipZeroOverZero,
-                                     samFlag_include=args.samFlagInclude,
-                                     samFlag_exclude=args.samFlagExclude,
-                                     minFragmentLength=args.minFragmentLength,
-                                     maxFragmentLength=args.maxFragmentLength,
-                                     chrsToSkip=args.ignoreForNormalization,
-                                     verbose=args.verbose
-                                     )
-
-    wr.run(FUNC, func_args, args.outFileName, blackListFileName=args.blackListFileName, format=args.outFileFormat, smoothLength=args.smoothLength)
+    if binCounts is not None:
+        wr.run_from_counts(binCounts, FUNC, func_args, args.outFileName, blackListFileName=args.blackListFileName,
+                           format=args.outFileFormat, smoothLength=args.smoothLength, maxZooms=args.zoomLevels,
+                           significantDigits=args.significantDigits, quantizationStep=args.quantizationStep)
+    else:
+        wr.run(FUNC, func_args, args.outFileName, blackListFileName=args.blackListFileName, format=args.outFileFormat, smoothLength=args.smoothLength,
+               maxZooms=args.zoomLevels, significantDigits=args.significantDigits,
+               quantizationStep=args.quantizationStep)
 
 
 if __name__ == "__main__":
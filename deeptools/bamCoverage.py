@@ -3,11 +3,15 @@
 
 # own tools
 import argparse
+import json
+import os
+import shlex
 import sys
 import numpy as np
 from deeptools import writeBedGraph  # This should be made directly into a bigWig
 from deeptools import parserCommon
-from deeptools.getScaleFactor import get_scale_factor
+from deeptools import mapReduce
+from deeptools.getScaleFactor import get_scale_factor, filters_reads, fraction_kept_from_tallies
 from deeptools.bamHandler import openBam
 
 debug = 0
@@ -19,7 +23,7 @@ def parseArguments():
     normalizationParser = parserCommon.normalization_options()
     requiredArgs = get_required_args()
     optionalArgs = get_optional_args()
-    outputParser = parserCommon.output()
+    outputParser = parserCommon.output(coverageOptions=True)
     parser = \
         argparse.ArgumentParser(
             parents=[requiredArgs, outputParser, optionalArgs,
@@ -111,6 +115,37 @@ def get_optional_args():
                           choices=['forward', 'reverse'],
                           default=None)
 
+    optional.add_argument('--extraOutput',
+                          help='Write another coverage file from the same pass over the BAM file. '
+                          'The value is a quoted list of bamCoverage options, which replace those '
+                          'given for the main output and must include a different --outFileName. '
+                          'Since the value starts with a dash, it must be attached to the option with '
+                          'an equal sign, for example --extraOutput="-o cpm.bw --binSize 10 --normalizeUsing CPM". '
+                          'The bin size, normalization, read filters, --Offset, --filterRNAstrand, '
+                          '--smoothLength and output format can differ between the outputs. '
+                          '--bam, --region, --blackListFileName and --numberOfProcessors cannot. '
+                          'This option can be given several times. The reads are fetched and '
+                          'decoded once for all the outputs, which is faster than running '
+                          'bamCoverage for each of them.',
+                          metavar='"OPTIONS"',
+                          action='append')
+
+    optional.add_argument('--incremental',
+                          help='Update the bigWig file given with --outFileName instead of writing '
+                          'it anew. Only the chromosomes whose length or number of mapped and unmapped '
+                          'reads (from the BAM index) changed since the previous run are recomputed, '
+                          'the values of the others are copied from the existing file. The read counts, '
+                          'scale factor and options of each run are stored in the file '
+                          '<outFileName>.provenance.json. If that file does not exist, or the options '
+                          'or scale factor differ, the whole bigWig file is recomputed.',
+                          action='store_true')
+
+    optional.add_argument('--recomputeChroms',
+                          help='With --incremental, chromosomes to recompute even if their number '
+                          'of reads did not change, for example after realigning their reads.',
+                          metavar='CHROM',
+                          nargs='+')
+
     return parser
 
 
@@ -140,8 +175,13 @@ def process_args(args=None):
     return args
 
 
+@mapReduce.restoresSettings
 def main(args=None):
-    args = process_args(args)
+    if args is None:
+        args = sys.argv[1:]
+    argv = list(args)
+    args = process_args(argv)
+    mapReduce.setExecutor(args.executor)
 
     global debug
     if args.verbose:
@@ -150,16 +190,68 @@ def main(args=None):
     else:
         debug = 0
 
+    # with --exactScaling, the reads kept by the filters are counted while
+    # computing the coverage, which is scaled once all reads are counted.
+    # The reads starting in blacklisted regions are not counted there, so
+    # with a blacklist the fraction kept is computed beforehand instead.
+    tallyReads = args.exactScaling and args.normalizeUsing not in [None, 'None'] and filters_reads(args) \
+        and not (args.extraOutput or args.incremental or args.region or args.MNase or args.blackListFileName)
+    outputs = [get_output(args, tallyReads)]
+    for extraOutput in args.extraOutput or []:
+        # the options of the extra output override those of the main output
+        extraArgs = process_args(argv + shlex.split(extraOutput))
+        if [extraArgs.bam, extraArgs.region, extraArgs.blackListFileName, extraArgs.numberOfProcessors] != \
+                [args.bam, args.region, args.blackListFileName, args.numberOfProcessors]:
+            sys.exit("*Error*: --bam, --region, --blackListFileName and --numberOfProcessors "
+                     "must be the same for all outputs.")
+        if extraArgs.outFileName in [x[1]['out_file_name'] for x in outputs]:
+            sys.exit("*Error*: Each --extraOutput needs its own --outFileName.")
+        outputs.append(get_output(extraArgs))
+    # with --incremental, the output is also an input
+    mapReduce.setCheckpointDir(args.checkpointDir,
+                               [] if args.incremental else [x[1]['out_file_name'] for x in outputs])
+
+    if args.incremental:
+        if len(outputs) > 1 or args.outFileFormat != 'bigwig' or args.region:
+            sys.exit("*Error*: --incremental can only update a single bigWig file, "
+                     "without --extraOutput or --region.")
+        wr, runArgs = outputs[0]
+        updateBigWig(args, wr, runArgs)
+    elif len(outputs) == 1:
+        wr, runArgs = outputs[0]
+        wr.run(blackListFileName=args.blackListFileName, **runArgs)
+    else:
+        writeBedGraph.runMultiple(outputs,
+                                  blackListFileName=args.blackListFileName,
+                                  region=args.region,
+                                  numberOfProcessors=args.numberOfProcessors)
+
+
+def get_output(args, tallyReads=False):
+    """
+    Returns the WriteBedGraph object computing the coverage for the given
+    options, and the arguments of its run method.
+
+    With tallyReads, the scale factor is computed by the run method from
+    the reads it counts (see WriteBedGraph.run) instead of beforehand.
+    """
     if args.normalizeUsing == 'None':
         args.normalizeUsing = None  # For the sake of sanity
     elif args.normalizeUsing == 'RPGC' and not args.effectiveGenomeSize:
         sys.exit("RPGC normalization requires an --effectiveGenomeSize!\n")
 
+    scaleFactorFunc = None
     if args.normalizeUsing:
         # if a normalization is required then compute the scale factors
         bam, mapped, unmapped, stats = openBam(args.bam, returnStats=True, nThreads=args.numberOfProcessors)
         bam.close()
-        scale_factor = get_scale_factor(args, stats)
+        if tallyReads:
+            def getTalliedScaleFactor(tallies):
+                return get_scale_factor(args, stats, fraction_kept_from_tallies(args, tallies))
+            scaleFactorFunc = getTalliedScaleFactor
+            scale_factor = 1.0
+        else:
+            scale_factor = get_scale_factor(args, stats)
     else:
         scale_factor = args.scaleFactor
 
@@ -253,9 +345,67 @@ def main(args=None):
                                          verbose=args.verbose,
                                          )
 
-    wr.run(writeBedGraph.scaleCoverage, func_args, args.outFileName,
-           blackListFileName=args.blackListFileName,
-           format=args.outFileFormat, smoothLength=args.smoothLength)
+    runArgs = {'func_to_call': writeBedGraph.scaleCoverage,
+               'func_args': func_args,
+               'out_file_name': args.outFileName,
+               'format': args.outFileFormat,
+               'smoothLength': args.smoothLength,
+               'maxZooms': args.zoomLevels,
+               'significantDigits': args.significantDigits,
+               'quantizationStep': args.quantizationStep * scale_factor if args.quantizationStep else None}
+    if scaleFactorFunc is not None:
+        runArgs['scaleFactorFunc'] = scaleFactorFunc
+    return wr, runArgs
+
+
+def updateBigWig(args, wr, runArgs):
+    """
+    Writes the bigWig file of --incremental, recomputing only the
+    chromosomes that changed since the run described by the provenance
+    file of the existing bigWig file, and updates the provenance file.
+    """
+    provenanceFileName = args.outFileName + ".provenance.json"
+    bam, mapped, unmapped, stats = openBam(args.bam, returnStats=True, nThreads=args.numberOfProcessors)
+    chromSizes = list(zip(bam.references, bam.lengths))
+    bam.close()
+
+    # the options that only affect how the file is computed, not its values
+    skip = ['outFileName', 'numberOfProcessors', 'executor', 'checkpointDir', 'verbose',
+            'incremental', 'recomputeChroms', 'extraOutput', 'zoomLevels']
+    provenance = {'parameters': {k: v for k, v in vars(args).items() if k not in skip},
+                  'scaleFactor': runArgs['func_args']['scaleFactor'],
+                  'chroms': {chrom: [size] + list(stats.get(chrom, [0, 0])) for chrom, size in chromSizes}}
+    # as it is read back from the file
+    provenance = json.loads(json.dumps(provenance))
+
+    reuseChroms = []
+    if not os.path.exists(args.outFileName) or not os.path.exists(provenanceFileName):
+        sys.stderr.write("No previous run of {} found, computing all chromosomes.\n".format(args.outFileName))
+    else:
+        with open(provenanceFileName) as f:
+            previous = json.load(f)
+        if previous['parameters'] != provenance['parameters'] or previous['scaleFactor'] != provenance['scaleFactor']:
+            sys.stderr.write("The options or the scale factor changed since the previous run of {}, "
+                             "computing all chromosomes.\n".format(args.outFileName))
+        else:
+            reuseChroms = [chrom for chrom, size in chromSizes
+                           if chrom not in (args.recomputeChroms or []) and
+                           previous['chroms'].get(chrom) == provenance['chroms'][chrom]]
+
+    if len(reuseChroms) == len(chromSizes):
+        sys.stderr.write("{} is up to date.\n".format(args.outFileName))
+        return
+    sys.stderr.write("Computing {} of {} chromosomes.\n".format(len(chromSizes) - len(reuseChroms), len(chromSizes)))
+
+    # the existing file is read while the new one is written
+    tempFileName = args.outFileName + ".part"
+    wr.run(blackListFileName=args.blackListFileName,
+           reuseBigWig=args.outFileName if reuseChroms else None,
+           reuseChroms=reuseChroms,
+           **dict(runArgs, out_file_name=tempFileName))
+    os.replace(tempFileName, args.outFileName)
+    with open(provenanceFileName, 'w') as f:
+        json.dump(provenance, f, indent=1, sort_keys=True)
 
 
 class OffsetFragment(writeBedGraph.WriteBedGraph):
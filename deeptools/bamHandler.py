@@ -1,7 +1,15 @@
+import hashlib
+import json
+import os
+import struct
 import sys
+import numpy as np
 import pysam
 from deeptools.mapReduce import mapReduce
 
+# the linear indices read by this process, see getLinearIndex
+_linearIndices = {}
+
 
 def countReadsInInterval(args):
     chrom, start, end, fname, toEOF = args
@@ -82,7 +90,14 @@ def openBam(bamFile, returnStats=False, nThreads=1, minimalDecoding=True):
         sys.exit("'{}' does not appear to have an index. You MUST index the file first!".format(bamFile))
 
     if bam.is_cram and returnStats:
-        mapped, unmapped, stats = getMappingStats(bam, nThreads)
+        # counting the reads of a CRAM file means reading all of it
+        cache = StatsCache(bamFile)
+        cached = cache.get("mappingStats")
+        if cached is None:
+            mapped, unmapped, stats = getMappingStats(bam, nThreads)
+            cache.set("mappingStats", None, [mapped, unmapped, stats])
+        else:
+            mapped, unmapped, stats = cached
     elif bam.is_bam:
         mapped = bam.mapped
         unmapped = bam.unmapped
@@ -101,3 +116,306 @@ def openBam(bamFile, returnStats=False, nThreads=1, minimalDecoding=True):
         return bam, mapped, unmapped, stats
     else:
         return bam
+
+
+def getIndexFileName(fileName):
+    """
+    Returns the name of the index file of a BAM/CRAM file, or None if it
+    is not found.
+    """
+    for indexName in [fileName + ".bai", os.path.splitext(fileName)[0] + ".bai", fileName + ".csi",
+                      fileName + ".crai", os.path.splitext(fileName)[0] + ".crai"]:
+        if os.path.exists(indexName):
+            return indexName
+    return None
+
+
+def fileKey(fileName):
+    """
+    Returns the absolute path, size and modification time of fileName, to
+    tell whether a statistic was computed with the same file, or None if
+    fileName is None. fileName can also be a list of files (as given to
+    --blackListFileName), for which the list of their keys is returned.
+
+    >>> import tempfile
+    >>> fileName = tempfile.NamedTemporaryFile(suffix=".bed", delete=False).name
+    >>> key = fileKey(fileName)
+    >>> key[0] == os.path.abspath(fileName), key[1]
+    (True, 0)
+    >>> fileKey([fileName, fileName]) == [key, key]
+    True
+    >>> fileKey(None) is None
+    True
+    >>> os.remove(fileName)
+    """
+    if fileName is None:
+        return None
+    if isinstance(fileName, (list, tuple)):
+        return [fileKey(x) for x in fileName]
+    st = os.stat(fileName)
+    return [os.path.abspath(fileName), st.st_size, st.st_mtime]
+
+
+def _jsonValue(value):
+    # numpy scalars and arrays
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError("{} can not be written to a statistics file".format(type(value)))
+
+
+class StatsCache(object):
+    """
+    Statistics of a BAM/CRAM file that take long to compute, kept in a JSON
+    file so that they are computed once for all deepTools runs on the file.
+    Each statistic is stored under a name and the parameters (a JSON
+    serializable value) it was computed with. The statistics are discarded
+    when the size or modification time of the file or of its index change.
+
+    The cache is only used if the environment variable
+    DEEPTOOLS_STATS_CACHE is set to a directory, which holds the statistics
+    files of all BAM/CRAM files. Nothing is cached if the directory can not
+    be written.
+
+    >>> import shutil, tempfile
+    >>> os.environ["DEEPTOOLS_STATS_CACHE"] = tempfile.mkdtemp()
+    >>> fileName = tempfile.NamedTemporaryFile(suffix=".bam", delete=False).name
+    >>> StatsCache(fileName).get("fractionKept", {"minMappingQuality": 10}) is None
+    True
+    >>> StatsCache(fileName).set("fractionKept", {"minMappingQuality": 10}, 0.9)
+    >>> StatsCache(fileName).get("fractionKept", {"minMappingQuality": 10})
+    0.9
+    >>> with open(fileName, "w") as f:
+    ...     _ = f.write("changed")
+    >>> StatsCache(fileName).get("fractionKept", {"minMappingQuality": 10}) is None
+    True
+    >>> os.remove(fileName)
+    >>> shutil.rmtree(os.environ.pop("DEEPTOOLS_STATS_CACHE"))
+    """
+    def __init__(self, fileName):
+        if isinstance(fileName, bytes):
+            fileName = fileName.decode()
+        self.fileName = fileName
+        self.cacheDir = os.environ.get("DEEPTOOLS_STATS_CACHE")
+        self.cacheFileName = None
+        self.key = None
+        if self.cacheDir:
+            # the files of BAM files with the same name in other
+            # directories are told apart by a hash of their path
+            pathHash = hashlib.sha1(os.path.abspath(fileName).encode("utf-8")).hexdigest()[:16]
+            baseName = os.path.basename(fileName)
+            self.cacheFileName = os.path.join(self.cacheDir, "{}.{}.dtstats".format(baseName, pathHash))
+            try:
+                self.key = self.getKey()
+            except (IOError, OSError):
+                # e.g. a remote file
+                pass
+
+    def getKey(self):
+        st = os.stat(self.fileName)
+        index = None
+        indexName = getIndexFileName(self.fileName)
+        if indexName is not None:
+            indexStat = os.stat(indexName)
+            index = [indexStat.st_size, indexStat.st_mtime]
+        return {"size": st.st_size, "mtime": st.st_mtime, "index": index}
+
+    def load(self):
+        try:
+            with open(self.cacheFileName) as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if cache.get("key") != self.key:
+            return {}
+        return cache.get("stats", {})
+
+    @staticmethod
+    def statName(name, parameters):
+        return name + json.dumps(parameters, sort_keys=True, default=_jsonValue)
+
+    def get(self, name, parameters=None):
+        """
+        Returns the statistic computed with the given parameters, or None
+        if it is not cached.
+        """
+        if self.key is None:
+            return None
+        return self.load().get(self.statName(name, parameters))
+
+    def set(self, name, parameters, value):
+        if self.key is None:
+            return
+        # statistics stored by other runs in the meantime are kept
+        stats = self.load()
+        stats[self.statName(name, parameters)] = value
+        tempName = "{}.{}.part".format(self.cacheFileName, os.getpid())
+        try:
+            os.makedirs(self.cacheDir, exist_ok=True)
+            with open(tempName, "w") as f:
+                json.dump({"key": self.key, "stats": stats}, f, default=_jsonValue)
+            os.replace(tempName, self.cacheFileName)
+        except (IOError, OSError):
+            # e.g. a read-only directory
+            if os.path.exists(tempName):
+                os.remove(tempName)
+
+
+def getLinearIndex(bam):
+    """
+    Reads the linear index of the .bai file belonging to an open BAM file.
+
+    The linear index stores, for each 16kb window of a chromosome, the
+    (virtual) file offset of the first alignment overlapping it. The
+    difference between two such offsets is the number of compressed bytes
+    spanned by the alignments in between, which is a cheap estimate of the
+    work needed to process a region.
+
+    Returns a dictionary with, for each chromosome, an array of the
+    compressed offsets of every window followed by the offset of the end of
+    that chromosome's alignments. None is returned if there is no .bai
+    file (e.g., for CRAM files or .csi indices).
+
+    The index is read once per process and kept, keyed by the path, size
+    and modification time of the .bai file, so the workers can call this
+    for each chunk.
+    """
+    fname = bam.filename
+    if isinstance(fname, bytes):
+        fname = fname.decode()
+    if not bam.is_bam:
+        return None
+    for indexName in [fname + ".bai", os.path.splitext(fname)[0] + ".bai"]:
+        if os.path.exists(indexName):
+            break
+    else:
+        return None
+
+    stat = os.stat(indexName)
+    key = (os.path.abspath(indexName), stat.st_size, stat.st_mtime_ns, tuple(bam.references))
+    if key not in _linearIndices:
+        _linearIndices[key] = readLinearIndex(indexName, bam.references)
+    return _linearIndices[key]
+
+
+def readLinearIndex(indexName, references):
+    """
+    Reads the linear index of a .bai file, see getLinearIndex.
+    """
+    with open(indexName, "rb") as f:
+        data = f.read()
+    if data[:4] != b"BAI\1":
+        return None
+
+    nRef, = struct.unpack_from("<i", data, 4)
+    if nRef != len(references):
+        return None
+    offset = 8
+    index = {}
+    for chrom in references:
+        nBin, = struct.unpack_from("<i", data, offset)
+        offset += 4
+        refEnd = 0
+        for _ in range(nBin):
+            binID, nChunk = struct.unpack_from("<Ii", data, offset)
+            offset += 8
+            # the pseudo-bin holds the offsets of the first and last alignment
+            if binID == 37450:
+                refEnd = struct.unpack_from("<Q", data, offset + 8)[0] >> 16
+            offset += 16 * nChunk
+        nIntv, = struct.unpack_from("<i", data, offset)
+        offset += 4
+        offsets = np.frombuffer(data, dtype="<u8", count=nIntv, offset=offset) >> 16
+        offset += 8 * nIntv
+        # windows without alignments have an offset of 0
+        offsets = np.maximum.accumulate(np.append(offsets, refEnd).astype(np.int64))
+        index[chrom] = offsets
+
+    return index
+
+
+def estimateReads(bam, mapped, chrom, start, end):
+    """
+    Returns an estimate of the number of alignments of an open BAM file
+    overlapping a region, from the share of the compressed bytes of the
+    file spanned by the region in the linear index (see getLinearIndex) and
+    the number of mapped reads of the file. As the linear index has 16kb
+    windows, the estimate is coarse for shorter regions. None is returned
+    if there is no .bai file.
+
+    >>> import os
+    >>> root = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+    >>> bam = openBam(root + "test1.bam")
+    >>> estimateReads(bam, 3, "3R", 0, 1500)
+    3.0
+    """
+    index = getLinearIndex(bam)
+    if index is None or chrom not in index:
+        return None
+    total = float(sum(x[-1] - x[0] for x in index.values() if len(x)))
+    if total <= 0:
+        return None
+    offsets = index[chrom]
+    first = min(start >> 14, len(offsets) - 1)
+    last = min((end >> 14) + 1, len(offsets) - 1)
+    return float(mapped * (offsets[last] - offsets[first]) / total)
+
+
+def getChunkCost(bamFiles, statsList=None):
+    """
+    Returns a function that estimates the relative cost of processing a
+    genomic region, to be used by mapReduce to balance its chunks, or None
+    if no estimate can be made.
+
+    The cost of a region in a BAM file with a .bai index is the fraction of
+    the file's compressed bytes between the linear index entries around the
+    region. Otherwise, the per-chromosome mapped read counts in `statsList`
+    (as returned by openBam(returnStats=True)) are used, assuming that the
+    reads are uniformly distributed along each chromosome. The costs of all
+    files are added up.
+
+    >>> import os
+    >>> root = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+    >>> cost = getChunkCost([root + "test1.bam"])
+    >>> cost("3R", 0, 1500)
+    1.0
+    >>> cost("chr1", 0, 1500)
+    0.0
+    """
+    if statsList is None or len(statsList) != len(bamFiles):
+        statsList = [None] * len(bamFiles)
+
+    estimators = []
+    for fname, stats in zip(bamFiles, statsList):
+        bam = openBam(fname)
+        index = getLinearIndex(bam)
+        if index is not None:
+            total = float(sum(x[-1] - x[0] for x in index.values() if len(x)))
+            if total > 0:
+                estimators.append(("index", index, total))
+        elif stats is not None:
+            total = float(sum(x[0] for x in stats.values()))
+            if total > 0:
+                density = {chrom: float(stats[chrom][0]) / size
+                           for chrom, size in zip(bam.references, bam.lengths)
+                           if chrom in stats and size > 0}
+                estimators.append(("stats", density, total))
+        bam.close()
+
+    if len(estimators) == 0:
+        return None
+
+    def cost(chrom, start, end):
+        value = 0.0
+        for kind, data, total in estimators:
+            if chrom not in data:
+                continue
+            if kind == "index":
+                offsets = data[chrom]
+                first = min(start >> 14, len(offsets) - 1)
+                last = min((end >> 14) + 1, len(offsets) - 1)
+                value += (offsets[last] - offsets[first]) / total
+            else:
+                value += data[chrom] * (end - start) / total
+        return float(value)
+
+    return cost
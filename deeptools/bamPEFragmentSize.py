@@ -16,7 +16,8 @@ import plotly.offline as py
 import plotly.graph_objs as go
 
 # own tools
-from deeptools.parserCommon import writableFile
+from deeptools.parserCommon import writableFile, executorOptions
+from deeptools import mapReduce
 from deeptools.getFragmentAndReadSize import get_read_and_fragment_length
 from importlib.metadata import version
 
@@ -60,6 +61,7 @@ def parse_arguments():
                         type=int,
                         default=1,
                         required=False)
+    executorOptions(parser)
     parser.add_argument('--samplesLabel',
                         help='Labels for the samples plotted. The '
                         'default is to use the file name of the '
@@ -290,8 +292,10 @@ def printTable(args, fragDict, readDict):
     of.close()
 
 
+@mapReduce.restoresSettings
 def main(args=None):
     args = parse_arguments().parse_args(args)
+    mapReduce.setExecutor(args.executor)
 
     if len(sys.argv) == 1:
         parse_arguments().print_help()
@@ -4,6 +4,7 @@ import argparse
 import sys
 import numpy as np
 from deeptools import parserCommon
+from deeptools import mapReduce
 from deeptools import writeBedGraph_bam_and_bw
 
 debug = 0
@@ -84,13 +85,32 @@ def average(tileCoverage, args):
     nan
     """
 
-    norm_values = [args['scaleFactors'][i] * cov for i, cov in enumerate(tileCoverage)]
+    return float(averageArray(np.asarray([tileCoverage]), args)[0])
 
-    return np.mean(norm_values)
+
+def averageArray(coverage, args):
+    r"""
+    Computes the values of all the tiles of a (tiles x samples) coverage
+    array at once, see average.
+
+    >>> funcArgs= {'scaleFactors': (1,0.5,0.1,0.2)}
+    >>> averageArray(np.array([[1, 2, 3, 12], [1, 2, 3, np.nan]]), funcArgs).tolist()
+    [1.175, nan]
+    """
+    coverage = np.asarray(coverage, dtype='float64')
+    norm_values = coverage * np.asarray(args['scaleFactors'][:coverage.shape[1]], dtype='float64')
+
+    return np.mean(norm_values, axis=1)
+
+
+average.vectorized = averageArray
 
 
+@mapReduce.restoresSettings
 def main(args=None):
     args = parse_arguments().parse_args(args)
+    mapReduce.setExecutor(args.executor)
+    mapReduce.setCheckpointDir(args.checkpointDir, [args.outFileName])
     if len(sys.argv) == 1:
         parse_arguments().print_help()
         sys.exit()
@@ -123,6 +143,7 @@ def main(args=None):
         numberOfProcessors=args.numberOfProcessors,
         skipZeroOverZero=False,
         format=args.outFileFormat,
+        maxZooms=args.zoomLevels,
         smoothLength=False,
         missingDataAsZero=not args.skipNonCoveredRegions,
         extendPairedEnds=False)
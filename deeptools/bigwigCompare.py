@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 import argparse
 from deeptools import parserCommon
+from deeptools import mapReduce
 from deeptools.getRatio import getRatio
 from deeptools import writeBedGraph_bam_and_bw
 
@@ -109,8 +110,11 @@ def getType(fname):
         return "bigwig"
 
 
+@mapReduce.restoresSettings
 def main(args=None):
     args = parse_arguments().parse_args(args)
+    mapReduce.setExecutor(args.executor)
+    mapReduce.setCheckpointDir(args.checkpointDir, [args.outFileName])
 
     if args.scaleFactors:
         scaleFactors = [float(x) for x in args.scaleFactors.split(":")]
@@ -140,6 +144,7 @@ def main(args=None):
         numberOfProcessors=args.numberOfProcessors,
         skipZeroOverZero=args.skipZeroOverZero,
         format=args.outFileFormat,
+        maxZooms=args.zoomLevels,
         smoothLength=False,
         missingDataAsZero=not args.skipNonCoveredRegions,
         extendPairedEnds=False,
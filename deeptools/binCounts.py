@@ -0,0 +1,109 @@
+"""
+A file with the raw coverage of several bam files in the bins of a genome,
+as computed by CountReadsPerBin before any scaling, written by bamCompare
+with --countsFile. The values of a comparison can be computed again from
+it with other operations, pseudocounts or scale factors, without reading
+the bam files again (see WriteBedGraph.run_from_counts).
+
+The file contains, in this order:
+
+  * the 8 bytes MAGIC
+  * for each chunk of the genome, in genome order, its (bins x files)
+    coverage as a float32 array in the .npy format
+  * a JSON header with the parameters given to BinCountsWriter, the names
+    and lengths of the chromosomes, the chromosome, start, end and file
+    offset of each chunk and, for each bam file, the reads tallied for
+    each chromosome while counting (see countReadsPerBin.ReadTally)
+  * the file offset of the JSON header as a little-endian uint64
+  * the 8 bytes MAGIC again
+
+As for binaryCoverage, the header is at the end, so that the chunks can be
+written as they are computed.
+"""
+import json
+import os
+import struct
+import numpy as np
+
+MAGIC = b"DTBINCNT"
+
+
+class BinCountsWriter(object):
+    """
+    Writes the coverage of the chunks added with add to fileName. The
+    file is written to fileName.part first and only replaces fileName
+    when closed, so an interrupted run does not leave a truncated file.
+
+    >>> import tempfile
+    >>> fileName = tempfile.NamedTemporaryFile(suffix=".counts", delete=False).name
+    >>> w = BinCountsWriter(fileName, [("chr1", 45)], {"binSize": 10}, 2)
+    >>> w.add("chr1", 0, 20, np.array([[1, 0], [2, 1]]), [(3, 0, 3), (1, 0, 1)])
+    >>> w.add("chr1", 20, 45, np.array([[0, 0], [4, 1], [1, 1]]), [(4, 1, 2), (1, 0, 1)])
+    >>> w.close()
+    >>> bc = BinCounts(fileName)
+    >>> bc.parameters
+    {'binSize': 10}
+    >>> bc.tallies
+    [{'chr1': [7, 1, 5]}, {'chr1': [2, 0, 2]}]
+    >>> [(chrom, start, end, counts.tolist()) for chrom, start, end, counts in bc.chunks()][1]
+    ('chr1', 20, 45, [[0.0, 0.0], [4.0, 1.0], [1.0, 1.0]])
+    >>> os.remove(fileName)
+    """
+    def __init__(self, fileName, chromSizes, parameters, numberOfFiles):
+        self.fileName = fileName
+        self.file = open(fileName + ".part", "wb")
+        self.file.write(MAGIC)
+        self.chromSizes = [[name, int(length)] for name, length in chromSizes]
+        self.parameters = parameters
+        self.chunkList = []
+        self.tallies = [{} for _ in range(numberOfFiles)]
+
+    def add(self, chrom, start, end, counts, tallies):
+        self.chunkList.append([chrom, int(start), int(end), self.file.tell()])
+        np.save(self.file, np.asarray(counts, dtype="<f4"), allow_pickle=False)
+        for fileTallies, fileCounts in zip(self.tallies, tallies):
+            chromTally = fileTallies.setdefault(chrom, [0, 0, 0])
+            for i, count in enumerate(fileCounts):
+                chromTally[i] += int(count)
+
+    def close(self):
+        headerOffset = self.file.tell()
+        header = {"parameters": self.parameters, "chroms": self.chromSizes,
+                  "chunks": self.chunkList, "tallies": self.tallies}
+        self.file.write(json.dumps(header).encode("utf-8"))
+        self.file.write(struct.pack("<Q", headerOffset))
+        self.file.write(MAGIC)
+        self.file.close()
+        os.replace(self.fileName + ".part", self.fileName)
+
+
+class BinCounts(object):
+    """
+    Reads a file written by BinCountsWriter.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with open(fileName, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a bin counts file".format(fileName))
+            f.seek(-8 - len(MAGIC), 2)
+            footerOffset = f.tell()
+            headerOffset = struct.unpack("<Q", f.read(8))[0]
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is truncated".format(fileName))
+            f.seek(headerOffset)
+            header = json.loads(f.read(footerOffset - headerOffset).decode("utf-8"))
+        self.parameters = header["parameters"]
+        self.chromSizes = [tuple(x) for x in header["chroms"]]
+        self.chunkList = header["chunks"]
+        self.tallies = header["tallies"]
+
+    def chunks(self):
+        """
+        Yields the chromosome, start, end and (bins x files) coverage of
+        each chunk, in genome order.
+        """
+        with open(self.fileName, "rb") as f:
+            for chrom, start, end, offset in self.chunkList:
+                f.seek(offset)
+                yield chrom, start, end, np.load(f, allow_pickle=False)
@@ -0,0 +1,238 @@
+"""
+A simple binary format for the values of fixed-width bins, written by
+bamCoverage and bamCompare with --outFileFormat binary. Other tools read it
+through openCoverage, which returns a BinaryCoverage object for these files
+and a pyBigWig handle otherwise. BinaryCoverage provides the part of the
+pyBigWig interface used by deepTools (chroms, values and stats), reading the
+values with np.memmap instead of decompressing bigWig blocks.
+
+The file contains, in this order:
+
+  * the 8 bytes MAGIC
+  * for each chromosome with values, the value of each of its bins as a
+    little-endian float32, nan for bins without a value
+  * a JSON header with the bin size, the names and lengths of all
+    chromosomes and, for those with values, the start of their first bin,
+    their number of bins and the file offset of their values
+  * the file offset of the JSON header as a little-endian uint64
+  * the 8 bytes MAGIC again
+
+The header is at the end, so that the values can be written as they are
+computed.
+"""
+import json
+import struct
+import numpy as np
+import pyBigWig
+
+MAGIC = b"DTBINCOV"
+
+
+def isBinaryCoverage(fileName):
+    """
+    Returns True if fileName is in the binary coverage format.
+    """
+    try:
+        with open(fileName, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def openCoverage(fileName):
+    """
+    Opens a binary coverage or bigWig file, with the same interface for
+    the methods used by deepTools.
+    """
+    if isBinaryCoverage(fileName):
+        return BinaryCoverage(fileName)
+    return pyBigWig.open(fileName)
+
+
+class BinaryCoverageWriter(object):
+    """
+    Writes the values of consecutive bins of binSize bp. chromSizes is a
+    list of (name, length) tuples. The values of a chromosome are added
+    with addValues, in order and without overlaps. Gaps between them are
+    filled with nan.
+
+    >>> import os, tempfile
+    >>> fileName = tempfile.NamedTemporaryFile(suffix=".bin", delete=False).name
+    >>> w = BinaryCoverageWriter(fileName, 10, [("chr1", 45), ("chr2", 100)])
+    >>> w.addValues("chr1", 0, np.array([1, 2]))
+    >>> w.addValues("chr1", 30, np.array([3, 4]))
+    >>> w.close()
+    >>> bc = BinaryCoverage(fileName)
+    >>> bc.chroms()
+    {'chr1': 45, 'chr2': 100}
+    >>> bc.values("chr1", 8, 12).tolist()
+    [1.0, 1.0, 2.0, 2.0]
+    >>> bc.stats("chr1", 0, 40, nBins=4)
+    [1.0, 2.0, None, 3.0]
+    >>> bc.close()
+    >>> os.remove(fileName)
+    """
+    def __init__(self, fileName, binSize, chromSizes):
+        self.file = open(fileName, "wb")
+        self.file.write(MAGIC)
+        self.binSize = binSize
+        self.chromSizes = [(name, int(length)) for name, length in chromSizes]
+        self.bins = {}
+        self.lastChrom = None
+
+    def addValues(self, chrom, start, values):
+        if len(values) == 0:
+            return
+        if chrom not in self.bins:
+            self.bins[chrom] = {"start": int(start), "nBins": 0, "offset": self.file.tell()}
+        elif chrom != self.lastChrom:
+            raise ValueError("The values of {} are not consecutive".format(chrom))
+        bins = self.bins[chrom]
+        nextStart = bins["start"] + bins["nBins"] * self.binSize
+        if start < nextStart or (start - nextStart) % self.binSize:
+            raise ValueError("The values at {}:{} do not start at a bin after "
+                             "{}:{}".format(chrom, start, chrom, nextStart))
+        if start > nextStart:
+            gap = (start - nextStart) // self.binSize
+            self.file.write(np.full(gap, np.nan, dtype="<f4").tobytes())
+            bins["nBins"] += gap
+        self.file.write(np.asarray(values, dtype="<f4").tobytes())
+        bins["nBins"] += len(values)
+        self.lastChrom = chrom
+
+    def close(self):
+        chroms = []
+        for name, length in self.chromSizes:
+            chrom = {"name": name, "length": length}
+            chrom.update(self.bins.get(name, {}))
+            chroms.append(chrom)
+        headerOffset = self.file.tell()
+        self.file.write(json.dumps({"binSize": self.binSize, "chroms": chroms}).encode("utf-8"))
+        self.file.write(struct.pack("<Q", headerOffset))
+        self.file.write(MAGIC)
+        self.file.close()
+
+
+class BinaryCoverage(object):
+    """
+    Reads a file written by BinaryCoverageWriter. The values of each
+    chromosome are memory mapped when they are first needed.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with open(fileName, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a binary coverage file".format(fileName))
+            f.seek(-8 - len(MAGIC), 2)
+            footerOffset = f.tell()
+            headerOffset = struct.unpack("<Q", f.read(8))[0]
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is truncated".format(fileName))
+            f.seek(headerOffset)
+            header = json.loads(f.read(footerOffset - headerOffset).decode("utf-8"))
+        self.binSize = header["binSize"]
+        self.chromInfo = {x["name"]: x for x in header["chroms"]}
+        self.arrays = {}
+
+    def chroms(self, chrom=None):
+        if chrom is None:
+            return {name: x["length"] for name, x in self.chromInfo.items()}
+        if chrom in self.chromInfo:
+            return self.chromInfo[chrom]["length"]
+        return None
+
+    def bins(self, chrom):
+        """
+        Returns the start of the first bin of chrom and the values of its
+        bins, as a memory mapped array (or None if it has no values).
+        """
+        info = self.chromInfo[chrom]
+        if not info.get("nBins"):
+            return None, None
+        if chrom not in self.arrays:
+            self.arrays[chrom] = np.memmap(self.fileName, dtype="<f4", mode="r",
+                                           offset=info["offset"], shape=(info["nBins"],))
+        return info["start"], self.arrays[chrom]
+
+    def runs(self, chrom, start, end, edges=None):
+        """
+        Returns the start, length and value of the runs of bases with the
+        same value from start to end, splitting them at the positions in
+        edges. The values come from a slice of the bins, without expanding
+        them to bases. Bases without a value are nan.
+
+        >>> import os, tempfile
+        >>> fileName = tempfile.NamedTemporaryFile(suffix=".bin", delete=False).name
+        >>> w = BinaryCoverageWriter(fileName, 10, [("chr1", 45)])
+        >>> w.addValues("chr1", 10, np.array([1, 2]))
+        >>> w.close()
+        >>> starts, lengths, values = BinaryCoverage(fileName).runs("chr1", 5, 35, edges=[15])
+        >>> starts.tolist(), lengths.tolist(), values.tolist()
+        ([5, 10, 15, 20, 30], [5, 5, 5, 10, 5], [nan, 1.0, 1.0, 2.0, nan])
+        >>> os.remove(fileName)
+        """
+        if chrom not in self.chromInfo or not 0 <= start < end <= self.chromInfo[chrom]["length"]:
+            raise RuntimeError("Invalid interval bounds!")
+        binStart, bins = self.bins(chrom)
+        bounds = [np.array([start, end]), np.asarray(edges if edges is not None else [], dtype=np.int64)]
+        if bins is not None:
+            # the bins overlapping start to end
+            first = max(0, (start - binStart) // self.binSize)
+            last = min(len(bins), max(0, (end - binStart - 1) // self.binSize + 1))
+            bounds.append(binStart + np.arange(first, last + 1, dtype=np.int64) * self.binSize)
+        bounds = np.unique(np.concatenate(bounds))
+        bounds = bounds[(bounds >= start) & (bounds <= end)]
+        starts = bounds[:-1]
+        values = np.full(len(starts), np.nan)
+        if bins is not None:
+            binIndices = (starts - binStart) // self.binSize
+            hasBin = (binIndices >= 0) & (binIndices < len(bins))
+            values[hasBin] = bins[binIndices[hasBin]]
+        return starts, np.diff(bounds), values
+
+    def values(self, chrom, start, end, numpy=True):
+        """
+        Returns the value of each base from start to end, like the values
+        method of pyBigWig. Bases without a value are nan.
+        """
+        _, lengths, values = self.runs(chrom, start, end)
+        return np.repeat(values, lengths)
+
+    def stats(self, chrom, start=None, end=None, type="mean", nBins=1, exact=True):
+        """
+        Returns the mean, max, min, std, sum or coverage of the values of
+        the bases in nBins bins from start to end, like the stats method
+        of pyBigWig. Bins without values are None. The statistics are
+        computed from the runs of equal values in each bin.
+        """
+        if start is None:
+            start = 0
+        if end is None:
+            end = self.chroms(chrom)
+        if type not in ["mean", "max", "min", "std", "sum", "coverage"]:
+            raise RuntimeError("Invalid type!")
+        edges = start + np.linspace(0, end - start, nBins + 1).astype(int)
+        runStarts, lengths, values = self.runs(chrom, start, end, edges=edges[1:-1])
+        # the bin of each run and the bases with a value in each bin
+        runBins = np.searchsorted(edges, runStarts, side="right") - 1
+        hasValue = ~np.isnan(values)
+        runBins, lengths, values = runBins[hasValue], lengths[hasValue], values[hasValue]
+        nBases = np.bincount(runBins, weights=lengths, minlength=nBins)
+        if type == "coverage":
+            res = nBases / np.maximum(np.diff(edges), 1)
+        elif type in ["max", "min"]:
+            res = np.full(nBins, -np.inf if type == "max" else np.inf)
+            (np.maximum if type == "max" else np.minimum).at(res, runBins, values)
+        else:
+            res = np.bincount(runBins, weights=lengths * values, minlength=nBins)
+            if type != "sum":
+                mean = res / np.maximum(nBases, 1)
+                res = mean
+                if type == "std":
+                    deviations = values - mean[runBins]
+                    res = np.sqrt(np.bincount(runBins, weights=lengths * deviations ** 2,
+                                              minlength=nBins) / np.maximum(nBases, 1))
+        return [float(x) if n > 0 else None for x, n in zip(res, nBases)]
+
+    def close(self):
+        self.arrays = {}
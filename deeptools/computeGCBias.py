@@ -637,8 +637,11 @@ def plotGCbias(file_name, frequencies, reads_per_gc, region_size, image_format=N
     plt.close()
 
 
+@mapReduce.restoresSettings
 def main(args=None):
     args = parse_arguments().parse_args(args)
+    mapReduce.setExecutor(args.executor)
+    mapReduce.setCheckpointDir(args.checkpointDir, [args.GCbiasFrequenciesFile, args.biasPlot])
 
     if args.extraSampling:
         extra_sampling_file = args.extraSampling.name
@@ -701,6 +704,9 @@ def main(args=None):
     for key in global_vars:
         print("{}: {}".format(key, global_vars[key]))
 
+    # the workers read global_vars, so they have to be forked after it is set
+    mapReduce.closePool()
+
     print("computing frequencies")
     # the GC of the genome is sampled each stepSize bp.
     stepSize = max(int(global_vars['genome_size'] / args.sampleSize), 1)
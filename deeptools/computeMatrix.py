@@ -5,6 +5,7 @@ import argparse
 import sys
 from deeptools.parserCommon import writableFile, numberOfProcessors
 from deeptools import parserCommon
+from deeptools import mapReduce
 from deeptools import heatmapper
 import deeptools.computeMatrixOperations as cmo
 from importlib.metadata import version
@@ -342,6 +343,8 @@ def computeMatrixOptArgs(case=['scale-regions', 'reference-point'][0]):
                           type=numberOfProcessors,
                           default=1,
                           required=False)
+
+    parserCommon.executorOptions(optional, checkpointDir=True)
     return parser
 
 
@@ -376,9 +379,12 @@ def process_args(args=None):
     return args
 
 
+@mapReduce.restoresSettings
 def main(args=None):
 
     args = process_args(args)
+    mapReduce.setExecutor(args.executor)
+    mapReduce.setCheckpointDir(args.checkpointDir, [args.outFileName, args.outFileNameMatrix, args.outFileSortedRegions])
 
     parameters = {'upstream': args.beforeRegionStartLength,
                   'downstream': args.afterRegionStartLength,
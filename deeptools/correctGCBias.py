@@ -549,8 +549,11 @@ def run_shell_command(command):
         exit(1)
 
 
+@mapReduce.restoresSettings
 def main(args=None):
     args = process_args(args)
+    mapReduce.setExecutor(args.executor)
+    mapReduce.setCheckpointDir(args.checkpointDir, [args.correctedFile])
     global F_gc, N_gc, R_gc
 
     data = np.loadtxt(args.GCbiasFrequenciesFile.name)
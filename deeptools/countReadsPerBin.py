@@ -1,15 +1,19 @@
+import bisect
+import itertools
 import shutil
 import os
 import time
 import sys
 import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
+import pysam
 
 # deepTools packages
 import deeptools.utilities
 from deeptools import bamHandler
 from deeptools import mapReduce
-from deeptoolsintervals import GTF
+from deeptools.readFilter import ReadFilter
 import pyBigWig
 
 debug = 0
@@ -28,6 +32,32 @@ def countReadsInRegions_wrapper(args):
     return CountReadsPerBin.count_reads_in_region(*args)
 
 
+def countReadsInRegionsShared_wrapper(args):
+    """
+    Like countReadsInRegions_wrapper, but the counts are written into the
+    rows of a matrix held in shared memory instead of being sent back to
+    the parent process. The args var contains the countReadsInRegions_wrapper
+    arguments, the name and shape of the shared memory matrix and the
+    first and last (exclusive) rows to write.
+
+    Returns the number of rows written and the name of the temporary file
+    holding the raw counts, if any.
+    """
+    task, shmName, shape, rowStart, rowEnd = args
+    _values, tempFileName = CountReadsPerBin.count_reads_in_region(*task)
+    if _values.shape[0] != rowEnd - rowStart:
+        raise ValueError("Expected {} rows for {}:{}-{} but {} were "
+                         "computed".format(rowEnd - rowStart, task[1], task[2], task[3], _values.shape[0]))
+    shm = shared_memory.SharedMemory(name=shmName)
+    try:
+        matrix = np.ndarray(shape, dtype='float64', buffer=shm.buf)
+        matrix[rowStart:rowEnd, :] = _values
+        del matrix
+    finally:
+        shm.close()
+    return _values.shape[0], tempFileName
+
+
 class CountReadsPerBin(object):
 
     r"""Collects coverage over multiple bam files using multiprocessing
@@ -186,8 +216,10 @@ class CountReadsPerBin(object):
         self.binLength = binLength
         self.numberOfSamples = numberOfSamples
         self.blackListFileName = blackListFileName
-        self.statsList = statsList
-        self.mappedList = mappedList
+        # copies, since the mapped reads of the files are appended below
+        # and the default lists are shared by all the objects
+        self.statsList = list(statsList)
+        self.mappedList = list(mappedList)
         self.skipZeroOverZero = skipZeroOverZero
         self.bed_and_bin = bed_and_bin
         self.genomeChunkSize = genomeChunkSize
@@ -237,6 +269,8 @@ class CountReadsPerBin(object):
         self.maxFragmentLength = maxFragmentLength
         self.zerosToNans = zerosToNans
         self.smoothLength = smoothLength
+        # a ReadTally counting the reads while computing the coverage
+        self.readTally = None
 
         if out_file_for_raw_data:
             self.save_data = True
@@ -333,6 +367,12 @@ class CountReadsPerBin(object):
 
         genomeSize = sum(chrLengths)
 
+        # the cost of the chunks of bam files, so that the workers start
+        # with the most expensive ones
+        chunkCost = None
+        if self.numberOfProcessors > 1 and all(isinstance(x, pysam.AlignmentFile) for x in bamFilesHandles):
+            chunkCost = bamHandler.getChunkCost(self.bamFilesList)
+
         chunkSize = None
         if self.bedFile is None:
             if self.genomeChunkSize is None:
@@ -352,20 +392,46 @@ class CountReadsPerBin(object):
         # Handle GTF options
         transcriptID, exonID, transcript_id_designator, keepExons = deeptools.utilities.gtfOptions(allArgs)
 
-        # use map reduce to call countReadsInRegions_wrapper
-        imap_res = mapReduce.mapReduce([],
-                                       countReadsInRegions_wrapper,
-                                       chromsizes,
-                                       self_=self,
-                                       genomeChunkLength=chunkSize,
-                                       bedFile=self.bedFile,
-                                       blackListFileName=self.blackListFileName,
-                                       region=self.region,
+        tasks, _ = mapReduce.getTasks([],
+                                      chromsizes,
+                                      self_=self,
+                                      genomeChunkLength=chunkSize,
+                                      bedFile=self.bedFile,
+                                      blackListFileName=self.blackListFileName,
+                                      region=self.region,
+                                      transcriptID=transcriptID,
+                                      exonID=exonID,
+                                      keepExons=keepExons,
+                                      transcript_id_designator=transcript_id_designator)
+
+        # When using several processors, the final matrix is preallocated
+        # in shared memory and each worker writes its rows in place, which
+        # avoids sending the counts back to this process and concatenating
+        # them.
+        shm = None
+        if self.numberOfProcessors > 1 and len(tasks) > 1 and mapReduce.sharesMemory():
+            blackList = None
+            if self.blackListFileName is not None:
+                blackList = mapReduce.getBlackList(self.blackListFileName)
+            rowOffsets = np.cumsum([0] + [self.get_num_rows(*task[1:], blackList=blackList) for task in tasks])
+            shape = (int(rowOffsets[-1]), len(self.bamFilesList))
+            shm = shared_memory.SharedMemory(create=True, size=max(1, shape[0] * shape[1] * 8))
+            tasks = [(task, shm.name, shape, int(rowOffsets[i]), int(rowOffsets[i + 1])) for i, task in enumerate(tasks)]
+            func = countReadsInRegionsShared_wrapper
+        else:
+            func = countReadsInRegions_wrapper
+
+        def taskCost(task):
+            # the chrom, start and end follow self in the tasks of getTasks
+            if shm is not None:
+                task = task[0]
+            return chunkCost(task[1], task[2], task[3])
+
+        # the per-chunk results are consumed in genome order as they finish.
+        imap_res = mapReduce.imapTasks(func, tasks,
                                        numberOfProcessors=self.numberOfProcessors,
-                                       transcriptID=transcriptID,
-                                       exonID=exonID,
-                                       keepExons=keepExons,
-                                       transcript_id_designator=transcript_id_designator)
+                                       verbose=self.verbose,
+                                       taskCost=None if chunkCost is None else taskCost)
 
         if self.out_file_for_raw_data:
             if len(non_common):
@@ -374,18 +440,34 @@ class CountReadsPerBin(object):
 
             # concatenate intermediary bedgraph files
             ofile = open(self.out_file_for_raw_data, "w")
+
+        chunk_values = []
+        try:
             for _values, tempFileName in imap_res:
-                if tempFileName:
+                if shm is None:
+                    chunk_values.append(_values)
+                if self.out_file_for_raw_data and tempFileName:
                     # concatenate all intermediate tempfiles into one
                     _foo = open(tempFileName, 'r')
                     shutil.copyfileobj(_foo, ofile)
                     _foo.close()
                     os.remove(tempFileName)
 
+            if shm is not None:
+                num_reads_per_bin = np.ndarray(shape, dtype='float64', buffer=shm.buf).copy()
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+        if self.out_file_for_raw_data:
             ofile.close()
 
+        if shm is not None:
+            return num_reads_per_bin
+
         try:
-            num_reads_per_bin = np.concatenate([x[0] for x in imap_res], axis=0)
+            num_reads_per_bin = np.concatenate(chunk_values, axis=0)
             return num_reads_per_bin
 
         except ValueError:
@@ -397,7 +479,7 @@ class CountReadsPerBin(object):
                 sys.exit('\nNo coverage values could be computed.\n\nCheck that all bam files are valid and '
                          'contain mapped reads.')
 
-    def count_reads_in_region(self, chrom, start, end, bed_regions_list=None):
+    def count_reads_in_region(self, chrom, start, end, bed_regions_list=None, bamHandles=None):
         """Counts the reads in each bam file at each 'stepSize' position
         within the interval (start, end) for a window or bin of size binLength.
 
@@ -422,6 +504,9 @@ class CountReadsPerBin(object):
             corresponding to bed regions to be processed.
             If not bed file was passed to the object constructor
             then this list is empty.
+        bamHandles: list
+            If given, the reads are taken from these objects (e.g.
+            ReadCache objects) instead of the bam files of bamFilesList.
 
         Returns
         -------
@@ -459,36 +544,24 @@ class CountReadsPerBin(object):
 
         start_time = time.time()
 
-        bam_handles = []
-        for fname in self.bamFilesList:
-            try:
-                bam_handles.append(bamHandler.openBam(fname))
-            except SystemExit:
-                sys.exit(sys.exc_info()[1])
-            except:
-                bam_handles.append(pyBigWig.open(fname))
+        # the files stay open in this process for the next chunks
+        if bamHandles is not None:
+            bam_handles = bamHandles
+        else:
+            bam_handles = []
+            for fname in self.bamFilesList:
+                try:
+                    bam_handles.append(mapReduce.getFileHandle(bamHandler.openBam, fname))
+                except SystemExit:
+                    sys.exit(sys.exc_info()[1])
+                except:
+                    bam_handles.append(mapReduce.getFileHandle(pyBigWig.open, fname))
 
         blackList = None
         if self.blackListFileName is not None:
-            blackList = GTF(self.blackListFileName)
+            blackList = mapReduce.getBlackList(self.blackListFileName)
 
-        # A list of lists of tuples
-        transcriptsToConsider = []
-        if bed_regions_list is not None:
-            if self.bed_and_bin:
-                transcriptsToConsider.append([(x[1][0][0], x[1][0][1], self.binLength) for x in bed_regions_list])
-            else:
-                transcriptsToConsider = [x[1] for x in bed_regions_list]
-        else:
-            if self.stepSize == self.binLength:
-                transcriptsToConsider.append([(start, end, self.binLength)])
-            else:
-                for i in range(start, end, self.stepSize):
-                    if i + self.binLength > end:
-                        break
-                    if blackList is not None and blackList.findOverlaps(chrom, i, i + self.binLength):
-                        continue
-                    transcriptsToConsider.append([(i, i + self.binLength)])
+        transcriptsToConsider = self.get_regions_to_count(chrom, start, end, bed_regions_list, blackList)
 
         if self.save_data:
             _file = open(deeptools.utilities.getTempFileName(suffix='.bed'), 'w+t')
@@ -496,13 +569,16 @@ class CountReadsPerBin(object):
         else:
             _file_name = ''
 
-        for bam in bam_handles:
-            for trans in transcriptsToConsider:
-                tcov = self.get_coverage_of_region(bam, chrom, trans)
+        readTally = self.readTally
+        for i, bam in enumerate(bam_handles):
+            if isinstance(readTally, list):
+                self.readTally = readTally[i]
+            for tcov in self.get_coverage_of_regions(bam, chrom, transcriptsToConsider):
                 if bed_regions_list is not None and not self.bed_and_bin:
                     subnum_reads_per_bin.append(np.sum(tcov))
                 else:
                     subnum_reads_per_bin.extend(tcov)
+        self.readTally = readTally
 
         subnum_reads_per_bin = np.concatenate([subnum_reads_per_bin]).reshape(-1, len(self.bamFilesList), order='F')
 
@@ -536,6 +612,77 @@ class CountReadsPerBin(object):
 
         return subnum_reads_per_bin, _file_name
 
+    def get_regions_to_count(self, chrom, start, end, bed_regions_list=None, blackList=None):
+        """
+        Returns the list of regions counted by count_reads_in_region for
+        the interval (start, end). Each element is a list of (start, end)
+        or (start, end, tileSize) tuples that is passed to
+        get_coverage_of_region.
+
+        >>> c = CountReadsPerBin([], 10, 0, stepSize=30)
+        >>> c.get_regions_to_count('chr1', 0, 100)
+        [[(0, 10)], [(30, 40)], [(60, 70)], [(90, 100)]]
+        >>> c.stepSize = 10
+        >>> c.get_regions_to_count('chr1', 0, 100)
+        [[(0, 100, 10)]]
+        """
+        # A list of lists of tuples
+        transcriptsToConsider = []
+        if bed_regions_list is not None:
+            if self.bed_and_bin:
+                transcriptsToConsider.append([(x[1][0][0], x[1][0][1], self.binLength) for x in bed_regions_list])
+            else:
+                transcriptsToConsider = [x[1] for x in bed_regions_list]
+        else:
+            if self.stepSize == self.binLength:
+                transcriptsToConsider.append([(start, end, self.binLength)])
+            else:
+                for i in range(start, end, self.stepSize):
+                    if i + self.binLength > end:
+                        break
+                    if blackList is not None and blackList.findOverlaps(chrom, i, i + self.binLength):
+                        continue
+                    transcriptsToConsider.append([(i, i + self.binLength)])
+
+        return transcriptsToConsider
+
+    def get_num_rows(self, chrom, start, end, bed_regions_list=None, blackList=None):
+        """
+        Returns the number of rows of the array computed by
+        count_reads_in_region for the same arguments, without counting
+        any reads.
+
+        >>> test = Tester()
+        >>> c = CountReadsPerBin([test.bamFile1, test.bamFile2], 25, 0, stepSize=50)
+        >>> c.get_num_rows(test.chrom, 0, 200)
+        4
+        """
+        transcriptsToConsider = self.get_regions_to_count(chrom, start, end, bed_regions_list, blackList)
+        if bed_regions_list is not None and not self.bed_and_bin:
+            return len(transcriptsToConsider)
+        return sum(self.get_num_bins(trans) for trans in transcriptsToConsider)
+
+    def get_num_bins(self, regions):
+        """
+        Returns the length of the coverage array for the given regions
+        (see get_coverage_of_region). Regions of the form (start, end, tileSize)
+        are split into tiles, keeping any smaller tile at their end.
+
+        >>> c = CountReadsPerBin([], 10, 0, stepSize=10)
+        >>> c.get_num_bins([(0, 100, 10), (200, 205, 10)])
+        11
+        >>> c.get_num_bins([(0, 100), (200, 205)])
+        2
+        """
+        nbins = len(regions)
+        if len(regions[0]) == 3:
+            nbins = 0
+            for reg in regions:
+                nbins += (reg[1] - reg[0]) // reg[2]
+                if (reg[1] - reg[0]) % reg[2] > 0:
+                    nbins += 1
+        return nbins
+
     def get_coverage_of_region(self, bamHandle, chrom, regions,
                                fragmentFromRead_func=None):
         """
@@ -574,14 +721,7 @@ class CountReadsPerBin(object):
         """
         if not fragmentFromRead_func:
             fragmentFromRead_func = self.get_fragment_from_read
-        nbins = len(regions)
-        if len(regions[0]) == 3:
-            nbins = 0
-            for reg in regions:
-                nbins += (reg[1] - reg[0]) // reg[2]
-                if (reg[1] - reg[0]) % reg[2] > 0:
-                    nbins += 1
-        coverages = np.zeros(nbins, dtype='float64')
+        coverages = np.zeros(self.get_num_bins(regions), dtype='float64')
 
         if self.defaultFragmentLength == 'read length':
             extension = 0
@@ -590,122 +730,29 @@ class CountReadsPerBin(object):
 
         blackList = None
         if self.blackListFileName is not None:
-            blackList = GTF(self.blackListFileName)
+            blackList = mapReduce.getBlackList(self.blackListFileName)
 
         vector_start = 0
         for idx, reg in enumerate(regions):
-            if len(reg) == 3:
-                tileSize = int(reg[2])
-                nRegBins = (reg[1] - reg[0]) // tileSize
-                if (reg[1] - reg[0]) % tileSize > 0:
-                    # Don't eliminate small bins! Issue 887
-                    nRegBins += 1
-            else:
-                nRegBins = 1
-                tileSize = int(reg[1] - reg[0])
+            tileSize, nRegBins = self.get_tiles_of_region(reg)
 
             # Blacklisted regions have a coverage of 0
-            if blackList and blackList.findOverlaps(chrom, reg[0], reg[1]):
+            bounds = self.get_fetch_bounds(chrom, reg, extension, blackList)
+            if bounds is None:
                 continue
-            regStart = int(max(0, reg[0] - extension))
-            regEnd = reg[1] + int(extension)
-
-            # If alignments are extended and there's a blacklist, ensure that no
-            # reads originating in a blacklist are fetched
-            if blackList and reg[0] > 0 and extension > 0:
-                o = blackList.findOverlaps(chrom, regStart, reg[0])
-                if o is not None and len(o) > 0:
-                    regStart = o[-1][1]
-                o = blackList.findOverlaps(chrom, reg[1], regEnd)
-                if o is not None and len(o) > 0:
-                    regEnd = o[0][0]
+            regStart, regEnd = bounds
 
             start_time = time.time()
-            # caching seems faster. TODO: profile the function
-            c = 0
             if chrom not in bamHandle.references:
                 raise NameError("chromosome {} not found in bam file".format(chrom))
 
-            prev_pos = set()
-            lpos = None
-            # of previous processed read pair
-            for read in bamHandle.fetch(chrom, regStart, regEnd):
-                if read.is_unmapped:
-                    continue
-                if self.minMappingQuality and read.mapq < self.minMappingQuality:
-                    continue
+            fragmentStarts, fragmentEnds, readIndices, readSpans = \
+                self.get_fragments_of_reads(bamHandle, chrom, regStart, regEnd, fragmentFromRead_func)
+            c = len(readSpans)
 
-                # filter reads based on SAM flag
-                if self.samFlag_include and read.flag & self.samFlag_include != self.samFlag_include:
-                    continue
-                if self.samFlag_exclude and read.flag & self.samFlag_exclude != 0:
-                    continue
-
-                # Fragment lengths
-                tLen = deeptools.utilities.getTLen(read)
-                if self.minFragmentLength > 0 and tLen < self.minFragmentLength:
-                    continue
-                if self.maxFragmentLength > 0 and tLen > self.maxFragmentLength:
-                    continue
-
-                # get rid of duplicate reads that have same position on each of the
-                # pairs
-                if self.ignoreDuplicates:
-                    # Assuming more or less concordant reads, use the fragment bounds, otherwise the start positions
-                    if tLen >= 0:
-                        s = read.pos
-                        e = s + tLen
-                    else:
-                        s = read.pnext
-                        e = s - tLen
-                    if read.reference_id != read.next_reference_id:
-                        e = read.pnext
-                    if lpos is not None and lpos == read.reference_start \
-                            and (s, e, read.next_reference_id, read.is_reverse) in prev_pos:
-                        continue
-                    if lpos != read.reference_start:
-                        prev_pos.clear()
-                    lpos = read.reference_start
-                    prev_pos.add((s, e, read.next_reference_id, read.is_reverse))
-
-                # since reads can be split (e.g. RNA-seq reads) each part of the
-                # read that maps is called a position block.
-                try:
-                    position_blocks = fragmentFromRead_func(read)
-                except TypeError:
-                    # the get_fragment_from_read functions returns None in some cases.
-                    # Those cases are to be skipped, hence the continue line.
-                    continue
-
-                last_eIdx = None
-                for fragmentStart, fragmentEnd in position_blocks:
-                    if fragmentEnd is None or fragmentStart is None:
-                        continue
-                    fragmentLength = fragmentEnd - fragmentStart
-                    if fragmentLength == 0:
-                        continue
-                    # skip reads that are not in the region being
-                    # evaluated.
-                    if fragmentEnd <= reg[0] or fragmentStart >= reg[1]:
-                        continue
-
-                    if fragmentStart < reg[0]:
-                        fragmentStart = reg[0]
-                    if fragmentEnd > reg[0] + len(coverages) * tileSize:
-                        fragmentEnd = reg[0] + len(coverages) * tileSize
-
-                    sIdx = vector_start + max((fragmentStart - reg[0]) // tileSize, 0)
-                    eIdx = vector_start + min(np.ceil(float(fragmentEnd - reg[0]) / tileSize).astype('int'), nRegBins)
-                    if last_eIdx is not None:
-                        sIdx = max(last_eIdx, sIdx)
-                        if sIdx >= eIdx:
-                            continue
-                    sIdx = int(sIdx)
-                    eIdx = int(eIdx)
-                    coverages[sIdx:eIdx] += 1
-                    last_eIdx = eIdx
-
-                c += 1
+            if len(fragmentStarts):
+                add_fragment_coverage(coverages, fragmentStarts, fragmentEnds, readIndices,
+                                      reg[0], reg[1], tileSize, vector_start, nRegBins)
 
             if self.verbose:
                 endTime = time.time()
@@ -720,6 +767,240 @@ class CountReadsPerBin(object):
 
         return coverages
 
+    def get_coverage_of_regions(self, bamHandle, chrom, transcripts,
+                                fragmentFromRead_func=None):
+        """
+        Returns a list with the coverage of each element of transcripts,
+        as computed by get_coverage_of_region. Instead of fetching the reads
+        again for every region, the regions whose fetch windows overlap or
+        are less than binLength apart are fetched together, and each region
+        takes those reads that get_coverage_of_region would have fetched,
+        which are found by a sweep over the reads sorted by their start.
+        Regions far apart, like the bins sampled with a stepSize much larger
+        than the binLength, are still fetched on their own.
+
+        When ignoreDuplicates is set, which reads are duplicates depends on
+        the reads fetched before them, so each region is fetched on its own.
+
+        >>> test = Tester()
+        >>> import pysam
+        >>> c = CountReadsPerBin([], stepSize=1, extendReads=300)
+        >>> c.get_coverage_of_regions(pysam.AlignmentFile(test.bamFile_PE), 'chr2',
+        ... [[(5000833, 5000834)], [(5000834, 5000835)], [(5000833, 5000834), (5000834, 5000835)]])
+        [array([4.]), array([5.]), array([4., 5.])]
+        """
+        if self.ignoreDuplicates or sum(len(trans) for trans in transcripts) < 2:
+            return [self.get_coverage_of_region(bamHandle, chrom, trans, fragmentFromRead_func)
+                    for trans in transcripts]
+
+        if not fragmentFromRead_func:
+            fragmentFromRead_func = self.get_fragment_from_read
+
+        if self.defaultFragmentLength == 'read length':
+            extension = 0
+        else:
+            extension = self.maxPairedFragmentLength
+
+        blackList = None
+        if self.blackListFileName is not None:
+            blackList = mapReduce.getBlackList(self.blackListFileName)
+
+        bounds = [[self.get_fetch_bounds(chrom, reg, extension, blackList) for reg in trans]
+                  for trans in transcripts]
+        windows = sorted(x for trans_bounds in bounds for x in trans_bounds if x is not None)
+
+        # the windows closer than binLength are merged into a single fetch
+        groups = []
+        for regStart, regEnd in windows:
+            if len(groups) and regStart - groups[-1][1] < (self.binLength or 0):
+                groups[-1][1] = max(groups[-1][1], regEnd)
+            else:
+                groups.append([regStart, regEnd])
+        groupStarts = [x[0] for x in groups]
+
+        start_time = time.time()
+        if len(groups) and chrom not in bamHandle.references:
+            raise NameError("chromosome {} not found in bam file".format(chrom))
+        # the fetches are done in order, as the read tally expects
+        fetched = []
+        nReads = 0
+        for groupStart, groupEnd in groups:
+            fragmentStarts, fragmentEnds, readIndices, readSpans = \
+                self.get_fragments_of_reads(bamHandle, chrom, groupStart, groupEnd, fragmentFromRead_func)
+            readIndices = np.asarray(readIndices, dtype='int64')
+            readSpans = np.asarray(readSpans, dtype='int64').reshape(-1, 2)
+            readStarts, readEnds = readSpans[:, 0], readSpans[:, 1]
+            # the blocks of the i-th read are blockOffsets[i]:blockOffsets[i + 1]
+            blockOffsets = np.searchsorted(readIndices, np.arange(len(readSpans) + 1))
+            maxReadSpan = np.max(readEnds - readStarts) if len(readSpans) else 0
+            fetched.append((np.asarray(fragmentStarts, dtype='int64'), np.asarray(fragmentEnds, dtype='int64'),
+                            readIndices, readStarts, readEnds, blockOffsets, maxReadSpan))
+            nReads += len(readSpans)
+
+        coverages_list = []
+        for trans, trans_bounds in zip(transcripts, bounds):
+            coverages = np.zeros(self.get_num_bins(trans), dtype='float64')
+            vector_start = 0
+            for reg, reg_bounds in zip(trans, trans_bounds):
+                tileSize, nRegBins = self.get_tiles_of_region(reg)
+
+                # Blacklisted regions have a coverage of 0
+                if reg_bounds is None:
+                    continue
+                regStart, regEnd = reg_bounds
+                fragmentStarts, fragmentEnds, readIndices, readStarts, readEnds, blockOffsets, maxReadSpan = \
+                    fetched[bisect.bisect_right(groupStarts, regStart) - 1]
+
+                # The reads overlapping (regStart, regEnd), which are the ones
+                # a fetch of that interval returns, start before regEnd and
+                # no earlier than maxReadSpan before regStart.
+                lo = np.searchsorted(readStarts, regStart - maxReadSpan)
+                hi = np.searchsorted(readStarts, regEnd)
+                blocks = np.arange(blockOffsets[lo], blockOffsets[hi])
+                blocks = blocks[readEnds[readIndices[blocks]] > regStart]
+                if len(blocks):
+                    add_fragment_coverage(coverages, fragmentStarts[blocks], fragmentEnds[blocks],
+                                          readIndices[blocks], reg[0], reg[1], tileSize,
+                                          vector_start, nRegBins)
+
+                vector_start += nRegBins
+
+            # change zeros to NAN
+            if self.zerosToNans:
+                coverages[coverages == 0] = np.nan
+            coverages_list.append(coverages)
+
+        if self.verbose:
+            endTime = time.time()
+            print("%s,  processing %s (%.1f per sec) reads for %s regions in %s fetches @ %s" % (
+                multiprocessing.current_process().name, nReads, nReads / (endTime - start_time),
+                len(windows), len(groups), chrom))
+
+        return coverages_list
+
+    def get_tiles_of_region(self, reg):
+        """
+        Returns the tile size and the number of tiles of a region of the
+        form (start, end, tileSize), keeping any smaller tile at its end,
+        or of a region of the form (start, end), which is a single tile.
+
+        >>> c = CountReadsPerBin([], 10, 0, stepSize=10)
+        >>> c.get_tiles_of_region((0, 105, 10))
+        (10, 11)
+        >>> c.get_tiles_of_region((0, 105))
+        (105, 1)
+        """
+        if len(reg) == 3:
+            tileSize = int(reg[2])
+            nRegBins = (reg[1] - reg[0]) // tileSize
+            if (reg[1] - reg[0]) % tileSize > 0:
+                # Don't eliminate small bins! Issue 887
+                nRegBins += 1
+        else:
+            nRegBins = 1
+            tileSize = int(reg[1] - reg[0])
+        return tileSize, nRegBins
+
+    def get_fetch_bounds(self, chrom, reg, extension, blackList=None):
+        """
+        Returns the interval (regStart, regEnd) from which the reads
+        contributing to the coverage of the region reg are fetched, or None
+        if the region overlaps the blacklist.
+
+        >>> c = CountReadsPerBin([], 10, 0, stepSize=10)
+        >>> c.get_fetch_bounds('chr1', (100, 200), 50)
+        (50, 250)
+        >>> c.get_fetch_bounds('chr1', (20, 200), 50)
+        (0, 250)
+        """
+        if blackList and blackList.findOverlaps(chrom, reg[0], reg[1]):
+            return None
+        regStart = int(max(0, reg[0] - extension))
+        regEnd = reg[1] + int(extension)
+
+        # If alignments are extended and there's a blacklist, ensure that no
+        # reads originating in a blacklist are fetched
+        if blackList and reg[0] > 0 and extension > 0:
+            o = blackList.findOverlaps(chrom, regStart, reg[0])
+            if o is not None and len(o) > 0:
+                regStart = o[-1][1]
+            o = blackList.findOverlaps(chrom, reg[1], regEnd)
+            if o is not None and len(o) > 0:
+                regEnd = o[0][0]
+
+        return regStart, regEnd
+
+    def get_fragments_of_reads(self, bamHandle, chrom, regStart, regEnd, fragmentFromRead_func):
+        """
+        Fetches the reads in (regStart, regEnd) that pass the filters and
+        returns the blocks of their fragments, as lists of starts, ends and
+        the index of the read each block comes from, together with the
+        (start, end) of the alignment of each read.
+        """
+        fragmentStarts = []
+        fragmentEnds = []
+        readIndices = []
+        readSpans = []
+
+        c = 0
+        tally = self.readTally
+        readFilter = self.get_read_filter()
+        for read in bamHandle.fetch(chrom, regStart, regEnd):
+            tallied = tally is not None and tally.start <= read.reference_start < tally.end
+            if tallied:
+                tally.total += 1
+                if read.is_unmapped:
+                    tally.unmapped += 1
+            if not readFilter.keep(read):
+                continue
+
+            # the reads of the other strand are not filtered, but the
+            # filterStrand method of bamCoverage.OffsetFragment gives them
+            # no blocks
+            if tallied and (not hasattr(self, 'filterStrand') or self.filterStrand(read, True) is True):
+                tally.kept += 1
+
+            # since reads can be split (e.g. RNA-seq reads) each part of the
+            # read that maps is called a position block.
+            try:
+                position_blocks = fragmentFromRead_func(read)
+            except TypeError:
+                # the get_fragment_from_read functions returns None in some cases.
+                # Those cases are to be skipped, hence the continue line.
+                continue
+
+            # the blocks of all reads are collected and added to
+            # the coverage at once
+            for fragmentStart, fragmentEnd in position_blocks:
+                if fragmentEnd is None or fragmentStart is None:
+                    continue
+                fragmentStarts.append(fragmentStart)
+                fragmentEnds.append(fragmentEnd)
+                readIndices.append(c)
+
+            # the interval a fetch uses to decide if the read overlaps it
+            readEnd = read.reference_end
+            if readEnd is None:
+                readEnd = read.reference_start + 1
+            readSpans.append((read.reference_start, readEnd))
+            c += 1
+
+        if tally is not None:
+            tally.start = max(tally.start, regEnd)
+
+        return fragmentStarts, fragmentEnds, readIndices, readSpans
+
+    def get_read_filter(self):
+        """
+        Returns the readFilter.ReadFilter of the current filter attributes.
+        """
+        return ReadFilter(minMappingQuality=self.minMappingQuality,
+                          samFlagInclude=self.samFlag_include,
+                          samFlagExclude=self.samFlag_exclude,
+                          minFragmentLength=self.minFragmentLength,
+                          maxFragmentLength=self.maxFragmentLength,
+                          ignoreDuplicates=self.ignoreDuplicates)
+
     def getReadLength(self, read):
         return len(read)
 
@@ -960,6 +1241,182 @@ class CountReadsPerBin(object):
         indexEnd = min(maxPosition, tileIndex + smoothTilesRight)
         return (indexStart, indexEnd)
 
+    def getSmoothCoverage(self, coverage, tileSize, smoothRange):
+        """
+        Returns the (tiles x samples) coverage array with each tile replaced
+        by the mean over its smoothRange, as given by getSmoothRange, using
+        cumulative sums instead of a mean per tile. A range containing a nan
+        is nan.
+
+        Examples
+        --------
+
+        >>> c = CountReadsPerBin([], 1, 1, 1, 0)
+        >>> c.getSmoothCoverage(np.array([[0.], [3.], [6.], [np.nan]]), 1, 3).tolist()
+        [[1.5], [3.0], [nan], [nan]]
+        """
+        nTiles = coverage.shape[0]
+        isNan = np.isnan(coverage)
+        finite = coverage[~isNan]
+        if not np.all(finite == np.floor(finite)):
+            # the cumulative sums are only exact for counts, which
+            # are all that is smoothed, but fractions would differ in
+            # the last digits from the mean per tile
+            return np.array([np.mean(coverage[slice(*self.getSmoothRange(x, tileSize, smoothRange, nTiles))], axis=0)
+                             for x in range(nTiles)]).reshape(coverage.shape)
+
+        smoothTiles = int(smoothRange / tileSize)
+        if smoothTiles == 1:
+            return coverage
+        smoothTilesSide = float(smoothTiles - 1) / 2
+        tileIndices = np.arange(nTiles)
+        indexStart = np.maximum(tileIndices - int(np.ceil(smoothTilesSide)), 0)
+        indexEnd = np.minimum(nTiles, tileIndices + int(np.floor(smoothTilesSide)) + 1)
+
+        sums = np.zeros((nTiles + 1,) + coverage.shape[1:])
+        np.cumsum(np.where(isNan, 0, coverage), axis=0, out=sums[1:])
+        nans = np.zeros((nTiles + 1,) + coverage.shape[1:], dtype='int64')
+        np.cumsum(isNan, axis=0, out=nans[1:])
+
+        smoothed = (sums[indexEnd] - sums[indexStart]) / (indexEnd - indexStart)[:, np.newaxis]
+        smoothed[nans[indexEnd] - nans[indexStart] > 0] = np.nan
+        return smoothed
+
+
+class ReadCache(object):
+    """
+    Holds the reads of a bam file that overlap the interval (start, end)
+    of chrom, so that the coverage of several CountReadsPerBin objects can
+    be computed from them without fetching and decoding them again. For any
+    interval within (start, end), the fetch method returns the same reads,
+    in the same order, as the fetch method of the bam file, so the object
+    can be passed to count_reads_in_region with bamHandles.
+
+    If maxReads is given and the interval has more reads, only the first
+    maxReads + 1 are kept and isComplete is False.
+
+    >>> test = Tester()
+    >>> import pysam
+    >>> bam = pysam.AlignmentFile(test.bamFile2)
+    >>> cache = ReadCache(bam, test.chrom, 0, 200)
+    >>> [x.query_name for x in cache.fetch(test.chrom, 100, 150)] == [x.query_name for x in bam.fetch(test.chrom, 100, 150)]
+    True
+    >>> c = CountReadsPerBin([test.bamFile2], 50, 0, stepSize=50)
+    >>> np.array_equal(c.count_reads_in_region(test.chrom, 0, 200, bamHandles=[cache])[0],
+    ...                c.count_reads_in_region(test.chrom, 0, 200)[0])
+    True
+    """
+    def __init__(self, bamHandle, chrom, start, end, maxReads=None):
+        self.references = bamHandle.references
+        self.chrom = chrom
+        self.start = start
+        self.end = end
+        self.reads = []
+        if chrom in self.references:
+            reads = bamHandle.fetch(chrom, start, end)
+            if maxReads is not None:
+                reads = itertools.islice(reads, maxReads + 1)
+            self.reads = list(reads)
+        self.isComplete = maxReads is None or len(self.reads) <= maxReads
+        # the reads are sorted by their start, the end of those without
+        # aligned bases is taken to be one base after it, as for fetch
+        self.readStarts = [read.reference_start for read in self.reads]
+        self.readEnds = [max(read.reference_end or 0, read.reference_start + 1) for read in self.reads]
+        self.maxSpan = max([e - s for s, e in zip(self.readStarts, self.readEnds)] or [0])
+
+    def fetch(self, chrom, start, end):
+        if chrom != self.chrom or start < self.start or end > self.end:
+            raise ValueError("{}:{}-{} is not within the cached interval "
+                             "{}:{}-{}".format(chrom, start, end, self.chrom, self.start, self.end))
+        lo = bisect.bisect_left(self.readStarts, start - self.maxSpan)
+        hi = bisect.bisect_left(self.readStarts, end)
+        return [read for read, readEnd in zip(self.reads[lo:hi], self.readEnds[lo:hi]) if readEnd > start]
+
+
+class ReadTally(object):
+    """
+    Counts the reads starting from start to end while their coverage is
+    computed, when set as the readTally of a CountReadsPerBin object with
+    a single bam file: the total number of reads, the unmapped ones and
+    those kept by the filters of the object (the others are filtered). A
+    read fetched more than once is counted the first time, since the reads
+    are fetched in order and start moves to the end of each fetch. With
+    several bam files, count_reads_in_region takes the readTally to be a
+    list with a ReadTally for each of them.
+
+    >>> test = Tester()
+    >>> c = CountReadsPerBin([test.bamFile2], 50, 0, stepSize=50)
+    >>> c.minMappingQuality = 40
+    >>> c.readTally = ReadTally(0, 200)
+    >>> _ = c.count_reads_in_region(test.chrom, 0, 200)
+    >>> _ = c.count_reads_in_region(test.chrom, 100, 200)
+    >>> c.readTally.counts()
+    (4, 0, 1)
+    """
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.total = 0
+        self.unmapped = 0
+        self.kept = 0
+
+    def counts(self):
+        return self.total, self.unmapped, self.kept
+
+
+def add_fragment_coverage(coverages, fragmentStarts, fragmentEnds, readIndices,
+                          regStart, regEnd, tileSize, vectorStart, nRegBins):
+    """
+    Adds the fragments (or blocks of spliced reads) overlapping the region
+    (regStart, regEnd) to the coverage of its tiles, which start at index
+    vectorStart of the coverages array. Each fragment adds 1 to every tile
+    it overlaps. Blocks from the same read, as given by readIndices, are
+    counted at most once per tile, so a spliced read is not counted twice
+    in a tile that contains both sides of the intron.
+
+    The coverage is computed with a difference array over the tiles
+    instead of updating them read by read.
+
+    >>> coverages = np.zeros(5)
+    >>> add_fragment_coverage(coverages, [0, 22, 28, 45], [12, 26, 33, 60],
+    ...                       [0, 1, 1, 2], 0, 50, 10, 0, 5)
+    >>> coverages
+    array([1., 1., 1., 1., 1.])
+    """
+    starts = np.asarray(fragmentStarts, dtype='float64')
+    ends = np.asarray(fragmentEnds, dtype='float64')
+    readIndices = np.asarray(readIndices, dtype='int64')
+
+    # skip empty blocks and those not in the region being evaluated.
+    keep = (ends != starts) & (ends > regStart) & (starts < regEnd)
+    starts = np.maximum(starts[keep], regStart)
+    ends = np.minimum(ends[keep], regStart + len(coverages) * tileSize)
+    readIndices = readIndices[keep]
+    if len(starts) == 0:
+        return
+
+    sIdx = vectorStart + np.maximum((starts - regStart) // tileSize, 0).astype('int64')
+    eIdx = vectorStart + np.minimum(np.ceil((ends - regStart) / tileSize), nRegBins).astype('int64')
+
+    # A block only covers the tiles after the last one covered by a previous
+    # block of the same read, that is, after the largest end index of the
+    # previous blocks of that read (the first block of a read always sets
+    # it). The read indices are sorted, so offsetting each read by a multiple
+    # of the largest index keeps the running maximum from one read to the
+    # next apart.
+    sameRead = readIndices[1:] == readIndices[:-1]
+    setsLast = sIdx < eIdx
+    setsLast[0] = True
+    setsLast[1:] |= ~sameRead
+    offset = readIndices * (len(coverages) + 1)
+    lastEIdx = np.maximum.accumulate(np.where(setsLast, eIdx, 0) + offset) - offset
+    sIdx[1:][sameRead] = np.maximum(sIdx[1:], lastEIdx[:-1])[sameRead]
+    counted = sIdx < eIdx
+
+    diff = np.bincount(sIdx[counted], minlength=len(coverages) + 1)
+    diff -= np.bincount(eIdx[counted], minlength=len(coverages) + 1)
+    coverages += np.cumsum(diff)[:len(coverages)]
+
 
 def remove_row_of_zeros(matrix):
     # remove rows containing all zeros or all nans
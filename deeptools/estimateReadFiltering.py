@@ -3,7 +3,7 @@ import argparse
 import sys
 
 from deeptools import parserCommon, bamHandler, utilities
-from deeptools.mapReduce import mapReduce
+from deeptools.mapReduce import mapReduce, restoresSettings, setExecutor
 from deeptools.utilities import smartLabels
 from importlib.metadata import version
 
@@ -89,6 +89,8 @@ The sum of these may be more than the total number of reads. Note that alignment
                          default=1,
                          required=False)
 
+    parserCommon.executorOptions(general)
+
     general.add_argument('--verbose', '-v',
                          help='Set to see processing messages.',
                          action='store_true')
@@ -255,8 +257,10 @@ def getFiltered_worker(arglist):
     return o
 
 
+@restoresSettings
 def main(args=None):
     args = parseArguments().parse_args(args)
+    setExecutor(args.executor)
 
     if not args.sampleLabels and args.smartLabels:
         args.sampleLabels = smartLabels(args.bamfiles)
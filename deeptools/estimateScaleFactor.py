@@ -5,7 +5,8 @@ import argparse
 import sys
 
 from deeptools.SES_scaleFactor import estimateScaleFactor
-from deeptools.parserCommon import numberOfProcessors
+from deeptools.parserCommon import numberOfProcessors, executorOptions
+from deeptools import mapReduce
 from importlib.metadata import version
 debug = 0
 
@@ -73,6 +74,8 @@ def parseArguments(args=None):
                         default="max/2",
                         required=False)
 
+    executorOptions(parser)
+
     parser.add_argument('--verbose', '-v',
                         help='Set to see processing messages.',
                         action='store_true')
@@ -91,6 +94,7 @@ def parseArguments(args=None):
     return args
 
 
+@mapReduce.restoresSettings
 def main(args=None):
     """
     The algorithm samples the genome a number of times as specified
@@ -99,6 +103,7 @@ def main(args=None):
 
     """
     args = parseArguments(args)
+    mapReduce.setExecutor(args.executor)
     if len(args.bamfiles) > 2:
         print("SES method to estimate scale factors only works for two samples")
         exit(0)
@@ -0,0 +1,197 @@
+"""
+A pool of workers that take their tasks from a directory, so that they can
+run on several hosts sharing a file system. It is used by mapReduce when
+the executor is set to filequeue:DIR (see mapReduce.setExecutor).
+
+Each task is written to DIR/tasks as a pickled (func, args) tuple. A worker
+claims a task by moving it to DIR/running, which only one worker can do,
+and writes the pickled result (or exception) of func(*args) to
+DIR/results, from where the submitting process reads it.
+
+Besides the workers started by the pool itself, any number of workers can
+be started on other hosts with:
+
+    python -m deeptools.fileQueue DIR
+
+These import the task functions from deepTools, so the same version has to
+be installed on every host, and the input files must be at the same path.
+Temporary files of the workers are written to DIR/tmp, so that the
+submitting process can read them.
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import pickle
+import socket
+import tempfile
+import time
+import uuid
+
+
+def _queueDirs(queueDir):
+    dirs = {x: os.path.join(queueDir, x) for x in ["tasks", "running", "results", "tmp"]}
+    for d in dirs.values():
+        os.makedirs(d, exist_ok=True)
+    return dirs
+
+
+def _writeAtomic(fileName, obj):
+    """
+    Pickle obj to fileName, such that readers never see a partial file.
+    """
+    tmpName = "{}.{}.{}.part".format(fileName, socket.gethostname(), os.getpid())
+    with open(tmpName, "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpName, fileName)
+
+
+def runWorker(queueDir, stopEvent=None, idleTimeout=None, pollInterval=0.1):
+    """
+    Run the tasks found in queueDir until stopEvent is set or, if given, no
+    task was found for idleTimeout seconds.
+    """
+    from deeptools import mapReduce
+    mapReduce._initWorker()
+    dirs = _queueDirs(queueDir)
+    tempfile.tempdir = dirs["tmp"]
+    suffix = ".{}.{}".format(socket.gethostname(), os.getpid())
+
+    lastTask = time.time()
+    while True:
+        taskNames = sorted(x for x in os.listdir(dirs["tasks"]) if x.endswith(".task"))
+        for taskName in taskNames:
+            runningName = os.path.join(dirs["running"], taskName + suffix)
+            try:
+                os.rename(os.path.join(dirs["tasks"], taskName), runningName)
+            except OSError:
+                # taken by another worker
+                continue
+            with open(runningName, "rb") as f:
+                func, args = pickle.load(f)
+            try:
+                result = (True, func(*args))
+            except (Exception, SystemExit) as e:
+                # deepTools workers call sys.exit() on some errors
+                result = (False, e)
+            resultName = os.path.join(dirs["results"], taskName[:-5] + ".result")
+            try:
+                _writeAtomic(resultName, result)
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                _writeAtomic(resultName, (False, RuntimeError("The result of {} could not be "
+                                                              "pickled: {}".format(func, e))))
+            os.remove(runningName)
+            lastTask = time.time()
+            break
+        else:
+            if stopEvent is not None and stopEvent.is_set():
+                return
+            if idleTimeout is not None and time.time() - lastTask > idleTimeout:
+                return
+            time.sleep(pollInterval)
+
+
+class FileQueueResult(object):
+    """
+    The result of a task submitted with FileQueuePool.apply_async.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+
+    def ready(self):
+        return os.path.exists(self.fileName)
+
+    def get(self, timeout=None):
+        start = time.time()
+        delay = 0.01
+        while not self.ready():
+            if timeout is not None and time.time() - start > timeout:
+                raise multiprocessing.TimeoutError()
+            time.sleep(delay)
+            delay = min(2 * delay, 1.0)
+        with open(self.fileName, "rb") as f:
+            success, value = pickle.load(f)
+        os.remove(self.fileName)
+        if not success:
+            raise value
+        return value
+
+
+class FileQueueMapResult(object):
+    """
+    The results of the tasks submitted with FileQueuePool.map_async.
+    """
+    def __init__(self, results):
+        self.results = results
+
+    def ready(self):
+        return all(x.ready() for x in self.results)
+
+    def get(self, timeout=None):
+        return [x.get(timeout) for x in self.results]
+
+
+class FileQueuePool(object):
+    """
+    A replacement for multiprocessing.Pool whose tasks are run by workers
+    watching the queueDir directory. numberOfProcessors such workers are
+    started on this host, more can be started on other hosts (see above).
+
+    >>> import operator, tempfile
+    >>> pool = FileQueuePool(tempfile.mkdtemp(), 2)
+    >>> pool.apply_async(operator.add, (1, 2)).get()
+    3
+    >>> pool.map_async(abs, [-1, 2, -3]).get()
+    [1, 2, 3]
+    >>> pool.close()
+    >>> pool.join()
+    """
+    def __init__(self, queueDir, numberOfProcessors=1):
+        self.dirs = _queueDirs(queueDir)
+        # tasks of this pool are run in the order they are submitted
+        self.session = "{}-{}-{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.counter = itertools.count()
+        self.stopEvent = multiprocessing.Event()
+        self.workers = []
+        for _ in range(numberOfProcessors):
+            worker = multiprocessing.Process(target=runWorker, args=(queueDir, self.stopEvent))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def apply_async(self, func, args=()):
+        name = "{}-{:010d}".format(self.session, next(self.counter))
+        _writeAtomic(os.path.join(self.dirs["tasks"], name + ".task"), (func, tuple(args)))
+        return FileQueueResult(os.path.join(self.dirs["results"], name + ".result"))
+
+    def map_async(self, func, iterable):
+        return FileQueueMapResult([self.apply_async(func, (x,)) for x in iterable])
+
+    def close(self):
+        self.stopEvent.set()
+
+    def join(self):
+        for worker in self.workers:
+            worker.join()
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(
+        description="Run the deepTools tasks queued in a directory by a tool "
+        "started with --executor filequeue:DIR. The directory must be on a "
+        "file system shared with the host running the tool.")
+    parser.add_argument("queueDir", metavar="DIR",
+                        help="The directory given to --executor.")
+    parser.add_argument("--idleTimeout", type=float, default=None,
+                        help="Stop after this many seconds without a task. "
+                        "By default, run until killed.")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    runWorker(args.queueDir, idleTimeout=args.idleTimeout)
+
+
+if __name__ == "__main__":
+    main()
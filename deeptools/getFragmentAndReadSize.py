@@ -80,6 +80,16 @@ for the read length. The dictionaries summarise the mean, median etc. values
 
     """
 
+    # without the lengths, the result is kept with the statistics of the
+    # file (see bamHandler.StatsCache)
+    if not return_lengths:
+        cache = bamHandler.StatsCache(bamFile)
+        parameters = {'blackListFile': bamHandler.fileKey(blackListFileName),
+                      'binSize': binSize, 'distanceBetweenBins': distanceBetweenBins}
+        cached = cache.get("readAndFragmentLength", parameters)
+        if cached is not None:
+            return tuple(cached)
+
     bam_handle = bamHandler.openBam(bamFile)
     chrom_sizes = list(zip(bam_handle.references, bam_handle.lengths))
 
@@ -163,4 +173,6 @@ for the read length. The dictionaries summarise the mean, median etc. values
         fragment_len_dict = None
         read_len_dict = None
 
+    if not return_lengths:
+        cache.set("readAndFragmentLength", parameters, [fragment_len_dict, read_len_dict])
     return fragment_len_dict, read_len_dict
@@ -3,22 +3,6 @@ import numpy as np
 old_settings = np.seterr(all='ignore')
 
 
-def compute_ratio(value1, value2, args):
-    value1 = value1 + args['pseudocount'][0]
-    value2 = value2 + args['pseudocount'][1]
-
-    ratio = float(value1) / value2
-    if args['valueType'] == 'log2':
-        ratio = np.log2(ratio)
-
-    elif args['valueType'] == 'reciprocal_ratio':
-        # the reciprocal ratio of a/b
-        # is a/b if a/b > 1 else -1* b/a
-        ratio = ratio if ratio >= 1 else -1.0 / ratio
-
-    return ratio
-
-
 def getRatio(tileCoverage, args):
     r"""
     The mapreduce method calls this function
@@ -36,7 +20,7 @@ def getRatio(tileCoverage, args):
     nan
     >>> funcArgs['valueType'] ='subtract'
     >>> getRatio([20, 10], funcArgs)
-    10
+    10.0
     >>> funcArgs['scaleFactors'] = (1, 0.5)
     >>> getRatio([10, 20], funcArgs)
     0.0
@@ -54,29 +38,46 @@ def getRatio(tileCoverage, args):
     1.0
     """
 
-    value1 = args['scaleFactors'][0] * tileCoverage[0]
-    value2 = args['scaleFactors'][1] * tileCoverage[1]
+    return float(getRatioArray(np.asarray([tileCoverage]), args)[0])
 
-    # if any of the two values to compare
-    # is nan, return nan
-    if np.isnan(value1) or np.isnan(value2):
-        return np.nan
+
+def getRatioArray(coverage, args):
+    r"""
+    Computes the values of all the tiles of a (tiles x 2) coverage array
+    at once, see getRatio.
+
+    >>> funcArgs= {'valueType': 'reciprocal_ratio', 'scaleFactors': (1,1), 'pseudocount': [0, 0]}
+    >>> getRatioArray(np.array([[2, 1], [1, 2], [1, 1], [np.nan, 1]]), funcArgs).tolist()
+    [2.0, -2.0, 1.0, nan]
+    """
+    coverage = np.asarray(coverage, dtype='float64')
+    value1 = args['scaleFactors'][0] * coverage[:, 0]
+    value2 = args['scaleFactors'][1] * coverage[:, 1]
 
     # ratio case
     if args['valueType'] in ['ratio', 'log2', 'reciprocal_ratio']:
-        bin_value = compute_ratio(value1, value2, args)
+        bin_values = (value1 + args['pseudocount'][0]) / (value2 + args['pseudocount'][1])
+        if args['valueType'] == 'log2':
+            bin_values = np.log2(bin_values)
+        elif args['valueType'] == 'reciprocal_ratio':
+            bin_values = np.where(bin_values >= 1, bin_values, -1.0 / bin_values)
 
     # non ratio case (diff, sum etc)
     else:
         if args['valueType'] == 'subtract':
-            bin_value = value1 - value2
+            bin_values = value1 - value2
         elif args['valueType'] == 'add':
-            bin_value = value1 + value2
+            bin_values = value1 + value2
         elif args['valueType'] == 'first':
-            bin_value = value1
+            bin_values = value1
         elif args['valueType'] == 'second':
-            bin_value = value2
+            bin_values = value2
         elif args['valueType'] == 'mean':
-            bin_value = (value1 + value2) / 2.0
+            bin_values = (value1 + value2) / 2.0
+
+    # if any of the two values to compare
+    # is nan, return nan
+    return np.where(np.isnan(value1) | np.isnan(value2), np.nan, bin_values)
+
 
-    return bin_value
+getRatio.vectorized = getRatioArray
@@ -5,6 +5,7 @@ import numpy as np
 import deeptools.mapReduce as mapReduce
 from deeptools import bamHandler
 from deeptools import utilities
+from deeptools.readFilter import ReadFilter
 import sys
 
 debug = 0
@@ -19,7 +20,7 @@ def getFractionKept_worker(chrom, start, end, bamFile, args, offset):
     Queries the BAM file and counts the number of alignments kept/found in the
     first 50000 bases.
     """
-    bam = bamHandler.openBam(bamFile)
+    bam = mapReduce.getFileHandle(bamHandler.openBam, bamFile)
     start += offset * 50000
     end = min(end, start + 50000)
     tot = 0
@@ -28,79 +29,33 @@ def getFractionKept_worker(chrom, start, end, bamFile, args, offset):
     if end <= start:
         return (filtered, tot)
 
-    prev_pos = set()
-    lpos = None
     if chrom in bam.references:
-        for read in bam.fetch(chrom, start, end):
-            tot += 1
-            if read.is_unmapped:
-                continue
-
-            if args.minMappingQuality and read.mapq < args.minMappingQuality:
-                filtered += 1
-                continue
-
-            # filter reads based on SAM flag
-            if args.samFlagInclude and read.flag & args.samFlagInclude != args.samFlagInclude:
-                filtered += 1
-                continue
-            if args.samFlagExclude and read.flag & args.samFlagExclude != 0:
-                filtered += 1
-                continue
-
-            # fragment length filtering
-            tLen = utilities.getTLen(read)
-            if args.minFragmentLength > 0 and tLen < args.minFragmentLength:
-                filtered += 1
-                continue
-            if args.maxFragmentLength > 0 and tLen > args.maxFragmentLength:
-                filtered += 1
-                continue
-
-            # get rid of duplicate reads that have same position on each of the
-            # pairs
-            if args.ignoreDuplicates:
-                # Assuming more or less concordant reads, use the fragment bounds, otherwise the start positions
-                if tLen >= 0:
-                    s = read.pos
-                    e = s + tLen
-                else:
-                    s = read.pnext
-                    e = s - tLen
-                if read.reference_id != read.next_reference_id:
-                    e = read.pnext
-                if lpos is not None and lpos == read.reference_start \
-                        and (s, e, read.next_reference_id, read.is_reverse) in prev_pos:
-                    filtered += 1
-                    continue
-                if lpos != read.reference_start:
-                    prev_pos.clear()
-                lpos = read.reference_start
-                prev_pos.add((s, e, read.next_reference_id, read.is_reverse))
-
-            # If filterRNAstrand is in args, then filter accordingly
-            # This is very similar to what's used in the get_fragment_from_read function in the filterRnaStrand class
-            if hasattr(args, "filterRNAstrand"):
-                if read.is_paired:
-                    if args.filterRNAstrand == 'forward':
-                        if not ((read.flag & 128 == 128 and read.flag & 16 == 0) or (read.flag & 64 == 64 and read.flag & 32 == 0)):
-                            filtered += 1
-                            continue
-                    elif args.filterRNAstrand == 'reverse':
-                        if not (read.flag & 144 == 144 or read.flag & 96 == 96):
-                            filtered += 1
-                            continue
-                else:
-                    if args.filterRNAstrand == 'forward' and read.flag & 16 == 0:
-                        filtered += 1
-                        continue
-                    elif args.filterRNAstrand == 'reverse' and read.flag & 16 == 16:
-                        filtered += 1
-                        continue
+        # only the counts of the filter are needed, unmapped reads are not
+        # counted as filtered
+        readFilter = ReadFilter.fromArgs(args)
+        for _ in readFilter.keptReads(bam.fetch(chrom, start, end)):
+            pass
+        tot = readFilter.counts["total"]
+        filtered = readFilter.counts["filtered"]
 
     return (filtered, tot)
 
 
+def filters_reads(args):
+    """
+    Returns True if any of the filters counted by fraction_kept is used.
+    """
+    if (not args.minMappingQuality or args.minMappingQuality == 0) and \
+       (not args.samFlagInclude or args.samFlagInclude == 0) and \
+       (not args.samFlagExclude or args.samFlagExclude == 0) and \
+       (not args.minFragmentLength or args.minFragmentLength == 0) and \
+       (not args.maxFragmentLength or args.maxFragmentLength == 0):
+        if hasattr(args, "filterRNAstrand"):
+            return args.filterRNAstrand in ["forward", "reverse"]
+        return False
+    return True
+
+
 def fraction_kept(args, stats):
     """
     Count the following:
@@ -123,16 +78,18 @@ def fraction_kept(args, stats):
     size is halved.
     """
     # Do we even need to proceed?
-    if (not args.minMappingQuality or args.minMappingQuality == 0) and \
-       (not args.samFlagInclude or args.samFlagInclude == 0) and \
-       (not args.samFlagExclude or args.samFlagExclude == 0) and \
-       (not args.minFragmentLength or args.minFragmentLength == 0) and \
-       (not args.maxFragmentLength or args.maxFragmentLength == 0):
-        if hasattr(args, "filterRNAstrand"):
-            if args.filterRNAstrand not in ["forward", "reverse"]:
-                return 1.0
-        else:
-            return 1.0
+    if not filters_reads(args):
+        return 1.0
+
+    # the fraction is kept with the statistics of the file (see bamHandler.StatsCache)
+    cache = bamHandler.StatsCache(args.bam)
+    parameters = {x: getattr(args, x, None) for x in ['minMappingQuality', 'samFlagInclude', 'samFlagExclude',
+                                                      'minFragmentLength', 'maxFragmentLength', 'ignoreDuplicates',
+                                                      'filterRNAstrand', 'ignoreForNormalization', 'exactScaling']}
+    parameters['blackListFile'] = bamHandler.fileKey(args.blackListFileName)
+    cached = cache.get("fractionKept", parameters)
+    if cached is not None:
+        return cached
 
     filtered = 0
     total = 0
@@ -177,14 +134,42 @@ def fraction_kept(args, stats):
         # This should never happen
         total = 1
 
+    fraction = 1.0 - float(filtered) / float(total)
+    cache.set("fractionKept", parameters, fraction)
+    return fraction
+
+
+def fraction_kept_from_tallies(args, tallies):
+    """
+    Like fraction_kept, but from the reads of every chromosome counted
+    while computing the coverage, as given by the tallies dict of
+    WriteBedGraph.run, instead of a sample of the genome.
+
+    >>> from argparse import Namespace
+    >>> fraction_kept_from_tallies(Namespace(ignoreForNormalization=['chrM']),
+    ...                            {'chr1': [100, 10, 45], 'chrM': [50, 0, 0]})
+    0.55
+    """
+    filtered = 0
+    total = 0
+    for chrom, (chromTotal, unmapped, kept) in tallies.items():
+        if chrom in args.ignoreForNormalization:
+            continue
+        filtered += chromTotal - unmapped - kept
+        total += chromTotal
+
+    if total == 0:
+        total = 1
+
     return 1.0 - float(filtered) / float(total)
 
 
-def get_num_kept_reads(args, stats):
+def get_num_kept_reads(args, stats, fractionKept=None):
     """
     Substracts from the total number of mapped reads in a bamfile
     the proportion of reads that fall into blacklisted regions
-    or that are filtered
+    or that are filtered. If fractionKept is given, it is used instead
+    of the value of fraction_kept.
 
     :return: integer
     """
@@ -201,7 +186,9 @@ def get_num_kept_reads(args, stats):
         num_kept_reads = bam_mapped_total - blacklisted
     else:
         num_kept_reads = bam_mapped_total
-    ftk = fraction_kept(args, stats)
+    ftk = fractionKept
+    if ftk is None:
+        ftk = fraction_kept(args, stats)
     if ftk < 1:
         num_kept_reads *= ftk
         print("Due to filtering, {0}% of the aforementioned alignments "
@@ -210,9 +197,9 @@ def get_num_kept_reads(args, stats):
     return num_kept_reads, bam_mapped_total
 
 
-def get_scale_factor(args, stats):
+def get_scale_factor(args, stats, fractionKept=None):
     scale_factor = args.scaleFactor
-    bam_mapped, bam_mapped_total = get_num_kept_reads(args, stats)
+    bam_mapped, bam_mapped_total = get_num_kept_reads(args, stats, fractionKept)
     if args.normalizeUsing == 'RPGC':
         # Print output, since normalzation stuff isn't printed to stderr otherwise
         sys.stderr.write("normalization: 1x (effective genome size {})\n".format(args.effectiveGenomeSize))
@@ -1,4 +1,3 @@
-import pyBigWig
 import numpy as np
 import os
 import sys
@@ -7,6 +6,7 @@ import warnings
 
 # deepTools packages
 import deeptools.mapReduce as mapReduce
+from deeptools.binaryCoverage import openCoverage
 import deeptools.utilities
 # debug = 0
 
@@ -61,7 +61,7 @@ def countFragmentsInRegions_worker(chrom, start, end,
 
     bigwig_handles = []
     for foo in bigWigFiles:
-        bigwig_handles.append(pyBigWig.open(foo))
+        bigwig_handles.append(mapReduce.getFileHandle(openCoverage, foo))
 
     regions_to_consider = []
     if bedRegions:
@@ -138,7 +138,7 @@ def countFragmentsInRegions_worker(chrom, start, end,
 
 def getChromSizes(bigwigFilesList):
     """
-    Get chromosome sizes from bigWig file with pyBigWig
+    Get chromosome sizes from bigWig (or binary coverage) files
 
     Test dataset with two samples covering 200 bp.
     >>> test = Tester()
@@ -155,13 +155,13 @@ def getChromSizes(bigwigFilesList):
 
     common_chr = set()
     for fname in bigwigFilesList:
-        fh = pyBigWig.open(fname)
+        fh = openCoverage(fname)
         common_chr = common_chr.union(set(fh.chroms().items()))
         fh.close()
 
     non_common_chr = set()
     for bw in bigwigFilesList:
-        _names_and_size = set(pyBigWig.open(bw).chroms().items())
+        _names_and_size = set(openCoverage(bw).chroms().items())
         if len(common_chr & _names_and_size) == 0:
             #  try to add remove 'chr' from the chromosme name
             _corr_names_size = set()
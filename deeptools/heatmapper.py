@@ -4,9 +4,9 @@ from collections import OrderedDict
 import numpy as np
 from copy import deepcopy
 
-import pyBigWig
 from deeptools import getScorePerBigWigBin
 from deeptools import mapReduce
+from deeptools.binaryCoverage import openCoverage
 from deeptools.utilities import toString, toBytes, smartLabels
 from deeptools.heatmapper_utilities import getProfileTicks
 
@@ -364,7 +364,7 @@ class heatmapper(object):
         # read BAM or scores file
         score_file_handles = []
         for sc_file in score_file_list:
-            score_file_handles.append(pyBigWig.open(sc_file))
+            score_file_handles.append(mapReduce.getFileHandle(openCoverage, sc_file))
 
         # determine the number of matrix columns based on the lengths
         # given by the user, times the number of score files
@@ -655,7 +655,7 @@ class heatmapper(object):
     def coverage_from_big_wig(bigwig, chrom, zones, binSize, avgType, nansAsZeros=False, verbose=True):
 
         """
-        uses pyBigWig
+        uses pyBigWig (or a binary coverage file)
         to query a region define by chrom and zones.
         The output is an array that contains the bigwig
         value per base pair. The summary over bins is
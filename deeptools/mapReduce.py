@@ -1,9 +1,424 @@
+import atexit
+import collections
+import functools
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
 import multiprocessing
+import multiprocessing.pool
+import threading
+import numpy as np
 from deeptoolsintervals import GTF
 import random
 
 debug = 0
 
+# how the tasks are run, see setExecutor()
+_executor = "processes"
+_executorArg = None
+
+# process-wide worker pool shared by all calls to mapReduce()
+_pool = None
+_poolSize = 0
+_poolExecutor = None
+_poolPid = None
+
+# blacklists already parsed by this process, see getBlackList()
+_blackLists = {}
+
+# where finished tasks are saved, see setCheckpointDir()
+_checkpointDir = None
+# the output files of the run, which are not keys of the saved results
+_outputFiles = frozenset()
+
+# files opened by this process (or thread), see getFileHandle()
+_localFiles = threading.local()
+maxFileHandles = 128
+
+
+def _initWorker():
+    """
+    Run once in each pooled worker process when it is started.
+    """
+    # the workers are forked from the parent, don't let them
+    # reuse its pool handle
+    global _pool, _poolSize, _poolExecutor, _poolPid
+    _pool = None
+    _poolSize = 0
+    _poolExecutor = None
+    _poolPid = None
+    # nor the files it has open, as the file offsets would be shared
+    _dropFileHandles()
+
+
+def _initThread(errorSettings):
+    """
+    Run once in each pooled worker thread when it is started. The numpy
+    error handling is set per thread, so use that of the parent thread.
+    """
+    np.seterr(**errorSettings)
+
+
+def setExecutor(executor):
+    """
+    Set how the tasks of mapReduce and friends are run when more than one
+    processor is used. `executor` is one of:
+
+    processes
+        a pool of worker processes on this host (the default).
+    threads
+        a pool of worker threads in this process.
+    filequeue:DIR
+        the tasks are written to the directory DIR, from which any number
+        of workers, on this host or on others sharing the file system,
+        take them (see deeptools.fileQueue). numberOfProcessors workers
+        are started on this host.
+
+    The current pool is shut down if the executor changes.
+
+    The tools set the executor of their --executor option in their main
+    function, which restoresSettings once it is done.
+
+    >>> setExecutor("threads")
+    >>> setExecutor("filequeue")
+    Traceback (most recent call last):
+    ...
+    ValueError: filequeue needs a directory, e.g. filequeue:/shared/queue
+    >>> setExecutor("processes")
+    """
+    name, arg = parseExecutor(executor)
+
+    global _executor, _executorArg
+    if (name, arg) != (_executor, _executorArg):
+        closePool()
+    _executor = name
+    _executorArg = arg
+
+
+def parseExecutor(executor):
+    """
+    Returns the name and the argument (or None) of an executor given as
+    for setExecutor, or raises a ValueError if it is not valid.
+
+    >>> parseExecutor("filequeue:/shared/queue")
+    ('filequeue', '/shared/queue')
+    >>> parseExecutor("threads")
+    ('threads', None)
+    """
+    name, _, arg = executor.partition(":")
+    if name not in ("processes", "threads", "filequeue"):
+        raise ValueError("{} is not a known executor. Use processes, threads "
+                         "or filequeue:DIR".format(executor))
+    if name == "filequeue" and not arg:
+        raise ValueError("filequeue needs a directory, e.g. filequeue:/shared/queue")
+    if name != "filequeue" and arg:
+        raise ValueError("{} does not take an argument".format(name))
+    return name, arg or None
+
+
+def restoresSettings(main):
+    """
+    Decorator for the main function of a tool, which restores the default
+    executor (see setExecutor) and stops saving the results of the tasks
+    (see setCheckpointDir) when main returns or fails, so that the
+    settings of a run do not leak into the next one in the same process.
+    """
+    @functools.wraps(main)
+    def wrapper(*args, **kwargs):
+        try:
+            return main(*args, **kwargs)
+        finally:
+            setExecutor("processes")
+            setCheckpointDir(None)
+    return wrapper
+
+
+def sharesMemory():
+    """
+    Return True if the workers of the current executor run on this host,
+    so that they can write their results to shared memory instead of
+    returning them. That is not possible either if the results have to be
+    saved to the checkpoint directory.
+    """
+    return _executor != "filequeue" and _checkpointDir is None
+
+
+def runsRemotely():
+    """
+    Return True if tasks can run on other hosts with the current executor,
+    in which case they are sent to the workers even if only one processor
+    is used on this host.
+    """
+    return _executor == "filequeue"
+
+
+def getPool(numberOfProcessors):
+    """
+    Return a pool of `numberOfProcessors` workers, as configured with
+    setExecutor(). The pool is started on first use and then reused by every
+    later call in this process, so tools that call mapReduce several times
+    (scale factor sampling, fragment length estimation, CRAM statistics and
+    then the actual computation) only pay for forking the workers once.
+
+    If a different number of processors is requested the current pool is
+    shut down and a new one is started.
+
+    Note that the workers are forked when the pool starts, so they do not
+    see module level variables set afterwards in the parent. Code relying
+    on such variables must call closePool() after setting them. Workers of
+    the filequeue executor on other hosts never see them.
+    """
+    global _pool, _poolSize, _poolExecutor, _poolPid
+    executor = (_executor, _executorArg)
+    if _pool is not None and (_poolPid != os.getpid() or _poolSize != numberOfProcessors or
+                              _poolExecutor != executor):
+        closePool()
+    if _pool is None:
+        if _executor == "threads":
+            _pool = multiprocessing.pool.ThreadPool(numberOfProcessors, initializer=_initThread,
+                                                    initargs=(np.geterr(),))
+        elif _executor == "filequeue":
+            from deeptools.fileQueue import FileQueuePool
+            _pool = FileQueuePool(_executorArg, numberOfProcessors)
+        else:
+            _pool = multiprocessing.Pool(numberOfProcessors, initializer=_initWorker)
+        _poolSize = numberOfProcessors
+        _poolExecutor = executor
+        _poolPid = os.getpid()
+    return _pool
+
+
+def closePool():
+    """
+    Shut down the shared worker pool, if any. A new one is started by
+    the next call to getPool().
+    """
+    global _pool, _poolSize, _poolExecutor, _poolPid
+    if _pool is not None and _poolPid == os.getpid():
+        _pool.close()
+        _pool.join()
+    _pool = None
+    _poolSize = 0
+    _poolExecutor = None
+    _poolPid = None
+
+
+atexit.register(closePool)
+
+
+def getBlackList(blackListFileName):
+    """
+    Return the GTF object of the blacklist file(s) in blackListFileName, or
+    None if no file is given. The files are parsed the first time they are
+    requested in a process and the result is reused by every later call,
+    so a worker does not parse the blacklist again for each chunk. Cached
+    blacklists are keyed by the path and modification time of the files,
+    so a file that changed is parsed again.
+
+    The pool workers are forked from the parent, so blacklists parsed in the
+    parent before the pool is started are shared with all the workers.
+    """
+    if not blackListFileName:
+        return None
+    if isinstance(blackListFileName, str):
+        fileNames = [blackListFileName]
+    else:
+        fileNames = list(blackListFileName)
+    key = tuple((os.path.abspath(x), os.path.getmtime(x)) for x in fileNames)
+    if key not in _blackLists:
+        _blackLists[key] = GTF(blackListFileName)
+    return _blackLists[key]
+
+
+def _dropFileHandles():
+    """
+    Forget the file handles inherited from the parent process. A forked
+    process shares the file offsets of its parent, so it must open the
+    files again rather than read from the same descriptors.
+    """
+    _localFiles.handles = collections.OrderedDict()
+    _localFiles.pid = os.getpid()
+
+
+def getFileHandle(opener, fileName, *args):
+    """
+    Return the handle returned by opener(fileName, *args), e.g.
+    getFileHandle(bamHandler.openBam, "file.bam"), opening the file only the
+    first time it is requested in this process. This way a worker reads the
+    index of a BAM/CRAM file or the header of a bigWig file once, instead of
+    once per chunk. Each thread has its own handles, since they can't be
+    read from concurrently.
+
+    The handles are shared by every caller, which must not close them. At
+    most maxFileHandles files are kept open, the least recently used one is
+    closed when another file is opened. A file that changed since it was
+    opened is opened again.
+    """
+    if getattr(_localFiles, "pid", None) != os.getpid():
+        _dropFileHandles()
+    handles = _localFiles.handles
+    try:
+        mtime = os.path.getmtime(fileName)
+    except OSError:
+        # e.g., a remote bigWig file
+        mtime = None
+    key = (opener, fileName, args, mtime)
+    if key in handles:
+        handles.move_to_end(key)
+        return handles[key]
+    handle = opener(fileName, *args)
+    handles[key] = handle
+    while len(handles) > maxFileHandles:
+        _, oldHandle = handles.popitem(last=False)
+        oldHandle.close()
+    return handle
+
+
+def setCheckpointDir(checkpointDir, outputFiles=()):
+    """
+    Save the result of every task run by mapReduce, imapReduce and
+    imapTasks in checkpointDir, or stop doing so if checkpointDir is None.
+    When the same task is run again, e.g. after a failed run, the saved
+    result is used instead of running it.
+
+    A result is saved as a file named after a hash of the task function,
+    its arguments and the path, size and modification time of the input
+    files found among them, so changing a parameter or an input file
+    invalidates the saved results. The outputFiles of the run (paths or
+    file objects) are not taken to be input files, since a failed run may
+    have left them behind. Temporary files returned by a task (see
+    utilities.getTempFileName) are saved along with the result and a copy
+    of them is returned when the result is reused.
+
+    The saved results are not removed once the run finishes. The tools set
+    the directory of their --checkpointDir option in their main function,
+    which restoresSettings once it is done.
+    """
+    global _checkpointDir, _outputFiles
+    if checkpointDir is not None:
+        os.makedirs(checkpointDir, exist_ok=True)
+    _checkpointDir = checkpointDir
+    _outputFiles = frozenset(os.path.realpath(getattr(x, "name", x)) for x in outputFiles if x)
+
+
+def _inputFiles(obj, files, seen):
+    """
+    Add to files the paths of the files found in obj, which can be a
+    string, a container or an object with attributes, such as the self
+    argument of CountReadsPerBin.count_reads_in_region. The output files
+    given to setCheckpointDir are left out.
+    """
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, str):
+        if obj not in files and os.path.isfile(obj) and os.path.realpath(obj) not in _outputFiles:
+            stat = os.stat(obj)
+            files[obj] = (stat.st_size, stat.st_mtime_ns)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for x in obj:
+            _inputFiles(x, files, seen)
+    elif isinstance(obj, dict):
+        for k, v in obj.items():
+            _inputFiles(k, files, seen)
+            _inputFiles(v, files, seen)
+    elif hasattr(obj, "__dict__") and not callable(obj):
+        _inputFiles(vars(obj), files, seen)
+
+
+def _checkpointName(func, task):
+    """
+    Returns the file holding the saved result of func(task).
+    """
+    files = {}
+    _inputFiles(task, files, set())
+    h = hashlib.sha1()
+    h.update(pickle.dumps((func, task, sorted(files.items())), protocol=4))
+    return os.path.join(_checkpointDir, h.hexdigest() + ".pkl")
+
+
+def _replaceFiles(obj, fileNames):
+    """
+    Returns obj with the strings that are keys of fileNames replaced by
+    their value.
+    """
+    if isinstance(obj, str):
+        return fileNames.get(obj, obj)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_replaceFiles(x, fileNames) for x in obj)
+    return obj
+
+
+def _tempFiles(obj, files):
+    """
+    Adds to files the temporary files of deepTools found in obj.
+    """
+    if isinstance(obj, str):
+        if os.path.basename(obj).startswith("_deeptools_") and os.path.isfile(obj):
+            files.append(obj)
+    elif isinstance(obj, (list, tuple)):
+        for x in obj:
+            _tempFiles(x, files)
+
+
+def _linkOrCopy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _runCheckpointed(args):
+    """
+    Runs func(task), or returns its saved result if there is one in
+    fileName. Its temporary files are restored under new names, since
+    the caller usually removes them.
+    """
+    func, fileName, task = args
+    if os.path.exists(fileName):
+        with open(fileName, "rb") as f:
+            res, savedFiles = pickle.load(f)
+        fileNames = {}
+        for tempName, savedName in savedFiles.items():
+            _file = tempfile.NamedTemporaryFile(prefix="_deeptools_", suffix=os.path.splitext(tempName)[1],
+                                                delete=False)
+            _file.close()
+            os.remove(_file.name)
+            _linkOrCopy(savedName, _file.name)
+            fileNames[tempName] = _file.name
+        return _replaceFiles(res, fileNames)
+
+    res = func(task)
+    tempNames = []
+    _tempFiles(res, tempNames)
+    savedFiles = {}
+    for i, tempName in enumerate(tempNames):
+        savedName = "{}.{}{}".format(fileName[:-4], i, os.path.splitext(tempName)[1])
+        if os.path.exists(savedName):
+            os.remove(savedName)
+        _linkOrCopy(tempName, savedName)
+        savedFiles[tempName] = savedName
+    # the result file is written last, so that it is only
+    # found once everything it refers to is in place
+    partName = "{}.{}.part".format(fileName, os.getpid())
+    with open(partName, "wb") as f:
+        pickle.dump((res, savedFiles), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(partName, fileName)
+    return res
+
+
+def _checkpointTasks(func, TASKS):
+    """
+    If a checkpoint directory is set, returns the function and tasks that
+    run func on each element of TASKS saving their result (see
+    setCheckpointDir). Otherwise, func and TASKS are returned unchanged.
+    """
+    if _checkpointDir is None:
+        return func, TASKS
+    return _runCheckpointed, [(func, _checkpointName(func, task), task) for task in TASKS]
+
 
 def mapReduce(staticArgs, func, chromSize,
               genomeChunkLength=None,
@@ -17,7 +432,9 @@ def mapReduce(staticArgs, func, chromSize,
               transcriptID="transcriptID",
               exonID="exonID",
               transcript_id_designator="transcript_id",
-              self_=None):
+              self_=None,
+              chunkCost=None,
+              tileSize=None):
     """
     Split the genome into parts that are sent to workers using a defined
     number of procesors. Results are collected and returned.
@@ -54,10 +471,194 @@ def mapReduce(staticArgs, func, chromSize,
     :param includeLabels: Pass group and transcript labels into the calling
                           function. These are added to the static args
                           (groupLabel and transcriptName).
+    :param chunkCost: A function returning the estimated cost of processing
+                      a region given its chrom, start and end (see
+                      bamHandler.getChunkCost). If given, the most expensive
+                      chunks are sent to the workers first, so that they
+                      do not end up holding up the whole pool at the end.
+    :param tileSize: If given together with chunkCost, expensive chunks are
+                     split and adjacent cheap chunks are merged (see
+                     balanceChunks). New chunk boundaries are multiples of
+                     tileSize from the start of the chromosome (or region).
 
     If "includeLabels" is true, a tuple of (results, labels) is returned
     """
 
+    TASKS, labels = getTasks(staticArgs, chromSize,
+                             genomeChunkLength=genomeChunkLength,
+                             region=region,
+                             bedFile=bedFile,
+                             blackListFileName=blackListFileName,
+                             verbose=verbose,
+                             includeLabels=includeLabels,
+                             keepExons=keepExons,
+                             transcriptID=transcriptID,
+                             exonID=exonID,
+                             transcript_id_designator=transcript_id_designator,
+                             self_=self_,
+                             chunkCost=chunkCost,
+                             tileSize=tileSize)
+
+    if len(TASKS) > 1 and (numberOfProcessors > 1 or runsRemotely()):
+        if verbose:
+            print(("using {} processors for {} "
+                   "number of tasks".format(numberOfProcessors,
+                                            len(TASKS))))
+        if chunkCost is not None:
+            # largest first, the position of chrom, start, end
+            # depends on whether self_ is in the list
+            i = 0 if self_ is None else 1
+            TASKS = [TASKS[x] for x in costOrder(TASKS, lambda x: chunkCost(x[i], x[i + 1], x[i + 2]))]
+        else:
+            random.shuffle(TASKS)
+        func, TASKS = _checkpointTasks(func, TASKS)
+        pool = getPool(numberOfProcessors)
+        res = pool.map_async(func, TASKS).get(9999999)
+    else:
+        func, TASKS = _checkpointTasks(func, TASKS)
+        res = list(map(func, TASKS))
+
+    if includeLabels:
+        return res, labels
+    return res
+
+
+def imapReduce(staticArgs, func, chromSize,
+               genomeChunkLength=None,
+               region=None,
+               bedFile=None,
+               blackListFileName=None,
+               numberOfProcessors=4,
+               verbose=False,
+               maxInFlight=None,
+               keepExons=False,
+               transcriptID="transcriptID",
+               exonID="exonID",
+               transcript_id_designator="transcript_id",
+               self_=None,
+               chunkCost=None,
+               tileSize=None):
+    """
+    Like mapReduce, but returns a generator that yields the result of each
+    task as soon as it (and all tasks before it) are done. The results are
+    yielded in genome order, that is, in the order of chromSize and by
+    start position within each chromosome.
+
+    At most `maxInFlight` tasks (by default twice the number of processors)
+    are sent to the workers ahead of the one that is consumed next, so the
+    memory needed to hold finished results depends on the number of workers
+    rather than on the size of the genome.
+
+    The parameters are otherwise the same as for mapReduce. Since the results
+    are yielded in genome order, chunkCost is only used to split and merge
+    chunks, not to reorder them.
+    """
+    TASKS, _ = getTasks(staticArgs, chromSize,
+                        genomeChunkLength=genomeChunkLength,
+                        region=region,
+                        bedFile=bedFile,
+                        blackListFileName=blackListFileName,
+                        verbose=verbose,
+                        keepExons=keepExons,
+                        transcriptID=transcriptID,
+                        exonID=exonID,
+                        transcript_id_designator=transcript_id_designator,
+                        self_=self_,
+                        chunkCost=chunkCost,
+                        tileSize=tileSize)
+
+    for res in imapTasks(func, TASKS, numberOfProcessors=numberOfProcessors,
+                         verbose=verbose, maxInFlight=maxInFlight):
+        yield res
+
+
+def costOrder(TASKS, taskCost):
+    """
+    Returns the indices of TASKS from the most to the least expensive one,
+    according to the taskCost function of a task.
+
+    >>> costOrder([('chr1', 0, 10), ('chr1', 10, 30), ('chr2', 0, 20)], lambda x: x[2] - x[1])
+    [1, 2, 0]
+    """
+    costs = [taskCost(x) for x in TASKS]
+    return sorted(range(len(TASKS)), key=lambda x: costs[x], reverse=True)
+
+
+def imapTasks(func, TASKS, numberOfProcessors=4, verbose=False, maxInFlight=None,
+              taskCost=None):
+    """
+    Calls 'func' on each element of the TASKS list using the shared pool of
+    workers and yields the results in the same order as the tasks (see
+    imapReduce). This is useful when the tasks returned by getTasks need to
+    be extended before sending them to the workers.
+
+    If taskCost, a function returning the cost of a task, is given, all the
+    tasks are sent to the workers at once, the most expensive first, and
+    maxInFlight is not used. The results are still yielded in task order.
+    """
+    if taskCost is not None and len(TASKS) > 1 and (numberOfProcessors > 1 or runsRemotely()):
+        order = costOrder(TASKS, taskCost)
+        func, TASKS = _checkpointTasks(func, TASKS)
+        if verbose:
+            print(("using {} processors for {} "
+                   "number of tasks".format(numberOfProcessors,
+                                            len(TASKS))))
+        pool = getPool(numberOfProcessors)
+        pending = [None] * len(TASKS)
+        for i in order:
+            pending[i] = pool.apply_async(func, (TASKS[i],))
+        for i in range(len(TASKS)):
+            yield pending[i].get(9999999)
+            pending[i] = None
+        return
+
+    func, TASKS = _checkpointTasks(func, TASKS)
+    if len(TASKS) > 1 and (numberOfProcessors > 1 or runsRemotely()):
+        if verbose:
+            print(("using {} processors for {} "
+                   "number of tasks".format(numberOfProcessors,
+                                            len(TASKS))))
+        if not maxInFlight:
+            if runsRemotely():
+                # the number of remote workers is unknown and finished
+                # results wait on disk, so queue all the tasks
+                maxInFlight = len(TASKS)
+            else:
+                maxInFlight = 2 * numberOfProcessors
+        pool = getPool(numberOfProcessors)
+        pending = collections.deque()
+        for task in TASKS:
+            pending.append(pool.apply_async(func, (task,)))
+            if len(pending) >= maxInFlight:
+                yield pending.popleft().get(9999999)
+        while pending:
+            yield pending.popleft().get(9999999)
+    else:
+        for task in TASKS:
+            yield func(task)
+
+
+def getTasks(staticArgs, chromSize,
+             genomeChunkLength=None,
+             region=None,
+             bedFile=None,
+             blackListFileName=None,
+             verbose=False,
+             includeLabels=False,
+             keepExons=False,
+             transcriptID="transcriptID",
+             exonID="exonID",
+             transcript_id_designator="transcript_id",
+             self_=None,
+             chunkCost=None,
+             tileSize=None):
+    """
+    Splits the genome into the chunks processed by mapReduce and returns
+    a tuple of (the list of task arguments in genome order, the bed file
+    labels or None if no bed file was given).
+
+    See mapReduce for a description of the parameters.
+    """
     if not genomeChunkLength:
         genomeChunkLength = 1e5
     genomeChunkLength = int(genomeChunkLength)
@@ -85,72 +686,115 @@ def mapReduce(staticArgs, func, chromSize,
         bed_interval_tree = GTF(bedFile, defaultGroup=defaultGroup, transcriptID=transcriptID, exonID=exonID, transcript_id_designator=transcript_id_designator, keepExons=keepExons)
 
     if blackListFileName:
-        blackList = GTF(blackListFileName)
+        blackList = getBlackList(blackListFileName)
 
-    TASKS = []
+    chunks = []
     # iterate over all chromosomes
     for chrom, size in chromSize:
         # the start is zero unless a specific region is defined
         start = 0 if region_start == 0 else region_start
         for startPos in range(start, size, genomeChunkLength):
-            endPos = min(size, startPos + genomeChunkLength)
+            chunks.append((chrom, startPos, min(size, startPos + genomeChunkLength)))
 
-            # Reject a chunk if it overlaps
-            if blackListFileName:
-                regions = blSubtract(blackList, chrom, [startPos, endPos])
-            else:
-                regions = [[startPos, endPos]]
+    if chunkCost is not None and tileSize:
+        chunks = balanceChunks(chunks, chunkCost, tileSize, maxLength=4 * genomeChunkLength)
+        if verbose:
+            print("number of chunks after balancing their cost: {}".format(len(chunks)))
 
-            for reg in regions:
-                if self_ is not None:
-                    argsList = [self_]
+    TASKS = []
+    for chrom, startPos, endPos in chunks:
+        # Reject a chunk if it overlaps
+        if blackListFileName:
+            regions = blSubtract(blackList, chrom, [startPos, endPos])
+        else:
+            regions = [[startPos, endPos]]
+
+        for reg in regions:
+            if self_ is not None:
+                argsList = [self_]
+            else:
+                argsList = []
+
+            argsList.extend([chrom, reg[0], reg[1]])
+            # add to argument list the static list received the the function
+            argsList.extend(staticArgs)
+
+            # if a bed file is given, append to the TASK list,
+            # a list of bed regions that overlap with the
+            # current genomeChunk.
+            if bedFile:
+                # This effectively creates batches of intervals, which is
+                # generally more performant due to the added overhead of
+                # initializing additional workers.
+
+                # TODO, there's no point in including the chromosome
+                if includeLabels:
+                    bed_regions_list = [[chrom, x[4], x[2], x[3], x[5], x[6]] for x in bed_interval_tree.findOverlaps(chrom, reg[0], reg[1], trimOverlap=True, numericGroups=True, includeStrand=True)]
                 else:
-                    argsList = []
-
-                argsList.extend([chrom, reg[0], reg[1]])
-                # add to argument list the static list received the the function
-                argsList.extend(staticArgs)
-
-                # if a bed file is given, append to the TASK list,
-                # a list of bed regions that overlap with the
-                # current genomeChunk.
-                if bedFile:
-                    # This effectively creates batches of intervals, which is
-                    # generally more performant due to the added overhead of
-                    # initializing additional workers.
-
-                    # TODO, there's no point in including the chromosome
-                    if includeLabels:
-                        bed_regions_list = [[chrom, x[4], x[2], x[3], x[5], x[6]] for x in bed_interval_tree.findOverlaps(chrom, reg[0], reg[1], trimOverlap=True, numericGroups=True, includeStrand=True)]
-                    else:
-                        bed_regions_list = [[chrom, x[4], x[5], x[6]] for x in bed_interval_tree.findOverlaps(chrom, reg[0], reg[1], trimOverlap=True, includeStrand=True)]
-
-                    if len(bed_regions_list) == 0:
-                        continue
-                    # add to argument list, the position of the bed regions to use
-                    argsList.append(bed_regions_list)
-
-                TASKS.append(tuple(argsList))
-
-    if len(TASKS) > 1 and numberOfProcessors > 1:
-        if verbose:
-            print(("using {} processors for {} "
-                   "number of tasks".format(numberOfProcessors,
-                                            len(TASKS))))
-        random.shuffle(TASKS)
-        pool = multiprocessing.Pool(numberOfProcessors)
-        res = pool.map_async(func, TASKS).get(9999999)
-        pool.close()
-        pool.join()
-    else:
-        res = list(map(func, TASKS))
+                    bed_regions_list = [[chrom, x[4], x[5], x[6]] for x in bed_interval_tree.findOverlaps(chrom, reg[0], reg[1], trimOverlap=True, includeStrand=True)]
 
-    if includeLabels:
-        if bedFile:
-            return res, bed_interval_tree.labels
+                if len(bed_regions_list) == 0:
+                    continue
+                # add to argument list, the position of the bed regions to use
+                argsList.append(bed_regions_list)
+
+            TASKS.append(tuple(argsList))
+
+    labels = None
+    if bedFile:
+        labels = bed_interval_tree.labels
+    return TASKS, labels
+
+
+def balanceChunks(chunks, chunkCost, tileSize, maxLength=None):
+    """
+    Splits and merges genome chunks so that their estimated costs are
+    more alike. A chunk costing more than twice the mean is split into
+    pieces of about the mean cost, while runs of adjacent cheap chunks on
+    the same chromosome are merged as long as their summed cost stays
+    below the mean and their length below maxLength. The new chunk
+    boundaries are multiples of tileSize from the start of the original
+    chunks.
+
+    :param chunks: list of (chrom, start, end) tuples in genome order
+    :param chunkCost: function returning the cost of (chrom, start, end)
+    :param tileSize: the chunks are only split at multiples of this
+    :param maxLength: upper limit for the length of a merged chunk
+
+    >>> cost = lambda chrom, start, end: 10 * (end - start) if chrom == 'chr1' else end - start
+    >>> balanceChunks([('chr1', 0, 100), ('chr2', 0, 100), ('chr2', 100, 200),
+    ...                ('chr2', 200, 300), ('chr2', 300, 350)], cost, 10)
+    [('chr1', 0, 40), ('chr1', 40, 80), ('chr1', 80, 100), ('chr2', 0, 200), ('chr2', 200, 350)]
+    >>> balanceChunks([('chr1', 0, 100), ('chr2', 0, 100), ('chr2', 100, 200),
+    ...                ('chr2', 200, 300), ('chr2', 300, 350)], cost, 10, maxLength=100)
+    [('chr1', 0, 40), ('chr1', 40, 80), ('chr1', 80, 100), ('chr2', 0, 100), ('chr2', 100, 200), ('chr2', 200, 300), ('chr2', 300, 350)]
+    """
+    costs = [chunkCost(*x) for x in chunks]
+    if len(chunks) < 2 or sum(costs) <= 0:
+        return chunks
+    meanCost = float(sum(costs)) / len(costs)
+
+    output = []
+    # cost of the last chunk in output, None if it can't be extended
+    lastCost = None
+    for (chrom, start, end), cost in zip(chunks, costs):
+        if cost > 2 * meanCost:
+            nPieces = int(cost // meanCost)
+            # round the piece length up to a multiple of tileSize
+            step = -(-(end - start) // (nPieces * tileSize)) * tileSize
+            for pos in range(start, end, step):
+                output.append((chrom, pos, min(end, pos + step)))
+            lastCost = None
+        elif lastCost is not None and output[-1][0] == chrom and output[-1][2] == start \
+                and lastCost + cost <= meanCost \
+                and (maxLength is None or end - output[-1][1] <= maxLength):
+            output[-1] = (chrom, output[-1][1], end)
+            lastCost += cost
         else:
-            return res, None
-    return res
+            output.append((chrom, start, end))
+            lastCost = cost
+
+    return output
 
 
 def getUserRegion(chrom_sizes, region_string, max_chunk_size=1e6):
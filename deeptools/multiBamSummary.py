@@ -8,6 +8,7 @@ import numpy as np
 
 import deeptools.countReadsPerBin as countR
 from deeptools import parserCommon
+from deeptools import mapReduce
 from deeptools.utilities import smartLabels
 from importlib.metadata import version
 old_settings = np.seterr(all='ignore')
@@ -209,6 +210,7 @@ def process_args(args=None):
     return args
 
 
+@mapReduce.restoresSettings
 def main(args=None):
     """
     1. get read counts at different positions either
@@ -218,6 +220,8 @@ def main(args=None):
 
     """
     args = process_args(args)
+    mapReduce.setExecutor(args.executor)
+    mapReduce.setCheckpointDir(args.checkpointDir, [args.outFileName, args.outRawCounts])
 
     if 'BED' in args:
         bed_regions = args.BED
@@ -6,6 +6,7 @@ import argparse
 import os.path
 import numpy as np
 from deeptools import parserCommon
+from deeptools import mapReduce
 from deeptools.utilities import smartLabels
 import deeptools.getScorePerBigWigBin as score_bw
 from importlib.metadata import version
@@ -204,6 +205,7 @@ def multiBigwigSummaryArgs(case='bins'):
     return parser
 
 
+@mapReduce.restoresSettings
 def main(args=None):
     """
     1. get read counts at different positions either
@@ -213,6 +215,8 @@ def main(args=None):
 
     """
     args = process_args(args)
+    mapReduce.setExecutor(args.executor)
+    mapReduce.setCheckpointDir(args.checkpointDir, [args.outFileName, args.outRawCounts])
 
     if 'BED' in args:
         bed_regions = args.BED
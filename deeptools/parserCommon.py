@@ -22,7 +22,11 @@ def check_list_of_comma_values(value):
     return value
 
 
-def output(args=None):
+def output(args=None, coverageOptions=False):
+    """
+    The output options. coverageOptions adds those only supported by the
+    tools writing through WriteBedGraph (bamCoverage and bamCompare).
+    """
     parser = argparse.ArgumentParser(add_help=False)
     group = parser.add_argument_group('Output')
     group.add_argument('--outFileName', '-o',
@@ -31,10 +35,55 @@ def output(args=None):
                        type=writableFile,
                        required=True)
 
-    group.add_argument('--outFileFormat', '-of',
-                       help='Output file type. Either "bigwig" or "bedgraph".',
-                       choices=['bigwig', 'bedgraph'],
-                       default='bigwig')
+    if coverageOptions:
+        group.add_argument('--outFileFormat', '-of',
+                           help='Output file type. Either "bigwig", "bedgraph" or '
+                           '"binary". A binary file holds the value of each bin as '
+                           'an array per chromosome, which multiBigwigSummary, '
+                           'computeMatrix, bigwigCompare and bigwigAverage read '
+                           'faster than a bigWig file. It is meant as an '
+                           'intermediate file for these tools and can not be used '
+                           'with a blacklist.',
+                           choices=['bigwig', 'bedgraph', 'binary'],
+                           default='bigwig')
+    else:
+        group.add_argument('--outFileFormat', '-of',
+                           help='Output file type. Either "bigwig" or "bedgraph".',
+                           choices=['bigwig', 'bedgraph'],
+                           default='bigwig')
+
+    group.add_argument('--zoomLevels',
+                       help='Maximum number of zoom levels of a bigWig file. The '
+                       'zoom levels are summaries of the values at lower '
+                       'resolutions, which genome browsers show when zoomed out. '
+                       'They are computed in a single pass after all values are '
+                       'written, so fewer levels make writing faster, especially '
+                       'for small bin sizes. 0 writes no zoom levels. '
+                       '(Default: %(default)s)',
+                       metavar='INT',
+                       type=int,
+                       default=10)
+
+    if coverageOptions:
+        group.add_argument('--significantDigits',
+                           help='Round the values to this number of significant '
+                           'digits. Adjacent bins with the same rounded value are '
+                           'written as one, which makes the files smaller. By '
+                           'default, bigWig and bedGraph files keep 6 digits, which '
+                           'is also the most that can be given.',
+                           metavar='INT',
+                           type=significantDigits,
+                           default=None)
+
+        group.add_argument('--quantizationStep',
+                           help='Round the values to multiples of this step, which '
+                           'for bamCoverage is in units of the scale factor (so that '
+                           'a step of 1 is one read, e.g. in a CPM track). As with '
+                           '--significantDigits, adjacent bins with the same rounded '
+                           'value are written as one.',
+                           metavar='FLOAT',
+                           type=float,
+                           default=None)
 
     return parser
 
@@ -254,7 +303,10 @@ def normalization_options():
                        'the output. This requires significantly more time to compute, but will '
                        'produce more accurate scaling factors in cases where alignments that are '
                        'being filtered are rare and lumped together. In other words, this is only '
-                       'needed when region-based sampling is expected to produce incorrect results.',
+                       'needed when region-based sampling is expected to produce incorrect results. '
+                       'bamCoverage counts the reads while computing the coverage instead, so that no '
+                       'extra pass over the file is needed, unless --region, --MNase, --extraOutput, '
+                       '--incremental or --blackListFileName is used.',
                        action='store_true')
 
     group.add_argument('--ignoreForNormalization', '-ignore',
@@ -334,6 +386,8 @@ def getParentArgParse(args=None, binSize=True, blackList=True):
                           default=1,
                           required=False)
 
+    executorOptions(optional, checkpointDir=True)
+
     optional.add_argument('--verbose', '-v',
                           help='Set to see processing messages.',
                           action='store_true')
@@ -341,6 +395,69 @@ def getParentArgParse(args=None, binSize=True, blackList=True):
     return parser
 
 
+def executorOptions(group, checkpointDir=False):
+    """
+    Adds the --executor option, and the --checkpointDir option if
+    checkpointDir is True, to an argument group (or parser). The tools set
+    them in their main function (see mapReduce.setExecutor and
+    mapReduce.setCheckpointDir).
+    """
+    group.add_argument('--executor',
+                       help='How to run the tasks when using several processors: "processes" '
+                       '(worker processes on this host), "threads" (worker threads) or '
+                       '"filequeue:DIR", which runs them on the workers watching the '
+                       'directory DIR. --numberOfProcessors such workers are started on '
+                       'this host, others can be started on hosts sharing the file system '
+                       'with "python -m deeptools.fileQueue DIR". (Default: %(default)s)',
+                       metavar="EXECUTOR",
+                       type=executor,
+                       default="processes",
+                       required=False)
+
+    if checkpointDir:
+        group.add_argument('--checkpointDir',
+                           help='Directory in which the result of each genomic chunk is saved '
+                           'as soon as it is computed. If the command is run again with the '
+                           'same input files and parameters, e.g. after it failed, the saved '
+                           'chunks are reused and only the missing ones are computed. The '
+                           'directory is not removed afterwards.',
+                           metavar="DIR",
+                           required=False)
+
+
+def executor(string):
+    """
+    Checks the value of --executor (see mapReduce.setExecutor).
+    """
+    from deeptools import mapReduce
+    try:
+        mapReduce.parseExecutor(string)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return string
+
+
+def significantDigits(string):
+    """
+    Checks the value of --significantDigits, from 1 to the 6 digits the
+    bigWig and bedGraph files keep.
+
+    >>> significantDigits("3")
+    3
+    >>> significantDigits("8")
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: 8 is not between 1 and 6
+    """
+    try:
+        digits = int(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} is not an integer".format(string))
+    if not 1 <= digits <= 6:
+        raise argparse.ArgumentTypeError("{} is not between 1 and 6".format(string))
+    return digits
+
+
 def numberOfProcessors(string):
     try:
         # won't work on macOS or windows
@@ -394,12 +511,15 @@ def genomicRegion(string):
 
 def writableFile(string):
     """
-    Simple function that tests if a given path is writable
+    Simple function that tests if a given path is writable. An existing
+    file is not touched, since it is only replaced once the output is
+    written (and read before that by bamCoverage --incremental).
     """
-    try:
-        open(string, 'w').close()
-        os.remove(string)
-    except:
+    if os.path.exists(string):
+        writable = not os.path.isdir(string) and os.access(string, os.W_OK)
+    else:
+        writable = os.access(os.path.dirname(os.path.abspath(string)), os.W_OK | os.X_OK)
+    if not writable:
         msg = "{} file can't be opened for writing".format(string)
         raise argparse.ArgumentTypeError(msg)
     return string
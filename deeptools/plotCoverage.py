@@ -17,6 +17,7 @@ import plotly.graph_objs as go
 from importlib.metadata import version
 import deeptools.countReadsPerBin as countR
 from deeptools import parserCommon
+from deeptools import mapReduce
 from deeptools.utilities import smartLabels
 
 old_settings = np.seterr(all='ignore')
@@ -170,8 +171,11 @@ def required_args():
     return parser
 
 
+@mapReduce.restoresSettings
 def main(args=None):
     args = process_args(args)
+    mapReduce.setExecutor(args.executor)
+    mapReduce.setCheckpointDir(args.checkpointDir, [args.plotFile, args.outRawCounts, args.outCoverageMetrics])
 
     if not args.outRawCounts and not args.plotFile and not args.outCoverageMetrics:
         sys.exit("At least one of --plotFile, --outRawCounts and --outCoverageMetrics are required.\n")
@@ -15,11 +15,13 @@ import matplotlib.gridspec as gridspec
 import plotly.offline as py
 import plotly.graph_objs as go
 
-from deeptools.mapReduce import mapReduce, getUserRegion, blSubtract
+from deeptools.mapReduce import mapReduce, getUserRegion, blSubtract, closePool, getBlackList, getFileHandle, \
+    restoresSettings, setExecutor, setCheckpointDir
 from deeptools.getFragmentAndReadSize import get_read_and_fragment_length
-from deeptools.utilities import getCommonChrNames, mungeChromosome, getTLen, smartLabels
+from deeptools.utilities import getCommonChrNames, mungeChromosome, smartLabels
 from deeptools.bamHandler import openBam
-from deeptoolsintervals import Enrichment, GTF
+from deeptools.readFilter import ReadFilter
+from deeptoolsintervals import Enrichment
 from deeptools.countReadsPerBin import CountReadsPerBin as cr
 from deeptools import parserCommon
 
@@ -303,47 +305,13 @@ def getEnrichment_worker(arglist):
         odict = dict()
         for x in gtf.features:
             odict[x] = 0
-        fh = openBam(f)
+        fh = getFileHandle(openBam, f)
 
         chrom = mungeChromosome(chrom, fh.references)
 
-        lpos = None
-        prev_pos = set()
-        for read in fh.fetch(chrom, start, end):
-            # Filter
-            if read.pos < start:
-                # Ensure that a given alignment is processed only once
-                continue
-            if read.flag & 4:
-                continue
-            if args.minMappingQuality and read.mapq < args.minMappingQuality:
-                continue
-            if args.samFlagInclude and read.flag & args.samFlagInclude != args.samFlagInclude:
-                continue
-            if args.samFlagExclude and read.flag & args.samFlagExclude != 0:
-                continue
-            tLen = getTLen(read)
-            if args.minFragmentLength > 0 and tLen < args.minFragmentLength:
-                continue
-            if args.maxFragmentLength > 0 and tLen > args.maxFragmentLength:
-                continue
-            if args.ignoreDuplicates:
-                # Assuming more or less concordant reads, use the fragment bounds, otherwise the start positions
-                if tLen >= 0:
-                    s = read.pos
-                    e = s + tLen
-                else:
-                    s = read.pnext
-                    e = s - tLen
-                if read.reference_id != read.next_reference_id:
-                    e = read.pnext
-                if lpos is not None and lpos == read.reference_start \
-                        and (s, e, read.next_reference_id, read.is_reverse) in prev_pos:
-                    continue
-                if lpos != read.reference_start:
-                    prev_pos.clear()
-                lpos = read.reference_start
-                prev_pos.add((s, e, read.next_reference_id, read.is_reverse))
+        # Ensure that a given alignment is processed only once
+        readFilter = ReadFilter.fromArgs(args)
+        for read in readFilter.keptReads(fh.fetch(chrom, start, end), minStart=start):
             total[idx] += 1
 
             # Get blocks, possibly extending
@@ -470,7 +438,7 @@ def getChunkLength(args, chromSize):
 
     bl = None
     if args.blackListFileName:
-        bl = GTF(args.blackListFileName)
+        bl = getBlackList(args.blackListFileName)
 
     lengths = []
     for k, v in chromSize:
@@ -489,9 +457,12 @@ def getChunkLength(args, chromSize):
     return max(1, rv)
 
 
+@restoresSettings
 def main(args=None):
 
     args = parse_arguments().parse_args(args)
+    setExecutor(args.executor)
+    setCheckpointDir(args.checkpointDir, [args.plotFile, args.outRawCounts])
 
     if not args.outRawCounts and not args.plotFile:
         sys.exit("Error: You need to specify at least one of --plotFile or --outRawCounts!\n")
@@ -547,6 +518,9 @@ def main(args=None):
     # Get the chunkLength
     chunkLength = getChunkLength(args, chromSize)
 
+    # the workers read the global gtf, so they have to be forked after it is set
+    closePool()
+
     # Map reduce to get the counts/file/feature
     res = mapReduce([args, defaultFragmentLength],
                     getEnrichment_worker,
@@ -19,6 +19,7 @@ import plotly.graph_objs as go
 import deeptools.countReadsPerBin as countR
 import deeptools.sumCoveragePerBin as sumR
 from deeptools import parserCommon
+from deeptools import mapReduce
 from deeptools.utilities import smartLabels
 
 old_settings = np.seterr(all='ignore')
@@ -364,8 +365,11 @@ def getExpected(mu):
     return (AUC, XInt, elbow)
 
 
+@mapReduce.restoresSettings
 def main(args=None):
     args = process_args(args)
+    mapReduce.setExecutor(args.executor)
+    mapReduce.setCheckpointDir(args.checkpointDir, [args.plotFile, args.outRawCounts, args.outQualityMetrics])
 
     if not args.plotFile and not args.outRawCounts and not args.outQualityMetrics:
         sys.stderr.write("\nAt least one of --plotFile, --outRawCounts or --outQualityMetrics is required.\n")
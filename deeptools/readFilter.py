@@ -0,0 +1,185 @@
+"""
+The read filters shared by the tools: --minMappingQuality,
+--samFlagInclude, --samFlagExclude, --minFragmentLength,
+--maxFragmentLength, --ignoreDuplicates and --filterRNAstrand.
+
+The filters are applied in the order the tools always used: an alignment
+that fails a filter is not seen by the following ones, which matters for
+--ignoreDuplicates, since an alignment only hides the duplicates that
+follow it if it passed the previous filters.
+
+The alignments are filtered one at a time. pysam has no column-level
+access to the fields of a fetch, so copying them into numpy arrays to
+filter a fetch at once still takes one Python call per field and
+alignment, and was 2 to 2.7 times slower than these checks.
+"""
+from deeptools.utilities import getTLen
+
+
+class ReadFilter(object):
+    """
+    The read filters of deepTools. The options are checked once, when the
+    filter is made, and keep tells if an alignment passes them. Since the
+    duplicate filter remembers the alignments it has seen, the alignments of
+    a fetch must be given in order, after a call to reset (keptReads does
+    both).
+
+    counts holds, for all the alignments given to keep so far, the number
+    of alignments ("total"), of unmapped alignments ("unmapped") and of
+    mapped alignments removed by the filters ("filtered").
+
+    >>> import os, pysam
+    >>> root = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+    >>> bam = pysam.AlignmentFile(root + "testB.bam")
+    >>> def nKept(readFilter):
+    ...     return len(list(readFilter.keptReads(bam.fetch('3R', 0, 200))))
+    >>> nKept(ReadFilter())
+    4
+    >>> nKept(ReadFilter(minMappingQuality=40))
+    1
+    >>> nKept(ReadFilter(ignoreDuplicates=True))
+    3
+    >>> readFilter = ReadFilter(minMappingQuality=40, ignoreDuplicates=True)
+    >>> nKept(readFilter)
+    1
+    >>> readFilter.counts
+    {'total': 4, 'unmapped': 0, 'filtered': 3}
+    """
+    def __init__(self, minMappingQuality=None, samFlagInclude=None, samFlagExclude=None,
+                 minFragmentLength=0, maxFragmentLength=0, ignoreDuplicates=False,
+                 filterRNAstrand=None):
+        self.minMappingQuality = minMappingQuality
+        self.samFlagInclude = samFlagInclude
+        self.samFlagExclude = samFlagExclude
+        self.minFragmentLength = minFragmentLength
+        self.maxFragmentLength = maxFragmentLength
+        self.ignoreDuplicates = ignoreDuplicates
+        self.filterRNAstrand = filterRNAstrand
+        self.compile()
+        # the template length is only computed if a filter uses it
+        self.usesTLen = bool(self.minFragmentLength or self.maxFragmentLength or self.ignoreDuplicates)
+        self.counts = dict.fromkeys(["total", "unmapped", "filtered"], 0)
+        self.reset()
+
+    @classmethod
+    def fromArgs(cls, args):
+        """
+        Returns the ReadFilter of the options of a tool (an argparse
+        namespace). Options the tool does not have are not used.
+        """
+        return cls(minMappingQuality=getattr(args, "minMappingQuality", None),
+                   samFlagInclude=getattr(args, "samFlagInclude", None),
+                   samFlagExclude=getattr(args, "samFlagExclude", None),
+                   minFragmentLength=getattr(args, "minFragmentLength", 0),
+                   maxFragmentLength=getattr(args, "maxFragmentLength", 0),
+                   ignoreDuplicates=getattr(args, "ignoreDuplicates", False),
+                   filterRNAstrand=getattr(args, "filterRNAstrand", None))
+
+    def compile(self):
+        """
+        Sets the options that are not used to None, so that keep only
+        checks the filters in use.
+        """
+        if not self.minMappingQuality:
+            self.minMappingQuality = None
+        if not self.samFlagInclude:
+            self.samFlagInclude = None
+        if not self.samFlagExclude:
+            self.samFlagExclude = None
+        if not self.minFragmentLength or self.minFragmentLength <= 0:
+            self.minFragmentLength = None
+        if not self.maxFragmentLength or self.maxFragmentLength <= 0:
+            self.maxFragmentLength = None
+        if not self.ignoreDuplicates:
+            self.ignoreDuplicates = None
+        if self.filterRNAstrand not in ["forward", "reverse"]:
+            self.filterRNAstrand = None
+
+    def reset(self):
+        """
+        Forgets the alignments seen by the duplicate filter, before the
+        alignments of a new fetch.
+        """
+        # the start and the keys of the last alignments seen by the
+        # duplicate filter
+        self.lastStart = None
+        self.lastKeys = set()
+
+    def keptReads(self, reads, minStart=None):
+        """
+        Yields the alignments of a fetch that pass the filters. Alignments
+        starting before minStart are not kept, seen by the duplicate filter
+        or counted.
+        """
+        self.reset()
+        keep = self.keep
+        for read in reads:
+            if minStart is not None and read.reference_start < minStart:
+                continue
+            if keep(read):
+                yield read
+
+    def keep(self, read):
+        """
+        Returns True if read is mapped and passes the filters, and adds it
+        to counts.
+        """
+        counts = self.counts
+        counts["total"] += 1
+        if read.is_unmapped:
+            counts["unmapped"] += 1
+            return False
+        flag = read.flag
+        if self.minMappingQuality and read.mapping_quality < self.minMappingQuality:
+            counts["filtered"] += 1
+            return False
+        if self.samFlagInclude and flag & self.samFlagInclude != self.samFlagInclude:
+            counts["filtered"] += 1
+            return False
+        if self.samFlagExclude and flag & self.samFlagExclude != 0:
+            counts["filtered"] += 1
+            return False
+        if self.usesTLen:
+            tLen = getTLen(read)
+            if self.minFragmentLength and tLen < self.minFragmentLength:
+                counts["filtered"] += 1
+                return False
+            if self.maxFragmentLength and tLen > self.maxFragmentLength:
+                counts["filtered"] += 1
+                return False
+            if self.ignoreDuplicates:
+                # a duplicate has the same start, fragment bounds, mate
+                # chromosome and strand as an earlier alignment. The fragment
+                # ends at the end of the template or, if the mate is on
+                # another chromosome, at the start of the mate
+                start = read.reference_start
+                end = start + tLen
+                if read.reference_id != read.next_reference_id:
+                    end = read.next_reference_start
+                key = (start, end, read.next_reference_id, read.is_reverse)
+                if start != self.lastStart:
+                    self.lastStart = start
+                    self.lastKeys = set()
+                elif key in self.lastKeys:
+                    counts["filtered"] += 1
+                    return False
+                self.lastKeys.add(key)
+        if self.filterRNAstrand and not self.isFromRNAstrand(flag):
+            counts["filtered"] += 1
+            return False
+        return True
+
+    def isFromRNAstrand(self, flag):
+        """
+        Returns True if an alignment comes from the strand given by
+        filterRNAstrand, for a dUTP library: the transcripts of the forward
+        strand have their single-end reads and first mates on the reverse
+        strand and their second mates on the forward strand.
+        """
+        if self.filterRNAstrand == "forward":
+            if flag & 1:
+                return flag & 144 == 128 or flag & 96 == 64
+            return flag & 16 == 16
+        if flag & 1:
+            return flag & 144 == 144 or flag & 96 == 96
+        return flag & 16 == 0
@@ -3,14 +3,40 @@ import multiprocessing
 import time
 
 from deeptools import countReadsPerBin
-from deeptools.utilities import getTLen
-from deeptoolsintervals import GTF
+from deeptools import mapReduce
 
 
 class SumCoveragePerBin(countReadsPerBin.CountReadsPerBin):
     r"""This is an extension of CountReadsPerBin for use with plotFingerprint.
     There, we need to sum the per-base coverage.
     """
+    def get_num_bins(self, regions):
+        """
+        Returns the length of the coverage array for the given regions.
+        Unlike in CountReadsPerBin, a smaller tile at the end of a region
+        is dropped.
+
+        >>> c = SumCoveragePerBin([], 10, 0, stepSize=10)
+        >>> c.get_num_bins([(0, 100, 10), (200, 205, 10)])
+        10
+        """
+        nbins = len(regions)
+        if len(regions[0]) == 3:
+            nbins = 0
+            for reg in regions:
+                nbins += (reg[1] - reg[0]) // reg[2]
+        return nbins
+
+    def get_coverage_of_regions(self, bamHandle, chrom, transcripts,
+                                fragmentFromRead_func=None):
+        """
+        Returns a list with the coverage of each element of transcripts.
+        The per-base coverage, and the bigWig input, are only handled by
+        get_coverage_of_region, so each element is fetched on its own.
+        """
+        return [self.get_coverage_of_region(bamHandle, chrom, trans, fragmentFromRead_func)
+                for trans in transcripts]
+
     def get_coverage_of_region(self, bamHandle, chrom, regions,
                                fragmentFromRead_func=None):
         """
@@ -39,12 +65,7 @@ class SumCoveragePerBin(countReadsPerBin.CountReadsPerBin):
         """
         if not fragmentFromRead_func:
             fragmentFromRead_func = self.get_fragment_from_read
-        nbins = len(regions)
-        if len(regions[0]) == 3:
-            nbins = 0
-            for reg in regions:
-                nbins += (reg[1] - reg[0]) // reg[2]
-        coverages = np.zeros(nbins, dtype='float64')
+        coverages = np.zeros(self.get_num_bins(regions), dtype='float64')
 
         if self.defaultFragmentLength == 'read length':
             extension = 0
@@ -53,7 +74,7 @@ class SumCoveragePerBin(countReadsPerBin.CountReadsPerBin):
 
         blackList = None
         if self.blackListFileName is not None:
-            blackList = GTF(self.blackListFileName)
+            blackList = mapReduce.getBlackList(self.blackListFileName)
 
         vector_start = 0
         for idx, reg in enumerate(regions):
@@ -98,48 +119,8 @@ class SumCoveragePerBin(countReadsPerBin.CountReadsPerBin):
                 else:
                     raise NameError("chromosome {} not found in bigWig file with chroms {}".format(chrom, bamHandle.chroms()))
 
-            prev_pos = set()
-            lpos = None
-            # of previous processed read pair
-            for read in bamHandle.fetch(chrom, regStart, regEnd):
-                if read.is_unmapped:
-                    continue
-                if self.minMappingQuality and read.mapq < self.minMappingQuality:
-                    continue
-
-                # filter reads based on SAM flag
-                if self.samFlag_include and read.flag & self.samFlag_include != self.samFlag_include:
-                    continue
-                if self.samFlag_exclude and read.flag & self.samFlag_exclude != 0:
-                    continue
-
-                # Fragment lengths
-                tLen = getTLen(read)
-                if self.minFragmentLength > 0 and tLen < self.minFragmentLength:
-                    continue
-                if self.maxFragmentLength > 0 and tLen > self.maxFragmentLength:
-                    continue
-
-                # get rid of duplicate reads that have same position on each of the
-                # pairs
-                if self.ignoreDuplicates:
-                    # Assuming more or less concordant reads, use the fragment bounds, otherwise the start positions
-                    if tLen >= 0:
-                        s = read.pos
-                        e = s + tLen
-                    else:
-                        s = read.pnext
-                        e = s - tLen
-                    if read.reference_id != read.next_reference_id:
-                        e = read.pnext
-                    if lpos is not None and lpos == read.reference_start \
-                            and (s, e, read.next_reference_id, read.is_reverse) in prev_pos:
-                        continue
-                    if lpos != read.reference_start:
-                        prev_pos.clear()
-                    lpos = read.reference_start
-                    prev_pos.add((s, e, read.next_reference_id, read.is_reverse))
-
+            readFilter = self.get_read_filter()
+            for read in readFilter.keptReads(bamHandle.fetch(chrom, regStart, regEnd)):
                 # since reads can be split (e.g. RNA-seq reads) each part of the
                 # read that maps is called a position block.
                 try:
@@ -0,0 +1,11 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def no_stats_cache(monkeypatch):
+    """
+    Keeps the tests from using the statistics cache (see
+    bamHandler.StatsCache) of the user. Tests of the cache turn it on with
+    a directory of their own.
+    """
+    monkeypatch.delenv("DEEPTOOLS_STATS_CACHE", raising=False)
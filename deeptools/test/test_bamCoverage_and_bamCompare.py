@@ -1,8 +1,11 @@
 import deeptools.bamCoverage as bam_cov
 import deeptools.bamCompare as bam_comp
 import deeptools.getScaleFactor as gs
+from deeptools.bamHandler import StatsCache
 import os.path
 import filecmp
+import json
+import shutil
 from os import unlink
 
 ROOT = os.path.dirname(os.path.abspath(__file__)) + "/test_data/"
@@ -49,6 +52,69 @@ def test_bam_coverage_arguments():
         unlink(outfile)
 
 
+def test_bam_coverage_binary():
+    """
+    Test --outFileFormat binary, read back like a bigWig file
+    """
+    from deeptools.binaryCoverage import openCoverage
+    outfile = '/tmp/test_file.bin'
+    for fname in [BAMFILE_B, CRAMFILE_B]:
+        args = "--bam {} -o {} --outFileFormat binary".format(fname, outfile).split()
+        bam_cov.main(args)
+
+        bc = openCoverage(outfile)
+        assert bc.chroms('3R') == 200
+        assert bc.values('3R', 40, 60).tolist() == [0.0] * 10 + [1.0] * 10
+        assert bc.stats('3R', 0, 200, nBins=4) == [0.0, 1.0, 1.0, 2.0]
+        bc.close()
+        unlink(outfile)
+
+
+def test_bam_coverage_quantization():
+    """
+    Test --quantizationStep, which merges bins that become equal
+    """
+    outfile = '/tmp/test_file.bg'
+    for fname in [BAMFILE_B, CRAMFILE_B]:
+        args = "--bam {} -o {} --outFileFormat bedgraph --scaleFactor 0.5 " \
+               "--quantizationStep 2".format(fname, outfile).split()
+        bam_cov.main(args)
+
+        _foo = open(outfile, 'r')
+        resp = _foo.readlines()
+        _foo.close()
+        # the values 0, 0.5, 0.5 and 1 are rounded to multiples of 1
+        expected = ['3R\t0\t150\t0\n', '3R\t150\t200\t1\n']
+        assert f"{resp}" == f"{expected}", f"{resp} != {expected}"
+        unlink(outfile)
+
+
+def test_bam_coverage_significant_digits():
+    """
+    Test --significantDigits, which can be at most the 6 digits kept by
+    the output files
+    """
+    outfile = '/tmp/test_file.bg'
+    args = "--bam {} -o {} --outFileFormat bedgraph --scaleFactor 0.3333333 " \
+           "--significantDigits 2".format(BAMFILE_B, outfile).split()
+    bam_cov.main(args)
+    _foo = open(outfile, 'r')
+    resp = _foo.readlines()
+    _foo.close()
+    expected = ['3R\t0\t50\t0\n', '3R\t50\t150\t0.33\n', '3R\t150\t200\t0.67\n']
+    assert f"{resp}" == f"{expected}", f"{resp} != {expected}"
+    unlink(outfile)
+
+    for digits in ["0", "8"]:
+        args[-1] = digits
+        try:
+            bam_cov.main(args)
+            assert False, "--significantDigits {} was accepted".format(digits)
+        except SystemExit:
+            pass
+    assert not os.path.exists(outfile)
+
+
 def test_bam_coverage_extend():
     outfile = '/tmp/test_file.bg'
     for fname in [BAMFILE_B, CRAMFILE_B]:
@@ -361,6 +427,36 @@ def test_bam_coverage_filter_blacklist():
         unlink(outfile)
 
 
+def test_bam_coverage_filter_blacklist_stats_cache(tmp_path, monkeypatch):
+    """
+    Test --blackListFileName with the statistics cache turned on: the
+    fraction of kept reads is stored in the statistics file of the BAM
+    file and read from it by the second run
+    """
+    monkeypatch.setenv("DEEPTOOLS_STATS_CACHE", str(tmp_path / "cache"))
+    fname = str(tmp_path / "test_filtering.bam")
+    shutil.copy(BAMFILE_FILTER1, fname)
+    shutil.copy(BAMFILE_FILTER1 + ".bai", fname + ".bai")
+    outfile = str(tmp_path / "test_file_filter.bg")
+    args = "--bam {} --normalizeUsing RPGC --effectiveGenomeSize 1400 -p 1 -o {} -of bedgraph --samFlagInclude 512 " \
+           "--samFlagExclude 256 --minMappingQuality 5 --ignoreDuplicates " \
+           "--blackListFileName {}".format(fname, outfile, BEDFILE_FILTER).split()
+    for _ in range(2):
+        bam_cov.main(args)
+        _foo = open(outfile, 'r')
+        resp = _foo.readlines()
+        _foo.close()
+        assert resp[1] == '3R\t100\t150\t1.42338\n'
+        assert resp[4] == '3R\t300\t400\t2.23675\n'
+
+    _foo = open(StatsCache(fname).cacheFileName)
+    stats = json.load(_foo)["stats"]
+    _foo.close()
+    names = [x for x in stats if x.startswith("fractionKept")]
+    assert len(names) == 1
+    assert BEDFILE_FILTER in names[0]
+
+
 def test_bam_coverage_offset1():
     """
     Test -bs 1 --Offset 1
@@ -379,6 +475,53 @@ def test_bam_coverage_offset1():
         unlink(outfile)
 
 
+def test_bam_coverage_zoom_levels():
+    """
+    Test --zoomLevels 0, which gives the same values without zoom levels
+    """
+    import pyBigWig
+    outfile = '/tmp/test_zoom.bw'
+    args = "--Offset 1 --bam {} -p 1 -bs 1 --zoomLevels 0 -o {}".format(BAMFILE_A, outfile).split()
+    bam_cov.main(args)
+    bw = pyBigWig.open(outfile)
+    expected = pyBigWig.open("{}testA_offset1.bw".format(ROOT))
+    assert bw.header()['nLevels'] == 0
+    assert bw.intervals('3R') == expected.intervals('3R')
+    bw.close()
+    expected.close()
+    unlink(outfile)
+
+
+def test_bam_coverage_incremental():
+    """
+    Test that --incremental recomputes only the chromosomes asked for and
+    gives the same values
+    """
+    import pyBigWig
+    outfile = '/tmp/test_incremental.bw'
+    # the files of a previous failed run
+    for fname in [outfile, outfile + ".provenance.json"]:
+        if os.path.exists(fname):
+            unlink(fname)
+    args = "--Offset 1 --bam {} -p 1 -bs 1 --incremental -o {}".format(BAMFILE_A, outfile).split()
+    bam_cov.main(args)
+    assert filecmp.cmp(outfile, "{}testA_offset1.bw".format(ROOT)) is True
+    mtime = os.path.getmtime(outfile)
+    # nothing changed
+    bam_cov.main(args)
+    assert os.path.getmtime(outfile) == mtime
+    bam_cov.main(args + ["--recomputeChroms", "3R"])
+    bw = pyBigWig.open(outfile)
+    expected = pyBigWig.open("{}testA_offset1.bw".format(ROOT))
+    assert bw.chroms() == expected.chroms()
+    for chrom in expected.chroms():
+        assert bw.intervals(chrom) == expected.intervals(chrom)
+    bw.close()
+    expected.close()
+    unlink(outfile)
+    unlink(outfile + ".provenance.json")
+
+
 def test_bam_coverage_offset1_10():
     """
     Test -bs 1 --Offset 1 10
@@ -433,6 +576,129 @@ def test_bam_coverage_offset20_minus4():
         unlink(outfile)
 
 
+def test_bam_coverage_extra_output():
+    """
+    Test that --extraOutput gives the same files as separate runs
+    """
+    outfile = '/tmp/test_file.bg'
+    expected_outfile = '/tmp/test_file_expected.bg'
+    for fname in [BAMFILE_A, CRAMFILE_A]:
+        args = "-b {} -p 1 -bs 50 -of bedgraph -o {}".format(fname, expected_outfile).split()
+        bam_cov.main(args)
+        args = "-b {} -p 1 -bs 50 -of bedgraph -o {}".format(fname, outfile).split()
+        args += ["--extraOutput=-o /tmp/test_offset.bw -of bigwig -bs 1 --Offset -1",
+                 "--extraOutput=-o /tmp/test_offset20.bw -of bigwig -bs 1 --Offset 20 -4"]
+        bam_cov.main(args)
+        try:
+            # python 3 only
+            filecmp.clear_cache()
+        except:
+            pass
+        assert filecmp.cmp(outfile, expected_outfile) is True
+        assert filecmp.cmp('/tmp/test_offset.bw', "{}testA_offset-1.bw".format(ROOT)) is True
+        assert filecmp.cmp('/tmp/test_offset20.bw', "{}testA_offset20_-4.bw".format(ROOT)) is True
+        for x in [outfile, expected_outfile, '/tmp/test_offset.bw', '/tmp/test_offset20.bw']:
+            unlink(x)
+
+
+def test_bam_coverage_exact_scaling():
+    """
+    Test that the reads counted by --exactScaling while computing the coverage
+    give the same file as counting them beforehand, which is done with --extraOutput
+    """
+    outfile = '/tmp/test_file_filter.bg'
+    expected_outfile = '/tmp/test_file_filter_expected.bg'
+    extra_outfile = '/tmp/test_file_filter_extra.bg'
+    for fname in [BAMFILE_FILTER1, CRAMFILE_FILTER1]:
+        for blacklist in [[], ["--blackListFileName", BEDFILE_FILTER]]:
+            args = "--bam {} --normalizeUsing CPM --exactScaling -p 1 -of bedgraph --samFlagInclude 512 " \
+                   "--samFlagExclude 256 --minMappingQuality 5 --ignoreDuplicates".format(fname).split() + blacklist
+            bam_cov.main(args + ["-o", outfile])
+            bam_cov.main(args + ["-o", expected_outfile, "--extraOutput=-o {}".format(extra_outfile)])
+            try:
+                # python 3 only
+                filecmp.clear_cache()
+            except:
+                pass
+            assert filecmp.cmp(outfile, expected_outfile) is True
+            assert filecmp.cmp(outfile, extra_outfile) is True
+            for x in [outfile, expected_outfile, extra_outfile]:
+                unlink(x)
+
+
+def test_bam_compare_counts_file():
+    """
+    Test that the output computed from --countsFile is that of a run without it,
+    and that the counts file is reused for another operation
+    """
+    outfile = '/tmp/test_file.bg'
+    expected_outfile = '/tmp/test_file_expected.bg'
+    counts_file = '/tmp/test_file.counts'
+    for A, B in [(BAMFILE_A, BAMFILE_B), (CRAMFILE_A, CRAMFILE_B)]:
+        for operation in ['log2', 'ratio']:
+            args = "-b1 {} -b2 {} -p 1 -bs 50 -of bedgraph --operation {}".format(A, B, operation).split()
+            bam_comp.main(args + ["-o", expected_outfile])
+            bam_comp.main(args + ["-o", outfile, "--countsFile", counts_file])
+            if operation == 'log2':
+                mtime = os.path.getmtime(counts_file)
+            else:
+                assert os.path.getmtime(counts_file) == mtime
+            try:
+                # python 3 only
+                filecmp.clear_cache()
+            except:
+                pass
+            assert filecmp.cmp(outfile, expected_outfile) is True
+            unlink(outfile)
+            unlink(expected_outfile)
+        unlink(counts_file)
+
+
+def test_bam_compare_counts_file_blacklist():
+    """
+    Test --countsFile together with the filters and --blackListFileName
+    """
+    outfile = '/tmp/test_file_filter.bg'
+    expected_outfile = '/tmp/test_file_filter_expected.bg'
+    counts_file = '/tmp/test_file_filter.counts'
+    for operation in ['log2', 'ratio']:
+        args = "-b1 {} -b2 {} -p 1 -of bedgraph --samFlagInclude 512 --samFlagExclude 256 " \
+               "--minMappingQuality 5 --ignoreDuplicates --blackListFileName {} " \
+               "--operation {}".format(BAMFILE_FILTER1, BAMFILE_FILTER2, BEDFILE_FILTER, operation).split()
+        bam_comp.main(args + ["-o", expected_outfile])
+        bam_comp.main(args + ["-o", outfile, "--countsFile", counts_file])
+        if operation == 'log2':
+            mtime = os.path.getmtime(counts_file)
+        else:
+            assert os.path.getmtime(counts_file) == mtime
+        filecmp.clear_cache()
+        assert filecmp.cmp(outfile, expected_outfile) is True
+        unlink(outfile)
+        unlink(expected_outfile)
+    unlink(counts_file)
+
+
+def test_bam_compare_counts_file_filters():
+    """
+    Test that --countsFile with filters gives the output of a run without
+    it, with and without --exactScaling
+    """
+    outfile = '/tmp/test_file_filter.bg'
+    expected_outfile = '/tmp/test_file_filter_expected.bg'
+    counts_file = '/tmp/test_file_filter.counts'
+    for exactScaling in [[], ["--exactScaling"]]:
+        args = "-b1 {} -b2 {} -p 1 -of bedgraph --samFlagInclude 512 --samFlagExclude 256 " \
+               "--minMappingQuality 5 --ignoreDuplicates --scaleFactorsMethod None " \
+               "--normalizeUsing CPM".format(BAMFILE_FILTER1, BAMFILE_FILTER2).split() + exactScaling
+        bam_comp.main(args + ["-o", expected_outfile])
+        bam_comp.main(args + ["-o", outfile, "--countsFile", counts_file])
+        filecmp.clear_cache()
+        assert filecmp.cmp(outfile, expected_outfile) is True
+        unlink(outfile)
+        unlink(expected_outfile)
+        unlink(counts_file)
+
+
 def test_bam_compare_filter_blacklist():
     """
     Test --samFlagInclude --samFlagExclude --minMappingQuality --ignoreDuplicates and --blackListFileName
@@ -0,0 +1,108 @@
+import json
+import os.path
+import shutil
+import pytest
+
+from deeptools.bamHandler import StatsCache, fileKey
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + "/test_data/"
+BAMFILE_A = ROOT + "testA.bam"
+BEDFILE_FILTER = ROOT + "test_filtering.blacklist.bed"
+PARAMETERS = {"minMappingQuality": 10, "blackListFile": fileKey([BEDFILE_FILTER])}
+
+
+@pytest.fixture
+def bam(tmp_path, monkeypatch):
+    """
+    A copy of testA.bam and its index, with the statistics cache turned on
+    """
+    monkeypatch.setenv("DEEPTOOLS_STATS_CACHE", str(tmp_path / "cache"))
+    fname = str(tmp_path / "testA.bam")
+    shutil.copy(BAMFILE_A, fname)
+    shutil.copy(BAMFILE_A + ".bai", fname + ".bai")
+    return fname
+
+
+def test_stats_cache_hit(bam):
+    assert StatsCache(bam).get("fractionKept", PARAMETERS) is None
+    StatsCache(bam).set("fractionKept", PARAMETERS, 0.5)
+    assert os.path.exists(StatsCache(bam).cacheFileName)
+    # nothing is written next to the BAM file
+    assert not os.path.exists(bam + ".dtstats")
+    assert StatsCache(bam).get("fractionKept", PARAMETERS) == 0.5
+    # other statistics are kept when one is added
+    StatsCache(bam).set("mappingStats", None, [1, 2])
+    assert StatsCache(bam).get("fractionKept", PARAMETERS) == 0.5
+    assert StatsCache(bam).get("mappingStats") == [1, 2]
+
+
+def test_stats_cache_miss_mtime(bam):
+    StatsCache(bam).set("fractionKept", PARAMETERS, 0.5)
+    st = os.stat(bam)
+    os.utime(bam, (st.st_atime, st.st_mtime + 10))
+    assert StatsCache(bam).get("fractionKept", PARAMETERS) is None
+
+
+def test_stats_cache_miss_size(bam):
+    StatsCache(bam).set("fractionKept", PARAMETERS, 0.5)
+    st = os.stat(bam)
+    with open(bam, "ab") as f:
+        f.write(b"\0")
+    # the same modification time, only the size changes
+    os.utime(bam, (st.st_atime, st.st_mtime))
+    assert StatsCache(bam).get("fractionKept", PARAMETERS) is None
+
+
+def test_stats_cache_miss_index(bam):
+    StatsCache(bam).set("fractionKept", PARAMETERS, 0.5)
+    with open(bam + ".bai", "ab") as f:
+        f.write(b"\0")
+    assert StatsCache(bam).get("fractionKept", PARAMETERS) is None
+
+
+def test_stats_cache_miss_parameters(bam):
+    StatsCache(bam).set("fractionKept", PARAMETERS, 0.5)
+    parameters = dict(PARAMETERS, minMappingQuality=20)
+    assert StatsCache(bam).get("fractionKept", parameters) is None
+    parameters = dict(PARAMETERS, blackListFile=None)
+    assert StatsCache(bam).get("fractionKept", parameters) is None
+    assert StatsCache(bam).get("readAndFragmentLength", PARAMETERS) is None
+
+
+def test_stats_cache_other_directory(bam, tmp_path):
+    StatsCache(bam).set("fractionKept", PARAMETERS, 0.5)
+    os.mkdir(str(tmp_path / "other"))
+    other = str(tmp_path / "other" / "testA.bam")
+    shutil.copy(bam, other)
+    shutil.copy(bam + ".bai", other + ".bai")
+    assert StatsCache(other).cacheFileName != StatsCache(bam).cacheFileName
+    assert StatsCache(other).get("fractionKept", PARAMETERS) is None
+
+
+def test_stats_cache_corrupt(bam):
+    os.makedirs(os.path.dirname(StatsCache(bam).cacheFileName))
+    with open(StatsCache(bam).cacheFileName, "w") as f:
+        f.write('{"key": ')
+    assert StatsCache(bam).get("fractionKept", PARAMETERS) is None
+    # the corrupt file is replaced
+    StatsCache(bam).set("fractionKept", PARAMETERS, 0.5)
+    assert StatsCache(bam).get("fractionKept", PARAMETERS) == 0.5
+    with open(StatsCache(bam).cacheFileName) as f:
+        assert json.load(f)["key"]["size"] == os.path.getsize(bam)
+
+
+def test_stats_cache_disabled(bam, monkeypatch, tmp_path):
+    monkeypatch.delenv("DEEPTOOLS_STATS_CACHE")
+    StatsCache(bam).set("fractionKept", PARAMETERS, 0.5)
+    assert StatsCache(bam).get("fractionKept", PARAMETERS) is None
+    assert not os.path.exists(str(tmp_path / "cache"))
+
+
+def test_file_key_blacklists():
+    """
+    --blackListFileName takes several files
+    """
+    key = fileKey(BEDFILE_FILTER)
+    assert key[0] == BEDFILE_FILTER
+    assert fileKey([BEDFILE_FILTER, BEDFILE_FILTER]) == [key, key]
+    assert fileKey(None) is None
@@ -113,6 +113,14 @@ class TestCountReadsPerBin():
         nt.assert_equal(resp, np.array([[0, 1.],
                                         [0, 2.]]).T)
 
+    def test_get_smooth_coverage(self, bc):
+        c, bamFile1, bamFile2, bamFile_PE, chrom, step_size, bin_length = self.ifiles(bc)
+        coverage = np.array([[0, 1, 2, 5, 3, np.nan, 1, 0, 4, 4, 2.]]).T
+        for smoothRange in [10, 20, 30, 45, 60]:
+            expected = [np.mean(coverage[slice(*c.getSmoothRange(x, 10, smoothRange, 11))], axis=0)
+                        for x in range(11)]
+            nt.assert_equal(c.getSmoothCoverage(coverage, 10, smoothRange), np.array(expected))
+
     def test_get_coverage_of_region_sam_flag_include(self, bc):
         c, bamFile1, bamFile2, bamFile_PE, chrom, step_size, bin_length = self.ifiles(bc)
         c.samFlag_include = 16  # include reverse reads only
@@ -207,3 +215,59 @@ class TestCountReadsPerBin():
 
         import os
         os.unlink(bed_file.name)
+
+    def test_run_shared_memory(self, bc):
+        c, bamFile1, bamFile2, bamFile_PE, chrom, step_size, bin_length = self.ifiles(bc)
+        for binLength, stepSize in [(25, 50), (30, 30)]:
+            # several chunks, so that the workers write into the shared matrix
+            c = cr.CountReadsPerBin([bamFile1, bamFile2], binLength=binLength,
+                                    stepSize=stepSize, genomeChunkSize=60,
+                                    numberOfProcessors=2)
+            resp = c.run()
+            c = cr.CountReadsPerBin([bamFile1, bamFile2], binLength=binLength,
+                                    stepSize=stepSize, genomeChunkSize=60,
+                                    numberOfProcessors=1)
+            nt.assert_equal(resp, c.run())
+        nt.assert_equal(resp[:, 1], np.array([0, 1, 1, 2, 1, 2, 2.]))
+
+
+def test_get_coverage_of_regions_single_fetch():
+    """
+    Fetching the reads once for all regions gives the same coverage
+    as fetching them for each region. Only the BAM file is used, since
+    decoding test_paired2.cram needs the chr2 sequence, which is not in
+    test_data.
+    """
+    import pysam
+    bamFile_PE = os.path.dirname(os.path.abspath(__file__)) + "/test_data/test_paired2.bam"
+    c = cr.CountReadsPerBin([], stepSize=1, extendReads=300)
+    regions = [[(5000000, 5000050)], [(5000090, 5000100), (5000100, 5000110)],
+               [(5000800, 5000900, 10)], [(5001000, 5001010)]]
+    bam = pysam.AlignmentFile(bamFile_PE)
+    resp = c.get_coverage_of_regions(bam, 'chr2', regions)
+    for trans, tcov in zip(regions, resp):
+        nt.assert_equal(tcov, c.get_coverage_of_region(bam, 'chr2', trans))
+
+
+def test_get_coverage_of_regions_sparse_fetches(monkeypatch):
+    """
+    The regions far apart, like sampled bins, are fetched on their own,
+    while those closer than binLength share a fetch.
+    """
+    import pysam
+    bamFile_PE = os.path.dirname(os.path.abspath(__file__)) + "/test_data/test_paired2.bam"
+    c = cr.CountReadsPerBin([], binLength=10, stepSize=10000, extendReads=300)
+    fetches = []
+    get_fragments_of_reads = c.get_fragments_of_reads
+
+    def counted(bamHandle, chrom, regStart, regEnd, func):
+        fetches.append((regStart, regEnd))
+        return get_fragments_of_reads(bamHandle, chrom, regStart, regEnd, func)
+    monkeypatch.setattr(c, "get_fragments_of_reads", counted)
+    regions = [[(5000000, 5000010)], [(5000010, 5000020)], [(5010000, 5010010)], [(5020000, 5020010)]]
+    bam = pysam.AlignmentFile(bamFile_PE)
+    resp = c.get_coverage_of_regions(bam, 'chr2', regions)
+    assert len(fetches) == 3
+    monkeypatch.undo()
+    for trans, tcov in zip(regions, resp):
+        nt.assert_equal(tcov, c.get_coverage_of_region(bam, 'chr2', trans))
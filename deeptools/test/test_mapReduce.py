@@ -0,0 +1,267 @@
+import os
+import tempfile
+
+import deeptools.mapReduce as mr
+
+
+def chunk_and_pid(args):
+    chrom, start, end = args
+    return chrom, start, end, os.getpid()
+
+
+def test_pool_is_reused():
+    chrom_sizes = [('chr1', 1000), ('chr2', 500)]
+    res1 = mr.mapReduce([], chunk_and_pid, chrom_sizes, genomeChunkLength=100, numberOfProcessors=2)
+    pool = mr._pool
+    res2 = mr.mapReduce([], chunk_and_pid, chrom_sizes, genomeChunkLength=100, numberOfProcessors=2)
+    assert pool is not None
+    assert mr._pool is pool
+    assert sorted(x[:3] for x in res1) == sorted(x[:3] for x in res2)
+    assert len(res1) == 15
+    # only the two pooled workers did the work, twice
+    assert len(set(x[3] for x in res1 + res2)) <= 2
+    mr.closePool()
+    assert mr._pool is None
+
+
+def test_pool_restarted_for_other_size():
+    mr.getPool(2)
+    pool = mr._pool
+    mr.getPool(3)
+    assert mr._pool is not pool
+    assert mr._poolSize == 3
+    mr.closePool()
+
+
+def test_imapReduce_genome_order():
+    chrom_sizes = [('chr2', 1000), ('chr1', 750)]
+    tasks, _ = mr.getTasks([], chrom_sizes, genomeChunkLength=100)
+    res = mr.imapReduce([], chunk_and_pid, chrom_sizes, genomeChunkLength=100,
+                        numberOfProcessors=2, maxInFlight=3)
+    assert not isinstance(res, list)
+    res = list(res)
+    assert [x[:3] for x in res] == tasks
+    assert res[0][:3] == ('chr2', 0, 100)
+    assert res[-1][:3] == ('chr1', 700, 750)
+
+
+def dense_chr1(chrom, start, end):
+    # chr1:200-300 is 50 times denser than the rest of the genome
+    return (end - start) + 49 * max(0, min(end, 300) - max(start, 200)) if chrom == 'chr1' else end - start
+
+
+def test_getTasks_balances_chunk_cost():
+    chrom_sizes = [('chr1', 1000), ('chr2', 500)]
+    tasks, _ = mr.getTasks([], chrom_sizes, genomeChunkLength=100,
+                           chunkCost=dense_chr1, tileSize=10)
+    # the dense chunk is split at multiples of the tile size
+    assert ('chr1', 200, 210) in tasks
+    assert all(x[1] % 10 == 0 for x in tasks)
+    # the cheap ones are merged, but not across chromosomes
+    assert ('chr2', 0, 400) in tasks
+    # the genome is still covered once, in order
+    assert sum(x[2] - x[1] for x in tasks) == 1500
+    assert sorted(tasks, key=lambda x: (x[0] != 'chr1', x[1])) == tasks
+
+
+def test_mapReduce_largest_cost_first():
+    chrom_sizes = [('chr1', 1000), ('chr2', 500)]
+    res = mr.mapReduce([], chunk_and_pid, chrom_sizes, genomeChunkLength=100,
+                       numberOfProcessors=2, chunkCost=dense_chr1)
+    assert res[0][:3] == ('chr1', 200, 300)
+    assert len(res) == 15
+    mr.closePool()
+
+
+class RecordingPool(object):
+    """
+    A pool running the tasks at once and recording the order they are sent in.
+    """
+    def __init__(self):
+        self.sent = []
+
+    def apply_async(self, func, args):
+        self.sent.append(args[0])
+        res = func(*args)
+
+        class Result(object):
+            def get(self, timeout):
+                return res
+        return Result()
+
+
+def test_imapTasks_largest_cost_first(monkeypatch):
+    pool = RecordingPool()
+    monkeypatch.setattr(mr, "getPool", lambda n: pool)
+    tasks, _ = mr.getTasks([], [('chr1', 1000), ('chr2', 500)], genomeChunkLength=100)
+    res = list(mr.imapTasks(chunk_and_pid, tasks, numberOfProcessors=2,
+                            taskCost=lambda x: dense_chr1(*x)))
+    assert pool.sent[0] == ('chr1', 200, 300)
+    assert sorted(pool.sent) == sorted(tasks)
+    # the results are still in the order of the tasks
+    assert [x[:3] for x in res] == tasks
+
+
+def test_getBlackList_is_cached(tmp_path):
+    blackListFileName = str(tmp_path / "blacklist.bed")
+    with open(blackListFileName, "w") as f:
+        f.write("chr1\t100\t200\n")
+    bl = mr.getBlackList(blackListFileName)
+    assert mr.getBlackList(blackListFileName) is bl
+    assert mr.getBlackList([blackListFileName]) is bl
+    assert mr.getBlackList(None) is None
+
+    # a modified file is parsed again
+    with open(blackListFileName, "w") as f:
+        f.write("chr1\t300\t400\n")
+    os.utime(blackListFileName, (0, 0))
+    bl2 = mr.getBlackList(blackListFileName)
+    assert bl2 is not bl
+    assert bl2.findOverlaps('chr1', 300, 400)
+
+
+def test_getFileHandle_lru(tmp_path, monkeypatch):
+    fileNames = []
+    for i in range(3):
+        fileNames.append(str(tmp_path / "{}.txt".format(i)))
+        with open(fileNames[-1], "w") as f:
+            f.write("{}\n".format(i))
+    monkeypatch.setattr(mr, "maxFileHandles", 2)
+    fh0 = mr.getFileHandle(open, fileNames[0])
+    assert mr.getFileHandle(open, fileNames[0]) is fh0
+    fh1 = mr.getFileHandle(open, fileNames[1])
+    # fileNames[0] was used last, so fileNames[1] is closed
+    assert mr.getFileHandle(open, fileNames[0]) is fh0
+    mr.getFileHandle(open, fileNames[2])
+    assert fh1.closed
+    assert not fh0.closed
+    # other open options give another handle
+    assert mr.getFileHandle(open, fileNames[0], "rb") is not fh0
+    mr._dropFileHandles()
+
+
+def test_thread_executor():
+    chrom_sizes = [('chr1', 1000), ('chr2', 500)]
+    mr.setExecutor("threads")
+    try:
+        res = mr.mapReduce([], chunk_and_pid, chrom_sizes, genomeChunkLength=100, numberOfProcessors=2)
+        assert mr._poolExecutor == ("threads", None)
+    finally:
+        mr.setExecutor("processes")
+    assert mr._pool is None
+    assert len(res) == 15
+    # the threads run in this process
+    assert set(x[3] for x in res) == {os.getpid()}
+
+
+def test_restoresSettings():
+    @mr.restoresSettings
+    def main(executor, checkpointDir):
+        mr.setExecutor(executor)
+        mr.setCheckpointDir(checkpointDir)
+        assert mr._executor == "threads"
+        raise RuntimeError()
+    try:
+        main("threads", tempfile.mkdtemp())
+    except RuntimeError:
+        pass
+    assert mr._executor == "processes"
+    assert mr._checkpointDir is None
+
+
+def test_filequeue_executor(tmp_path):
+    chrom_sizes = [('chr2', 1000), ('chr1', 750)]
+    tasks, _ = mr.getTasks([], chrom_sizes, genomeChunkLength=100)
+    mr.setExecutor("filequeue:{}".format(tmp_path))
+    try:
+        # with one processor the tasks still go to the (local) workers
+        res = list(mr.imapReduce([], chunk_and_pid, chrom_sizes, genomeChunkLength=100,
+                                 numberOfProcessors=1))
+    finally:
+        mr.setExecutor("processes")
+    assert [x[:3] for x in res] == tasks
+    assert os.getpid() not in set(x[3] for x in res)
+    assert os.listdir(str(tmp_path / "tasks")) == []
+    assert os.listdir(str(tmp_path / "results")) == []
+
+
+calls = []
+
+
+def chunk_to_file(args):
+    chrom, start, end = args
+    calls.append((chrom, start))
+    _file = tempfile.NamedTemporaryFile(prefix="_deeptools_", suffix=".bg", delete=False, mode="w")
+    _file.write("{}\t{}\t{}\t1\n".format(chrom, start, end))
+    _file.close()
+    return chrom, start, _file.name
+
+
+def chunk_with_files(args):
+    chrom, start, end, inFile, outFile = args
+    calls.append((chrom, start))
+    return chrom, start
+
+
+def test_checkpoint_output_files(tmp_path):
+    """
+    The saved results depend on the input files, but not on the output
+    files given to setCheckpointDir.
+    """
+    inFile = str(tmp_path / "in.txt")
+    outFile = str(tmp_path / "out.txt")
+    for fname in [inFile, outFile]:
+        with open(fname, "w") as f:
+            f.write("1\n")
+    tasks = [('chr1', 0, 100, inFile, outFile), ('chr1', 100, 200, inFile, outFile)]
+    mr.setCheckpointDir(str(tmp_path / "checkpoints"), [outFile])
+    try:
+        del calls[:]
+        list(mr.imapTasks(chunk_with_files, tasks, numberOfProcessors=1))
+        assert len(calls) == 2
+        # a failed run left a partial output behind
+        with open(outFile, "w") as f:
+            f.write("partial\n")
+        del calls[:]
+        list(mr.imapTasks(chunk_with_files, tasks, numberOfProcessors=1))
+        assert calls == []
+        # but the input changed
+        with open(inFile, "w") as f:
+            f.write("2\n")
+        list(mr.imapTasks(chunk_with_files, tasks, numberOfProcessors=1))
+        assert len(calls) == 2
+    finally:
+        mr.setCheckpointDir(None)
+
+
+def test_checkpoint_resume(tmp_path):
+    chrom_sizes = [('chr1', 1000), ('chr2', 500)]
+    mr.setCheckpointDir(str(tmp_path))
+    try:
+        del calls[:]
+        res1 = list(mr.imapReduce([], chunk_to_file, chrom_sizes, genomeChunkLength=100,
+                                  numberOfProcessors=1))
+        assert len(calls) == 15
+        for _, _, fname in res1:
+            os.remove(fname)
+
+        # the second run reuses the saved results and temporary files
+        del calls[:]
+        res2 = list(mr.imapReduce([], chunk_to_file, chrom_sizes, genomeChunkLength=100,
+                                  numberOfProcessors=1))
+        assert calls == []
+        assert [x[:2] for x in res2] == [x[:2] for x in res1]
+        for chrom, start, fname in res2:
+            with open(fname) as f:
+                assert f.read().startswith("{}\t{}\t".format(chrom, start))
+            os.remove(fname)
+
+        # other parameters give other tasks, but chr2:400-500 is the same
+        res3 = list(mr.imapReduce([], chunk_to_file, chrom_sizes, genomeChunkLength=200,
+                                  numberOfProcessors=1))
+        assert len(calls) == 7
+        assert ('chr2', 400) not in calls
+        for _, _, fname in res3:
+            os.remove(fname)
+    finally:
+        mr.setCheckpointDir(None)
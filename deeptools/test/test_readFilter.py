@@ -0,0 +1,138 @@
+import os.path
+
+import pysam
+import pytest
+
+from deeptools.readFilter import ReadFilter
+from deeptools.utilities import getTLen
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + "/test_data/"
+PAIRED_BAMS = [ROOT + "test_paired2.bam", ROOT + "test_proper_pair_filtering.bam"]
+BAMS = PAIRED_BAMS + [ROOT + "test_filtering2.bam"]
+
+OPTIONS = [dict(),
+           dict(ignoreDuplicates=True),
+           dict(minMappingQuality=20, ignoreDuplicates=True),
+           dict(samFlagInclude=2, ignoreDuplicates=True),
+           dict(samFlagExclude=16, ignoreDuplicates=True),
+           dict(samFlagExclude=512, filterRNAstrand="forward"),
+           dict(minFragmentLength=150, maxFragmentLength=300, ignoreDuplicates=True),
+           dict(ignoreDuplicates=True, filterRNAstrand="forward"),
+           dict(ignoreDuplicates=True, filterRNAstrand="reverse"),
+           dict(minMappingQuality=20, samFlagInclude=64, samFlagExclude=256, minFragmentLength=100,
+                maxFragmentLength=1000, ignoreDuplicates=True, filterRNAstrand="reverse")]
+
+
+def perReadFilter(reads, minStart=0, minMappingQuality=None, samFlagInclude=None, samFlagExclude=None,
+                  minFragmentLength=0, maxFragmentLength=0, ignoreDuplicates=False, filterRNAstrand=None):
+    """
+    The filter chain of alignmentSieve before ReadFilter, returning the
+    kept alignments and the number of alignments filtered (with the unmapped
+    ones).
+    """
+    kept = []
+    nFiltered = 0
+    prev_pos = set()
+    lpos = None
+    for read in reads:
+        if read.pos < minStart:
+            continue
+        if read.flag & 4:
+            nFiltered += 1
+            continue
+        if minMappingQuality and read.mapq < minMappingQuality:
+            nFiltered += 1
+            continue
+        if samFlagInclude and read.flag & samFlagInclude != samFlagInclude:
+            nFiltered += 1
+            continue
+        if samFlagExclude and read.flag & samFlagExclude != 0:
+            nFiltered += 1
+            continue
+        tLen = getTLen(read)
+        if minFragmentLength > 0 and tLen < minFragmentLength:
+            nFiltered += 1
+            continue
+        if maxFragmentLength > 0 and tLen > maxFragmentLength:
+            nFiltered += 1
+            continue
+        if ignoreDuplicates:
+            if tLen >= 0:
+                s = read.pos
+                e = s + tLen
+            else:
+                s = read.pnext
+                e = s - tLen
+            if read.reference_id != read.next_reference_id:
+                e = read.pnext
+            if lpos is not None and lpos == read.reference_start \
+                    and (s, e, read.next_reference_id, read.is_reverse) in prev_pos:
+                nFiltered += 1
+                continue
+            if lpos != read.reference_start:
+                prev_pos.clear()
+            lpos = read.reference_start
+            prev_pos.add((s, e, read.next_reference_id, read.is_reverse))
+        if filterRNAstrand:
+            if read.is_paired:
+                if filterRNAstrand == 'forward':
+                    passes = read.flag & 144 == 128 or read.flag & 96 == 64
+                else:
+                    passes = read.flag & 144 == 144 or read.flag & 96 == 96
+            else:
+                if filterRNAstrand == 'forward':
+                    passes = read.flag & 16 == 16
+                else:
+                    passes = read.flag & 16 == 0
+            if not passes:
+                nFiltered += 1
+                continue
+        kept.append(read)
+    return kept, nFiltered
+
+
+def chunks(bam, chunkSize):
+    """
+    The (chrom, start, end) of consecutive chunks of the chromosomes of bam,
+    from the first alignment of each chromosome to its end.
+    """
+    for chrom, length in zip(bam.references, bam.lengths):
+        first = min([x.reference_start for x in bam.fetch(chrom)] or [0])
+        for start in range(first, length, chunkSize):
+            yield chrom, start, min(start + chunkSize, length)
+
+
+@pytest.mark.parametrize("bamFile", BAMS)
+@pytest.mark.parametrize("options", OPTIONS)
+def test_read_filter_matches_per_read_filters(bamFile, options):
+    bam = pysam.AlignmentFile(bamFile)
+    for chrom in bam.references:
+        expected, nFiltered = perReadFilter(bam.fetch(chrom), **options)
+        readFilter = ReadFilter(**options)
+        kept = list(readFilter.keptReads(bam.fetch(chrom)))
+        assert [x.to_string() for x in kept] == [x.to_string() for x in expected]
+        assert readFilter.counts["unmapped"] + readFilter.counts["filtered"] == nFiltered
+        assert readFilter.counts["total"] == bam.count(chrom)
+
+
+@pytest.mark.parametrize("bamFile", PAIRED_BAMS)
+@pytest.mark.parametrize("chunkSize", [1, 7, 100, 10000])
+def test_read_filter_duplicates_across_chunks(bamFile, chunkSize):
+    """
+    The tools fetch a chromosome in chunks and skip the alignments starting
+    before each chunk, as keptReads does with minStart. Duplicates are
+    always found, since they start at the same position.
+    """
+    bam = pysam.AlignmentFile(bamFile)
+    options = dict(ignoreDuplicates=True, filterRNAstrand="forward")
+    kept = []
+    expected = []
+    for chrom, start, end in chunks(bam, chunkSize):
+        readFilter = ReadFilter(**options)
+        kept.extend(readFilter.keptReads(bam.fetch(chrom, start, end), minStart=start))
+        expected.extend(perReadFilter(bam.fetch(chrom, start, end), minStart=start, **options)[0])
+    assert [x.to_string() for x in kept] == [x.to_string() for x in expected]
+    wholeFile = []
+    for chrom in bam.references:
+        wholeFile.extend(ReadFilter(**options).keptReads(bam.fetch(chrom)))
+    assert [x.to_string() for x in kept] == [x.to_string() for x in wholeFile]
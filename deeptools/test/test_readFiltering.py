@@ -10,6 +10,8 @@ ROOT = os.path.dirname(os.path.abspath(__file__)) + "/test_data/"
 BAMFILE_FILTER = ROOT + "test_filtering.bam"
 BEDFILE_FILTER = ROOT + "test_filtering.blacklist.bed"
 PAIREDBAMFILE_FILTER = ROOT + "test_paired.bam"
+PAIREDBAMFILE_FILTER2 = ROOT + "test_paired2.bam"
+HEADER = 'Sample\tTotal Reads\tMapped Reads\tAlignments in blacklisted regions\tEstimated mapped reads filtered\tBelow MAPQ\tMissing Flags\tExcluded Flags\tInternally-determined Duplicates\tMarked Duplicates\tSingletons\tWrong strand\n'
 
 
 def test_estimate_read_filtering_minimal():
@@ -54,6 +56,58 @@ def test_estimate_read_filtering_params():
     unlink(outfile)
 
 
+def test_estimate_read_filtering_combined():
+    """
+    Several filters at once, on paired-end and single-end reads. A read is
+    filtered if any filter matches it, so the reads filtered are fewer than
+    the sum of the filters.
+    """
+    outfile = '/tmp/test_combined.txt'
+    for params, expected in [('--minMappingQuality 10 --samFlagInclude 2 --samFlagExclude 256 --ignoreDuplicates --filterRNAstrand forward',
+                              ['test_paired2\t47\t47\t0\t26.0\t0.0\t2.0\t0.0\t10.0\t0.0\t0.0\t17.0\n',
+                               'test_filtering\t193\t193\t0\t193.0\t44.0\t193.0\t2.0\t30.0\t0.0\t0.0\t100.0\n']),
+                             ('--minMappingQuality 10 --samFlagExclude 512 --ignoreDuplicates --filterRNAstrand reverse',
+                              ['test_paired2\t47\t47\t0\t32.0\t0.0\t0.0\t0.0\t10.0\t0.0\t0.0\t30.0\n',
+                               'test_filtering\t193\t193\t0\t192.0\t44.0\t0.0\t187.0\t30.0\t0.0\t0.0\t93.0\n'])]:
+        args = '-b {} {} --smartLabels {} -o {}'.format(PAIREDBAMFILE_FILTER2, BAMFILE_FILTER, params, outfile).split()
+        est.main(args)
+
+        _foo = open(outfile, 'r')
+        resp = _foo.readlines()
+        _foo.close()
+        assert f"{resp}" == f"{[HEADER] + expected}", f"{resp} != {[HEADER] + expected}"
+        unlink(outfile)
+
+
+def test_estimate_read_filtering_marked_duplicates(tmp_path):
+    """
+    Marked duplicates and singletons are always counted as filtered. Two of
+    the 8 alignments with these flags are also duplicates determined by
+    deepTools.
+    """
+    bamFile = str(tmp_path / "marked.bam")
+    bam = pysam.AlignmentFile(PAIREDBAMFILE_FILTER2)
+    out = pysam.AlignmentFile(bamFile, "wb", template=bam)
+    for i, read in enumerate(bam.fetch(until_eof=True)):
+        if i < 5:
+            read.flag |= 1024
+        elif i < 8:
+            read.flag |= 8
+        out.write(read)
+    out.close()
+    bam.close()
+    pysam.index(bamFile)
+
+    outfile = str(tmp_path / "marked.txt")
+    for params, expected in [('--ignoreDuplicates', 'marked\t47\t47\t0\t16.0\t0.0\t0.0\t0.0\t10.0\t5.0\t3.0\t0.0\n'),
+                             ('--ignoreDuplicates --samFlagExclude 1032', 'marked\t47\t47\t0\t16.0\t0.0\t0.0\t8.0\t10.0\t5.0\t3.0\t0.0\n')]:
+        est.main('-b {} --smartLabels {} -o {}'.format(bamFile, params, outfile).split())
+        _foo = open(outfile, 'r')
+        resp = _foo.readlines()
+        _foo.close()
+        assert f"{resp}" == f"{[HEADER, expected]}", f"{resp} != {[HEADER, expected]}"
+
+
 def test_sieve():
     """
     Test filtering a BAM file by MAPQ, flag, and blacklist
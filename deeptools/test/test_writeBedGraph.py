@@ -1,4 +1,6 @@
 import os
+import numpy as np
+import numpy.testing as nt
 import pytest
 import deeptools.writeBedGraph as wr
 from deeptools.writeBedGraph import scaleCoverage
@@ -35,6 +37,59 @@ class TestWriteBedGraph():
         assert f"{res}" == f"{expected}"
         os.remove(tempFile[3])
 
+    def test_get_bedgraph_lines(self, bc):
+        c, bamFile1, bamFile2, bamFile_PE, chrom, step_size, bin_length, func_args = self.ifiles(bc)
+        c.bamFilesList = [bamFile2]
+        c.ignoreDuplicates = True
+        lines = c.get_bedgraph_lines(chrom, 0, 200, scaleCoverage, func_args)[3]
+        tempFile = c.writeBedGraph_worker(chrom, 0, 200, scaleCoverage, func_args)
+        _foo = open(tempFile[3], 'rb')
+        assert lines == _foo.read()
+        _foo.close()
+        os.remove(tempFile[3])
+
+    def test_get_runs_sparse(self, bc):
+        """
+        Chunks with few reads, which are counted only around them, have
+        the runs of counting the whole chunk.
+        """
+        c, bamFile1, bamFile2, bamFile_PE, chrom, step_size, bin_length, func_args = self.ifiles(bc)
+        for bamFile, region, binLength, extendReads, smoothLength in [
+                (bamFile2, (chrom, 0, 200), 1, False, 0),
+                (bamFile_PE, ('chr2', 4999000, 5002000), 1, 300, 0),
+                (bamFile_PE, ('chr2', 4999000, 5002000), 5, 300, 0),
+                (bamFile_PE, ('chr2', 4999000, 5002000), 1, False, 30)]:
+            c = wr.WriteBedGraph([bamFile], binLength=binLength, stepSize=binLength, extendReads=extendReads)
+            c.smoothLength = smoothLength
+            if bamFile == bamFile2:
+                assert c.compute_sparse_tile_runs(*region, scaleCoverage, func_args) is not None
+            sparse = c.get_runs(*region, scaleCoverage, func_args)[3]
+            # count the whole chunk
+            c.maxSparseReads = 0
+            dense = c.get_runs(*region, scaleCoverage, func_args)[3]
+            for x, y in zip(sparse, dense):
+                nt.assert_equal(x, y)
+
+    def test_sparse_estimated_from_index(self, bc, monkeypatch):
+        """
+        The chunks of bam files that the index estimates to have too many
+        reads are counted whole, without fetching the reads twice.
+        """
+        if bc == 'cram':
+            pytest.skip("CRAM files have no linear index")
+        c, bamFile1, bamFile2, bamFile_PE, chrom, step_size, bin_length, func_args = self.ifiles(bc)
+        c = wr.WriteBedGraph([bamFile_PE], binLength=1, stepSize=1)
+        region = ('chr2', 4999000, 5002000)
+        sparse = c.get_runs(*region, scaleCoverage, func_args)[3]
+        c.maxSparseReads = 1
+        caches = []
+        monkeypatch.setattr(wr.cr.ReadCache, "__init__", lambda *args, **kwargs: caches.append(args))
+        assert c.compute_sparse_tile_runs(*region, scaleCoverage, func_args) is None
+        assert caches == []
+        dense = c.get_runs(*region, scaleCoverage, func_args)[3]
+        for x, y in zip(sparse, dense):
+            nt.assert_equal(x, y)
+
     def test_writeBedGraph_worker_zerotonan(self, bc):
         c, bamFile1, bamFile2, bamFile_PE, chrom, step_size, bin_length, func_args = self.ifiles(bc)
         # turn on zeroToNan
@@ -115,3 +170,52 @@ class TestWriteBedGraph():
         ]
         assert f"{res}" == f"{expected}"
         os.remove(tempFile[3])
+
+    def test_get_runs(self, bc):
+        c, bamFile1, bamFile2, bamFile_PE, chrom, step_size, bin_length, func_args = self.ifiles(bc)
+        c.zerosToNans = True
+        res = c.get_runs(chrom, 0, 200, scaleCoverage, func_args)
+        assert res[:3] == (chrom, 0, 200)
+        assert [x.tolist() for x in res[3]] == [[100], [200], [1.0]]
+
+
+def test_roundToSignificant():
+    values = [1 / 3.0, 2e-7 / 3, 123456789, -987654.321, 0]
+    res = wr.roundToSignificant(values)
+    assert res.tolist() == [float("{:g}".format(x)) for x in values]
+
+    def test_get_runs_vectorized(self, bc):
+        """
+        The vectorized scaleCoverage gives the same runs as calling
+        it for each tile.
+        """
+        c, bamFile1, bamFile2, bamFile_PE, chrom, step_size, bin_length, func_args = self.ifiles(bc)
+        c.bamFilesList = [bamFile2]
+        c.binLength = c.stepSize = 10
+        c.smoothLength = 30
+        c.skipZeroOverZero = True
+
+        def scaleTile(tile_coverage, args):
+            return scaleCoverage(tile_coverage, args)
+
+        res = c.get_runs(chrom, 0, 200, scaleCoverage, {'scaleFactor': 1 / 3.0})[3]
+        expected = c.get_runs(chrom, 0, 200, scaleTile, {'scaleFactor': 1 / 3.0})[3]
+        assert [x.tolist() for x in res] == [x.tolist() for x in expected]
+
+
+def test_getRatioArray():
+    from deeptools.getRatio import getRatio, getRatioArray
+    coverage = np.array([[4, 1], [1, 4], [0, 0], [np.nan, 1], [3, 3]])
+    expected = {'ratio': [2.5, 0.4, 1, np.nan, 1],
+                'log2': np.log2([2.5, 0.4, 1, np.nan, 1]),
+                'reciprocal_ratio': [2.5, -2.5, 1, np.nan, 1],
+                'subtract': [3, -3, 0, np.nan, 0],
+                'add': [5, 5, 0, np.nan, 6],
+                'mean': [2.5, 2.5, 0, np.nan, 3],
+                'first': [4, 1, 0, np.nan, 3],
+                'second': [1, 4, 0, np.nan, 3]}
+    for valueType, values in expected.items():
+        funcArgs = {'valueType': valueType, 'scaleFactors': (1, 1), 'pseudocount': [1, 1]}
+        nt.assert_allclose(getRatioArray(coverage, funcArgs), values)
+        nt.assert_allclose(wr.applyTileFunction(getRatio, coverage, funcArgs), values)
+        nt.assert_allclose([getRatio(x, funcArgs) for x in coverage], values)
@@ -1,6 +1,5 @@
 import sys
 import os
-from deeptoolsintervals import GTF
 from deeptools.bamHandler import openBam
 import matplotlib as mpl
 mpl.use('Agg')
@@ -364,7 +363,8 @@ def bam_blacklisted_reads(bam_handle, chroms_to_ignore, blackListFileName=None,
     # Get the chromosome lengths
     chromLens = {x: y for x, y in zip(bam_handle.references, bam_handle.lengths)}
 
-    bl = GTF(blackListFileName)
+    from deeptools.mapReduce import getBlackList
+    bl = getBlackList(blackListFileName)
     hasOverlaps, minOverlap = bl.hasOverlaps(returnDistance=True)
     if hasOverlaps:
         sys.exit("Your blacklist file(s) has (have) regions that overlap. Proceeding with such a file would result in deepTools incorrectly calculating scaling factors. As such, you MUST fix this issue before being able to proceed.\n")
@@ -378,9 +378,9 @@ def bam_blacklisted_reads(bam_handle, chroms_to_ignore, blackListFileName=None,
                 regions.append([bam_handle.filename, chrom, reg[0], reg[1]])
 
     if len(regions) > 0:
-        import multiprocessing
+        from deeptools.mapReduce import getPool
         if len(regions) > 1 and numberOfProcessors > 1:
-            pool = multiprocessing.Pool(numberOfProcessors)
+            pool = getPool(numberOfProcessors)
             res = pool.map_async(bam_blacklisted_worker, regions).get(9999999)
         else:
             res = [bam_blacklisted_worker(x) for x in regions]
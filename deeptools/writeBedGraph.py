@@ -1,15 +1,19 @@
+import math
 import os
+import pickle
 import sys
-import shutil
+import tempfile
 import numpy as np
 import pyBigWig
 
 # own modules
 from deeptools import mapReduce
-from deeptools.utilities import getCommonChrNames
+from deeptools.utilities import getCommonChrNames, toBytes
 import deeptools.countReadsPerBin as cr
 from deeptools import bamHandler
 from deeptools import utilities
+from deeptools.binaryCoverage import BinaryCoverageWriter
+from deeptools.binCounts import BinCountsWriter
 
 debug = 0
 old_settings = np.seterr(all='ignore')
@@ -27,6 +31,29 @@ def writeBedGraph_wrapper(args):
     return WriteBedGraph.writeBedGraph_worker(*args)
 
 
+def getChunkResult_wrapper(args):
+    """
+    Like writeBedGraph_wrapper, but passes the arguments to
+    WriteBedGraph.get_chunk_result, which returns the result of a chunk
+    as needed for the output format.
+    """
+    return WriteBedGraph.get_chunk_result(*args)
+
+
+def getChunkCounts_wrapper(args):
+    """
+    Passes the arguments to WriteBedGraph.get_chunk_counts.
+    """
+    return WriteBedGraph.get_chunk_counts(*args)
+
+
+def multipleOutputs_wrapper(args):
+    """
+    Passes the arguments to multipleOutputs_worker.
+    """
+    return multipleOutputs_worker(*args)
+
+
 class WriteBedGraph(cr.CountReadsPerBin):
 
     r"""Reads bam files coverages and writes a bedgraph or bigwig file
@@ -90,7 +117,13 @@ class WriteBedGraph(cr.CountReadsPerBin):
 
     """
 
-    def run(self, func_to_call, func_args, out_file_name, blackListFileName=None, format="bedgraph", smoothLength=0):
+    # chunks with at most this many reads per bam file are computed with
+    # compute_sparse_tile_runs
+    maxSparseReads = 100000
+
+    def run(self, func_to_call, func_args, out_file_name, blackListFileName=None, format="bedgraph", smoothLength=0,
+            maxZooms=10, significantDigits=None, quantizationStep=None, reuseBigWig=None, reuseChroms=None,
+            scaleFactorFunc=None):
         r"""
         Given a list of bamfiles, a function and a function arguments,
         this method writes a bedgraph file (or bigwig) file
@@ -111,24 +144,47 @@ class WriteBedGraph(cr.CountReadsPerBin):
         out_file_name : str
             name of the file to save the resulting data.
 
+        format : str
+            "bedgraph", "bigwig" or "binary" (see binaryCoverage).
+
         smoothLength : int
             Distance in bp for smoothing the coverage per tile.
 
+        maxZooms : int
+            Maximum number of zoom levels of a bigwig file.
+
+        significantDigits : int
+            If given, the values are rounded to this number of significant digits.
+
+        quantizationStep : float
+            If given, the values are rounded to multiples of this step.
+
+        reuseBigWig : str
+            A bigwig file from which the values of the chromosomes in
+            reuseChroms are copied instead of being computed. Only for
+            the bigwig format.
+
+        reuseChroms : list
+            The chromosomes copied from reuseBigWig.
+
+        scaleFactorFunc : function
+            If given, the reads of the single bam file are tallied while
+            computing the coverage (see cr.ReadTally) and the values are
+            multiplied by scaleFactorFunc(tallies) once all chunks are
+            done, before being rounded. tallies is a dict with the total,
+            unmapped and kept reads of each chromosome. The quantizationStep
+            is then in units of the values before scaling.
 
         """
-        self.__dict__["smoothLength"] = smoothLength
-        getStats = len(self.mappedList) < len(self.bamFilesList)
-        bam_handles = []
-        for x in self.bamFilesList:
-            if getStats:
-                bam, mapped, unmapped, stats = bamHandler.openBam(x, returnStats=True, nThreads=self.numberOfProcessors)
-                self.mappedList.append(mapped)
-                self.statsList.append(stats)
-            else:
-                bam = bamHandler.openBam(x)
-            bam_handles.append(bam)
+        self.set_run_options(format, blackListFileName, smoothLength, significantDigits, quantizationStep)
+        bam_handles = self.open_bam_files()
 
         genome_chunk_length = getGenomeChunkLength(bam_handles, self.binLength, self.mappedList)
+        # the genome chunk length is based on the average read density,
+        # estimate the cost of each chunk to split the dense ones.
+        chunk_cost = None
+        if self.can_split_chunks(blackListFileName):
+            chunk_cost = bamHandler.getChunkCost(self.bamFilesList, self.statsList)
         # check if both bam files correspond to the same species
         # by comparing the chromosome names:
         chrom_names_and_size, non_common = getCommonChrNames(bam_handles, verbose=False)
@@ -142,37 +198,238 @@ class WriteBedGraph(cr.CountReadsPerBin):
                 continue
             sys.stderr.write("{}: {}\n".format(x, self.__getattribute__(x)))
 
-        res = mapReduce.mapReduce([func_to_call, func_args],
-                                  writeBedGraph_wrapper,
-                                  chrom_names_and_size,
-                                  self_=self,
-                                  genomeChunkLength=genome_chunk_length,
-                                  region=self.region,
-                                  blackListFileName=blackListFileName,
-                                  numberOfProcessors=self.numberOfProcessors)
-
-        # Determine the sorted order of the temp files
-        chrom_order = dict()
-        for i, _ in enumerate(chrom_names_and_size):
-            chrom_order[_[0]] = i
-        res = [[chrom_order[x[0]], x[1], x[2], x[3]] for x in res]
-        res.sort()
+        computed_chroms = chrom_names_and_size
+        if reuseChroms:
+            computed_chroms = [x for x in chrom_names_and_size if x[0] not in reuseChroms]
+
+        if scaleFactorFunc is not None:
+            self.run_scaled(func_to_call, func_args, out_file_name, chrom_names_and_size,
+                            scaleFactorFunc, blackListFileName, format, maxZooms, significantDigits,
+                            quantizationStep, genome_chunk_length, chunk_cost)
+            return
+
+        # the results are streamed in genome order, so each one can be
+        # added to the output as soon as its chunk is done
+        res = mapReduce.imapReduce([format, func_to_call, func_args],
+                                   getChunkResult_wrapper,
+                                   computed_chroms,
+                                   self_=self,
+                                   genomeChunkLength=genome_chunk_length,
+                                   region=self.region,
+                                   blackListFileName=blackListFileName,
+                                   numberOfProcessors=self.numberOfProcessors,
+                                   chunkCost=chunk_cost,
+                                   tileSize=self.binLength)
+
+        output = openOutput(format, out_file_name, chrom_names_and_size, self.binLength, maxZooms,
+                            copyFrom=reuseBigWig, copyChroms=reuseChroms)
+        for r in res:
+            output.add(r)
+        output.close()
+
+    def run_scaled(self, func_to_call, func_args, out_file_name, chrom_names_and_size, scaleFactorFunc,
+                   blackListFileName, format, maxZooms, significantDigits, quantizationStep,
+                   genome_chunk_length, chunk_cost):
+        """
+        The part of run for scaleFactorFunc. The runs of each chunk are
+        computed with the reads tallied and kept unrounded in a temporary
+        file, which is read again to write the output once the scale factor
+        is known.
+        """
+        if len(self.bamFilesList) != 1:
+            raise ValueError("The reads can only be tallied for a single bam file")
+        self.__dict__["significantDigits"] = None
+        self.__dict__["quantizationStep"] = None
+
+        res = mapReduce.imapReduce(['bigwig', func_to_call, func_args, None, True],
+                                   getChunkResult_wrapper,
+                                   chrom_names_and_size,
+                                   self_=self,
+                                   genomeChunkLength=genome_chunk_length,
+                                   region=self.region,
+                                   blackListFileName=blackListFileName,
+                                   numberOfProcessors=self.numberOfProcessors,
+                                   chunkCost=chunk_cost,
+                                   tileSize=self.binLength)
+
+        tallies = {}
+        with tempfile.TemporaryFile() as runsFile:
+            for r in res:
+                pickle.dump(r[:4], runsFile, protocol=pickle.HIGHEST_PROTOCOL)
+                chromTally = tallies.setdefault(r[0], [0, 0, 0])
+                for i, count in enumerate(r[4]):
+                    chromTally[i] += count
+
+            scaleFactor = scaleFactorFunc(tallies)
+            if quantizationStep:
+                quantizationStep *= scaleFactor
+
+            runsFile.seek(0)
+            output = openOutput(format, out_file_name, chrom_names_and_size, self.binLength, maxZooms)
+            while True:
+                try:
+                    chrom, start, end, runs = pickle.load(runsFile)
+                except EOFError:
+                    break
+                runs = scaleRuns(runs, scaleFactor, significantDigits, quantizationStep)
+                if format == 'bedgraph':
+                    output.add((chrom, start, end, formatBedGraphLines(chrom, *runs)))
+                elif format == 'binary':
+                    output.add((chrom, start, end, runsToTileValues(start, end, self.binLength, *runs)))
+                else:
+                    output.add((chrom, start, end, runs))
+            output.close()
+
+    def write_counts(self, fileName, parameters, blackListFileName=None):
+        """
+        Instead of the values of a function of the coverage, writes the
+        coverage of each bam file in each tile to a bin counts file (see
+        binCounts), together with the reads tallied while counting them
+        (see cr.ReadTally) and the parameters dict. run_from_counts then
+        computes the output of run from it.
+
+        The chunks are the same as those of run when their boundaries
+        matter, so that both give the same output.
+        """
+        self.set_run_options('bigwig', blackListFileName)
+        bam_handles = self.open_bam_files()
+        genome_chunk_length = getGenomeChunkLength(bam_handles, self.binLength, self.mappedList)
+        chrom_names_and_size, non_common = getCommonChrNames(bam_handles, verbose=False)
 
+        region = self.region
+        if region:
+            region += ":{}".format(self.binLength)
+
+        # the chunks are not split, since the smoothing and
+        # skipZeroOverZero applied to them are not known yet
+        res = mapReduce.imapReduce([],
+                                   getChunkCounts_wrapper,
+                                   chrom_names_and_size,
+                                   self_=self,
+                                   genomeChunkLength=genome_chunk_length,
+                                   region=region,
+                                   blackListFileName=blackListFileName,
+                                   numberOfProcessors=self.numberOfProcessors,
+                                   tileSize=self.binLength)
+
+        writer = BinCountsWriter(fileName, chrom_names_and_size, parameters, len(self.bamFilesList))
+        for chrom, start, end, counts, tallies in res:
+            writer.add(chrom, start, end, counts, tallies)
+        writer.close()
+
+    def get_chunk_counts(self, chrom, start, end):
+        """
+        Returns the (tiles x samples) coverage of the chunk from start to
+        end, as float32, and the counts of the reads of each bam file
+        tallied while computing it.
+        """
+        self.readTally = [cr.ReadTally(start, end) for _ in self.bamFilesList]
+        try:
+            coverage, _ = self.count_reads_in_region(chrom, start, end)
+            return chrom, start, end, coverage.astype('float32'), [x.counts() for x in self.readTally]
+        finally:
+            self.readTally = None
+
+    def run_from_counts(self, binCounts, func_to_call, func_args, out_file_name, blackListFileName=None,
+                        format="bedgraph", smoothLength=0, maxZooms=10, significantDigits=None,
+                        quantizationStep=None):
+        """
+        Writes the output of run from the coverage in the BinCounts object
+        binCounts, written by write_counts with the same options, without
+        reading the bam files. The arguments are those of run.
+        """
+        self.set_run_options(format, blackListFileName, smoothLength, significantDigits, quantizationStep)
+        output = openOutput(format, out_file_name, binCounts.chromSizes, self.binLength, maxZooms)
+        for chrom, start, end, counts in binCounts.chunks():
+            output.add(self.chunk_result_of_coverage(chrom, start, end, counts.astype('float64'),
+                                                     format, func_to_call, func_args))
+        output.close()
+
+    def chunk_result_of_coverage(self, chrom, start, end, coverage, format, func_to_call, func_args):
+        """
+        Returns the result of get_chunk_result for the chunk from start to
+        end from its (tiles x samples) coverage.
+        """
+        nTiles, tileIndices, values = self.tile_values_of_coverage(coverage, func_to_call, func_args)
+        if format == 'binary':
+            tileValues = np.full(nTiles, np.nan, dtype='float32')
+            tileValues[tileIndices] = values
+            return chrom, start, end, tileValues
+        runs = self.runs_of_tile_values(start, end, tileIndices, values)
         if format == 'bedgraph':
-            out_file = open(out_file_name, 'wb')
-            for r in res:
-                if r[3]:
-                    _foo = open(r[3], 'rb')
-                    shutil.copyfileobj(_foo, out_file)
-                    _foo.close()
-                    os.remove(r[3])
-            out_file.close()
+            return chrom, start, end, formatBedGraphLines(chrom, *runs)
+        return chrom, start, end, runs
+
+    def set_run_options(self, format="bedgraph", blackListFileName=None, smoothLength=0,
+                        significantDigits=None, quantizationStep=None):
+        """
+        Sets the options of run that are needed by the workers and checks
+        that the format can be written.
+        """
+        self.__dict__["smoothLength"] = smoothLength
+        self.__dict__["significantDigits"] = significantDigits
+        self.__dict__["quantizationStep"] = quantizationStep
+        if format == 'binary' and (blackListFileName or self.stepSize != self.binLength):
+            # the blacklisted regions would shift the bins after them
+            sys.exit("The binary format needs adjacent bins of the same size, "
+                     "which is not possible with a blacklist.\n")
+
+    def open_bam_files(self):
+        """
+        Opens the bam files, getting their statistics if they were not
+        given to the constructor.
+        """
+        getStats = len(self.mappedList) < len(self.bamFilesList)
+        bam_handles = []
+        for x in self.bamFilesList:
+            if getStats:
+                bam, mapped, unmapped, stats = bamHandler.openBam(x, returnStats=True, nThreads=self.numberOfProcessors)
+                self.mappedList.append(mapped)
+                self.statsList.append(stats)
+            else:
+                bam = bamHandler.openBam(x)
+            bam_handles.append(bam)
+        return bam_handles
+
+    def can_split_chunks(self, blackListFileName=None):
+        """
+        Smoothing, blacklisted regions, duplicate removal and skipped
+        zero-over-zero tiles are affected by where chunks start and end,
+        so in those cases the chunks are kept as is.
+        """
+        return not self.smoothLength and not blackListFileName and not self.ignoreDuplicates \
+            and not self.skipZeroOverZero
+
+    def get_chunk_result(self, chrom, start, end, format, func_to_call, func_args,
+                         bamHandles=None, tallyReads=False):
+        """
+        Computes what the output of the given format needs for a chunk (see
+        openOutput): the bedgraph lines of get_bedgraph_lines, the runs of
+        get_runs for bigwig files or the tile values of get_tile_values for
+        binary files.
+
+        With tallyReads, the reads starting in the chunk are tallied with a
+        cr.ReadTally, whose counts are appended to the result.
+        """
+        if format == 'bedgraph':
+            worker = self.get_bedgraph_lines
+        elif format == 'binary':
+            worker = self.get_tile_values
         else:
-            bedGraphToBigWig(chrom_names_and_size, [x[3] for x in res], out_file_name)
+            worker = self.get_runs
+        if not tallyReads:
+            return worker(chrom, start, end, func_to_call, func_args, bamHandles=bamHandles)
+
+        self.readTally = cr.ReadTally(start, end)
+        try:
+            result = worker(chrom, start, end, func_to_call, func_args, bamHandles=bamHandles)
+            return result + (self.readTally.counts(),)
+        finally:
+            self.readTally = None
 
     def writeBedGraph_worker(self, chrom, start, end,
                              func_to_call, func_args,
-                             bed_regions_list=None):
+                             bed_regions_list=None, bamHandles=None):
         r"""Writes a bedgraph based on the read coverage found on bamFiles
 
         The given func is called to compute the desired bedgraph value
@@ -200,6 +457,8 @@ class WriteBedGraph(cr.CountReadsPerBin):
             corresponding to bed regions to be processed.
             If not bed file was passed to the object constructor
             then this list is empty.
+        bamHandles: list
+            If given, the reads are taken from these (see count_reads_in_region).
 
         Returns
         -------
@@ -223,107 +482,585 @@ class WriteBedGraph(cr.CountReadsPerBin):
         >>> os.remove(tempFile[3])
 
 
+        """
+        lines = self.get_bedgraph_lines(chrom, start, end, func_to_call, func_args,
+                                        bamHandles=bamHandles)[3]
+
+        _file = open(utilities.getTempFileName(suffix='.bg'), 'wb')
+        _file.write(lines)
+        tempfilename = _file.name
+        _file.close()
+        return chrom, start, end, tempfilename
+
+    def get_bedgraph_lines(self, chrom, start, end,
+                           func_to_call, func_args,
+                           bed_regions_list=None, bamHandles=None):
+        r"""Computes the lines written by writeBedGraph_worker, which are
+        returned instead of being written to a temporary file, so that no
+        file is needed to send them back from the workers.
+
+        Returns
+        -------
+        A tuple of (chromosome, start, end, bedgraph lines as bytes).
+
+        Examples
+        --------
+        >>> test_path = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+        >>> c = WriteBedGraph([test_path + "testA.bam"], 50, 0, stepSize=50)
+        >>> c.get_bedgraph_lines('3R', 0, 200, scaleCoverage, {'scaleFactor': 1.0})[3].decode()
+        '3R\t0\t100\t0\n3R\t100\t200\t1\n'
+        """
+        runs = self.get_runs(chrom, start, end, func_to_call, func_args,
+                             bamHandles=bamHandles)[3]
+        return chrom, start, end, formatBedGraphLines(chrom, *runs)
+
+    def get_runs(self, chrom, start, end,
+                 func_to_call, func_args,
+                 bed_regions_list=None, bamHandles=None):
+        r"""Computes the values written by writeBedGraph_worker, that is,
+        the runs of consecutive tiles with the same value, without the
+        NaN ones.
+
+        Returns
+        -------
+        A tuple of (chromosome, start, end, (run starts, run ends, run values)),
+        with the runs as numpy arrays.
+
+        Examples
+        --------
+        >>> test_path = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+        >>> c = WriteBedGraph([test_path + "testA.bam"], 50, 0, stepSize=50)
+        >>> [x.tolist() for x in c.get_runs('3R', 0, 200, scaleCoverage, {'scaleFactor': 1.0})[3]]
+        [[0, 100], [100, 200], [0.0, 1.0]]
+        """
+        sparse = self.compute_sparse_tile_runs(chrom, start, end, func_to_call, func_args,
+                                               bamHandles=bamHandles)
+        if sparse is not None:
+            runFirst, runValues = sparse[1:]
+            runStarts = start + runFirst * self.binLength
+            runEnds = np.append(runStarts[1:], end)
+            keep = ~np.isnan(runValues)
+            keep[-1] &= runStarts[-1] != end
+            return chrom, start, end, (runStarts[keep], runEnds[keep], runValues[keep])
+
+        tileIndices, values = self.compute_tile_values(chrom, start, end, func_to_call, func_args,
+                                                       bamHandles=bamHandles)[1:]
+        return chrom, start, end, self.runs_of_tile_values(start, end, tileIndices, values)
+
+    def runs_of_tile_values(self, start, end, tileIndices, values):
+        """
+        Returns the runs of get_runs for the values of the tiles with the
+        given indices in the chunk from start to end.
+        """
+        if len(tileIndices) == 0:
+            return (np.zeros(0, dtype='int64'),
+                    np.zeros(0, dtype='int64'),
+                    np.zeros(0, dtype='float64'))
+
+        # tiles skipped by skipZeroOverZero are left out, but the following
+        # tiles are written right after the previous ones, as they always
+        # were. Below are the end of each tile and the first tile of each
+        # run of equal values (nan never equals the previous value).
+        tileEnds = np.minimum(start + (tileIndices[0] + np.arange(1, len(values) + 1)) * self.binLength, end)
+        runFirst = np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]]))
+
+        runStarts = np.concatenate([[start + tileIndices[0] * self.binLength], tileEnds[runFirst[1:] - 1]])
+        runEnds = np.concatenate([tileEnds[runFirst[1:] - 1], [end]])
+        runValues = values[runFirst]
+        keep = ~np.isnan(runValues)
+        keep[-1] &= runStarts[-1] != end
+
+        return (runStarts[keep].astype('int64'),
+                runEnds[keep].astype('int64'),
+                runValues[keep])
+
+    def get_tile_values(self, chrom, start, end,
+                        func_to_call, func_args,
+                        bed_regions_list=None, bamHandles=None):
+        r"""Computes the value of each tile, as for writeBedGraph_worker,
+        but with nan for the tiles skipped by skipZeroOverZero.
+
+        Returns
+        -------
+        A tuple of (chromosome, start, end, values), with the values as a
+        float32 numpy array.
+
+        Examples
+        --------
+        >>> test_path = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+        >>> c = WriteBedGraph([test_path + "testA.bam"], 50, 0, stepSize=50)
+        >>> c.get_tile_values('3R', 0, 200, scaleCoverage, {'scaleFactor': 1.0})[3].tolist()
+        [0.0, 0.0, 1.0, 1.0]
+        """
+        sparse = self.compute_sparse_tile_runs(chrom, start, end, func_to_call, func_args,
+                                               bamHandles=bamHandles)
+        if sparse is not None:
+            nTiles, runFirst, runValues = sparse
+            return chrom, start, end, np.repeat(runValues, np.diff(np.append(runFirst, nTiles))).astype('float32')
+
+        nTiles, tileIndices, values = self.compute_tile_values(chrom, start, end, func_to_call, func_args,
+                                                               bamHandles=bamHandles)
+        tileValues = np.full(nTiles, np.nan, dtype='float32')
+        tileValues[tileIndices] = values
+        return chrom, start, end, tileValues
+
+    def compute_sparse_tile_runs(self, chrom, start, end, func_to_call, func_args, bamHandles=None):
+        """
+        For chunks with few reads, computes the values of the tiles from
+        start to end as runs of equal values. The reads are only counted in
+        windows around them, so the time and memory needed depend on the
+        number of reads rather than on the length of the chunk. The tiles
+        outside of these windows have no reads and get the value of a tile
+        without coverage.
+
+        Returns the number of tiles, the first tile of each run and the
+        value of each run. None is returned if the chunk has more than
+        maxSparseReads reads (or one per 8 tiles) in a bam file, or if the
+        values depend on where the counting starts (with overlapping bins,
+        skipZeroOverZero or ignoreDuplicates). Chunks that the BAM index
+        estimates to have more than twice that many reads are not fetched
+        (see bamHandler.estimateReads).
+        """
+        if self.stepSize != self.binLength or self.skipZeroOverZero or self.ignoreDuplicates:
+            return None
+        if self.defaultFragmentLength == 'read length':
+            extension = 0
+        else:
+            extension = int(self.maxPairedFragmentLength)
+
+        nTiles = -(-(end - start) // self.binLength)
+        if bamHandles is None:
+            maxReads = min(self.maxSparseReads, nTiles // 8)
+            bams = [mapReduce.getFileHandle(bamHandler.openBam, fname) for fname in self.bamFilesList]
+            if len(self.mappedList) == len(bams):
+                for bam, mapped in zip(bams, self.mappedList):
+                    estimate = bamHandler.estimateReads(bam, mapped, chrom, max(0, start - extension), end + extension)
+                    if estimate is not None and estimate > 2 * maxReads:
+                        return None
+            bamHandles = []
+            for bam in bams:
+                cache = cr.ReadCache(bam, chrom, max(0, start - extension), end + extension, maxReads=maxReads)
+                if not cache.isComplete:
+                    return None
+                bamHandles.append(cache)
+
+        # the fragments of a read lie within the extension around it, and
+        # smoothing spreads their coverage by less than smoothLength. The
+        # windows are that much larger, so the values in them are those
+        # that counting the whole chunk would give.
+        pad = extension + 2 * int(self.smoothLength or 0) + self.binLength
+        readStarts = np.concatenate([np.asarray(x.readStarts, dtype='int64') for x in bamHandles])
+        readEnds = np.concatenate([np.asarray(x.readEnds, dtype='int64') for x in bamHandles])
+        tileLo = np.clip((readStarts - pad - start) // self.binLength, 0, nTiles)
+        tileHi = np.clip(-(-(readEnds + pad - start) // self.binLength), 0, nTiles)
+        order = np.argsort(tileLo, kind='stable')
+        tileLo = tileLo[order]
+        tileHi = np.maximum.accumulate(tileHi[order])
+        # merge the overlapping windows
+        windowFirst = np.flatnonzero(np.concatenate([[True], tileLo[1:] > tileHi[:-1]])) if len(tileLo) else tileLo
+        windowLo = tileLo[windowFirst]
+        windowHi = tileHi[np.append(windowFirst[1:] - 1, len(tileHi) - 1).astype('int64')] if len(tileLo) else tileHi
+
+        emptyCoverage = np.full((1, len(self.bamFilesList)), np.nan if self.zerosToNans else 0.0)
+        emptyValue = quantizeValues(applyTileFunction(func_to_call, emptyCoverage, func_args),
+                                    getattr(self, 'significantDigits', None),
+                                    getattr(self, 'quantizationStep', None))
+
+        runFirst = []
+        runValues = []
+        lastTile = 0
+        for lo, hi in zip(windowLo.tolist(), windowHi.tolist()):
+            if hi <= lo:
+                continue
+            if lo > lastTile:
+                runFirst.append(np.array([lastTile]))
+                runValues.append(emptyValue)
+            values = self.compute_tile_values(chrom, start + lo * self.binLength, min(start + hi * self.binLength, end),
+                                              func_to_call, func_args, bamHandles=bamHandles)[2]
+            first = np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]]))
+            runFirst.append(lo + first)
+            runValues.append(values[first])
+            lastTile = hi
+        if lastTile < nTiles:
+            runFirst.append(np.array([lastTile]))
+            runValues.append(emptyValue)
+
+        runFirst = np.concatenate(runFirst).astype('int64')
+        runValues = np.concatenate(runValues)
+        # equal values on both sides of the end of a window are one run
+        keep = np.concatenate([[True], runValues[1:] != runValues[:-1]])
+        return nTiles, runFirst[keep], runValues[keep]
+
+    def compute_tile_values(self, chrom, start, end, func_to_call, func_args, bamHandles=None):
+        """
+        Returns the number of tiles from start to end, the indices of the
+        tiles not skipped by skipZeroOverZero and their values.
         """
         if start > end:
             raise NameError("start position ({0}) bigger "
                             "than end position ({1})".format(start, end))
 
-        coverage, _ = self.count_reads_in_region(chrom, start, end)
+        coverage, _ = self.count_reads_in_region(chrom, start, end, bamHandles=bamHandles)
+        return self.tile_values_of_coverage(coverage, func_to_call, func_args)
 
-        _file = open(utilities.getTempFileName(suffix='.bg'), 'w')
-        previous_value = None
-        line_string = "{}\t{}\t{}\t{:g}\n"
-        for tileIndex in range(coverage.shape[0]):
+    def tile_values_of_coverage(self, coverage, func_to_call, func_args):
+        """
+        The part of compute_tile_values after the (tiles x samples)
+        coverage of the chunk is counted.
+        """
+        if self.smoothLength is not None and self.smoothLength > 0:
+            coverage = self.getSmoothCoverage(coverage, self.binLength, self.smoothLength)
 
-            if self.smoothLength is not None and self.smoothLength > 0:
-                vector_start, vector_end = self.getSmoothRange(tileIndex,
-                                                               self.binLength,
-                                                               self.smoothLength,
-                                                               coverage.shape[0])
-                tileCoverage = np.mean(coverage[vector_start:vector_end, :], axis=0)
-            else:
-                tileCoverage = coverage[tileIndex, :]
-            if self.skipZeroOverZero and np.sum(tileCoverage) == 0:
-                continue
+        nTiles = coverage.shape[0]
+        tileIndices = np.arange(nTiles)
+        if self.skipZeroOverZero:
+            tileIndices = np.flatnonzero(np.sum(coverage, axis=1) != 0)
+            coverage = coverage[tileIndices, :]
 
-            value = func_to_call(tileCoverage, func_args)
-            """
-            # uncomment these lines if fixed step bedgraph is required
-            if not np.isnan(value):
-                writeStart = start + tileIndex * self.binLength
-                writeEnd  =  min(writeStart + self.binLength, end)
-                _file.write(line_string.format(chrom, writeStart,
-                                               writeEnd, value))
-            continue
-            """
+        values = applyTileFunction(func_to_call, coverage, func_args)
+        values = quantizeValues(values, getattr(self, 'significantDigits', None),
+                                getattr(self, 'quantizationStep', None))
+        return nTiles, tileIndices, values
 
-            if previous_value is None:
-                writeStart = start + tileIndex * self.binLength
-                writeEnd = min(writeStart + self.binLength, end)
-                previous_value = value
 
-            elif previous_value == value:
-                writeEnd = min(writeEnd + self.binLength, end)
+def roundToSignificant(values, digits=6):
+    """
+    Rounds the values to the given number of significant digits, as
+    formatting them with "{:g}" and parsing them back would.
 
-            elif previous_value != value:
-                if not np.isnan(previous_value):
-                    _file.write(
-                        line_string.format(chrom, writeStart, writeEnd, previous_value))
-                previous_value = value
-                writeStart = writeEnd
-                writeEnd = min(writeStart + self.binLength, end)
+    >>> roundToSignificant([1.23456789, 123456789., 0., -0.000123456789]).tolist()
+    [1.23457, 123457000.0, 0.0, -0.000123457]
+    """
+    values = np.array(values, dtype='float64')
+    nonZero = np.isfinite(values) & (values != 0)
+    power = digits - 1 - np.floor(np.log10(np.abs(values[nonZero])))
+    # only exact powers of ten are used, so that e.g. 123457 / 1e-3 does
+    # not come out as 123457000.00000001
+    scale = 10.0 ** np.abs(power)
+    values[nonZero] = np.where(power >= 0,
+                               np.round(values[nonZero] * scale) / scale,
+                               np.round(values[nonZero] / scale) * scale)
+    return values
+
+
+def quantizeValues(values, significantDigits=None, step=None):
+    """
+    Rounds the values to multiples of step and then to the given number of
+    significant digits, if these are given.
 
-        # write remaining value if not a nan
-        if previous_value is not None and writeStart != end and not np.isnan(previous_value):
-            _file.write(line_string.format(chrom, writeStart,
-                                           end, previous_value))
+    >>> quantizeValues(np.array([0.14, 0.26, 1234.5]), step=0.1).tolist()
+    [0.1, 0.30000000000000004, 1234.5]
+    >>> quantizeValues(np.array([0.14, 0.26, 1234.5]), significantDigits=2, step=0.1).tolist()
+    [0.1, 0.3, 1200.0]
+    """
+    if step:
+        values = np.round(values / step) * step
+    if significantDigits:
+        values = roundToSignificant(values, significantDigits)
+    return values
 
-        tempfilename = _file.name
-        _file.close()
-        return chrom, start, end, tempfilename
 
+def formatBedGraphLines(chrom, starts, ends, values):
+    """
+    Returns the bedgraph lines of the given runs as bytes.
+
+    >>> formatBedGraphLines('chr1', np.array([0, 10]), np.array([10, 30]), np.array([1.5, 2.0]))
+    b'chr1\\t0\\t10\\t1.5\\nchr1\\t10\\t30\\t2\\n'
+    """
+    line_string = "{}\t{}\t{}\t{:g}\n"
+    lines = "".join(line_string.format(chrom, writeStart, writeEnd, value)
+                    for writeStart, writeEnd, value in zip(starts.tolist(), ends.tolist(), values.tolist()))
+    return toBytes(lines)
+
+
+def scaleRuns(runs, scaleFactor, significantDigits=None, quantizationStep=None):
+    """
+    Multiplies the values of the runs of get_runs by scaleFactor and rounds
+    them as quantizeValues, joining the adjacent runs that end up with the
+    same value.
+
+    >>> runs = (np.array([0, 10, 20, 40]), np.array([10, 20, 30, 50]), np.array([1., 1.1, 2., 2.]))
+    >>> [x.tolist() for x in scaleRuns(runs, 2.0, quantizationStep=1)]
+    [[0, 20, 40], [20, 30, 50], [2.0, 4.0, 4.0]]
+    """
+    starts, ends, values = runs
+    values = quantizeValues(values * scaleFactor, significantDigits, quantizationStep)
+    if len(values) == 0:
+        return starts, ends, values
+    first = np.flatnonzero(np.concatenate([[True], (values[1:] != values[:-1]) | (starts[1:] != ends[:-1])]))
+    last = np.append(first[1:] - 1, len(values) - 1)
+    return starts[first], ends[last], values[first]
+
+
+def runsToTileValues(start, end, binLength, starts, ends, values):
+    """
+    Returns the values of the tiles from start to end covered by the runs,
+    with nan for the others, as get_tile_values does.
+
+    >>> runsToTileValues(0, 50, 10, np.array([10, 30]), np.array([30, 40]), np.array([1., 2.])).tolist()
+    [nan, 1.0, 1.0, 2.0, nan]
+    """
+    tileValues = np.full(-(-(end - start) // binLength), np.nan, dtype='float32')
+    firstTiles = (starts - start) // binLength
+    counts = -(-(ends - start) // binLength) - firstTiles
+    # the tiles of each run are numbered on from its first tile
+    tiles = np.arange(np.sum(counts)) + np.repeat(firstTiles - (np.cumsum(counts) - counts), counts)
+    tileValues[tiles] = np.repeat(values, counts)
+    return tileValues
+
+
+# the reads in a chunk of runMultiple, which multipleOutputs_worker keeps
+# in memory
+MULTIPLE_OUTPUTS_READS_PER_CHUNK = 2e5
+
+
+def runMultiple(outputs, blackListFileName=None, region=None, numberOfProcessors=1):
+    """
+    Like WriteBedGraph.run, but writes several outputs from the same bam
+    files, whose reads are fetched and decoded once per chunk for all of
+    them (see multipleOutputs_worker).
+
+    Each element of outputs is a tuple of a WriteBedGraph object and a dict
+    with the arguments of its run method, other than blackListFileName.
+    The objects can differ in their bin size, read filters and fragment
+    options, but must count the same bam files. The region and number of
+    processors of the objects are not used.
+
+    The chunks are multiples of the least common multiple of the bin
+    sizes, so with smoothing the values at the chunk boundaries can differ
+    slightly from those of separate runs. They have about
+    MULTIPLE_OUTPUTS_READS_PER_CHUNK reads, a tenth of those of a single
+    output, since the workers keep them in memory.
+    """
+    writers = [wr for wr, runArgs in outputs]
+    if any(wr.bamFilesList != writers[0].bamFilesList for wr in writers):
+        raise ValueError("All the outputs must be computed from the same bam files")
+
+    runArgsList = []
+    for wr, runArgs in outputs:
+        runArgs = dict({'format': 'bedgraph', 'smoothLength': 0, 'maxZooms': 10,
+                        'significantDigits': None, 'quantizationStep': None}, **runArgs)
+        wr.set_run_options(runArgs['format'], blackListFileName, runArgs['smoothLength'],
+                           runArgs['significantDigits'], runArgs['quantizationStep'])
+        runArgsList.append(runArgs)
+
+    bam_handles = writers[0].open_bam_files()
+    tileSize = 1
+    for wr in writers:
+        tileSize = tileSize * wr.binLength // math.gcd(tileSize, wr.binLength)
+    # the workers keep all the reads of a chunk in memory, so the chunks
+    # are smaller than those of a single output
+    genome_chunk_length = getGenomeChunkLength(bam_handles, tileSize, writers[0].mappedList,
+                                               readsPerChunk=MULTIPLE_OUTPUTS_READS_PER_CHUNK)
+    genome_chunk_length = max(genome_chunk_length, tileSize)
+    chunk_cost = None
+    if all(wr.can_split_chunks(blackListFileName) for wr in writers):
+        chunk_cost = bamHandler.getChunkCost(writers[0].bamFilesList, writers[0].statsList)
+    chrom_names_and_size, non_common = getCommonChrNames(bam_handles, verbose=False)
+
+    if region:
+        region += ":{}".format(tileSize)
+
+    res = mapReduce.imapReduce([[(wr, x['format'], x['func_to_call'], x['func_args'])
+                                 for wr, x in zip(writers, runArgsList)]],
+                               multipleOutputs_wrapper,
+                               chrom_names_and_size,
+                               genomeChunkLength=genome_chunk_length,
+                               region=region,
+                               blackListFileName=blackListFileName,
+                               numberOfProcessors=numberOfProcessors,
+                               chunkCost=chunk_cost,
+                               tileSize=tileSize)
+
+    outputFiles = [openOutput(x['format'], x['out_file_name'], chrom_names_and_size, wr.binLength, x['maxZooms'])
+                   for wr, x in zip(writers, runArgsList)]
+    for r in res:
+        for output, result in zip(outputFiles, r[3]):
+            output.add(result)
+    for output in outputFiles:
+        output.close()
+
+
+def multipleOutputs_worker(chrom, start, end, outputs):
+    """
+    Fetches the reads needed by all the outputs for the chunk from start
+    to end once, keeping them in a ReadCache, and computes the result of
+    each output from them. outputs is a list of (WriteBedGraph object,
+    format, func_to_call, func_args) tuples.
+
+    Returns a tuple of (chromosome, start, end, list of the results of
+    get_chunk_result for each output).
+    """
+    extension = 0
+    for wr, format, func_to_call, func_args in outputs:
+        if wr.defaultFragmentLength != 'read length':
+            extension = max(extension, wr.maxPairedFragmentLength)
+
+    caches = []
+    for fname in outputs[0][0].bamFilesList:
+        bam = mapReduce.getFileHandle(bamHandler.openBam, fname)
+        caches.append(cr.ReadCache(bam, chrom, int(max(0, start - extension)), end + int(extension)))
 
-def bedGraphToBigWig(chromSizes, bedGraphFiles, bigWigPath):
+    results = [wr.get_chunk_result(chrom, start, end, format, func_to_call, func_args, bamHandles=caches)
+               for wr, format, func_to_call, func_args in outputs]
+    return chrom, start, end, results
+
+
+def openOutput(format, fileName, chromSizes, binSize, maxZooms=10, copyFrom=None, copyChroms=None):
+    """
+    Returns an object writing the results of WriteBedGraph.get_chunk_result
+    for the given format to fileName. Its add method takes the result of
+    a chunk, in genome order, and its close method finishes the file.
+
+    For bigwig files, the values of the chromosomes in copyChroms can be
+    copied from the bigwig file copyFrom (see BigWigOutput).
+    """
+    if copyChroms and format != 'bigwig':
+        raise ValueError("Only the values of bigwig files can be copied")
+    if format == 'bedgraph':
+        return BedGraphOutput(fileName)
+    elif format == 'binary':
+        return BinaryOutput(fileName, binSize, chromSizes)
+    return BigWigOutput(fileName, chromSizes, maxZooms=maxZooms, copyFrom=copyFrom, copyChroms=copyChroms)
+
+
+class BedGraphOutput(object):
+    """
+    Writes the bedgraph lines of the chunks to fileName.
+    """
+    def __init__(self, fileName):
+        self.file = open(fileName, 'wb')
+
+    def add(self, result):
+        self.file.write(result[3])
+
+    def close(self):
+        self.file.close()
+
+
+class BinaryOutput(BinaryCoverageWriter):
+    """
+    Writes the tile values of the chunks to a binary coverage file.
+    """
+    def add(self, result):
+        self.addValues(result[0], result[1], result[3])
+
+
+class BigWigOutput(object):
+    """
+    Adds the runs of the chunks to a bigWig file. The values are rounded to
+    the precision of the bedGraph files, so that both give the same bigWig
+    file.
+
+    The zoom levels, of which there are at most maxZooms, are computed by
+    pyBigWig when the file is closed.
+
+    The intervals of the chromosomes in copyChroms, for which no results
+    are added, are copied as they are from the bigWig file copyFrom, in
+    their place in the order of chromSizes.
+    """
+    def __init__(self, fileName, chromSizes, maxZooms=10, copyFrom=None, copyChroms=None):
+        self.bw = pyBigWig.open(fileName, "w")
+        assert self.bw is not None
+        self.bw.addHeader(chromSizes, maxZooms=maxZooms)
+        self.chromSizes = dict(chromSizes)
+        self.chromOrder = {chrom: i for i, (chrom, size) in enumerate(chromSizes)}
+        self.copyFrom = None
+        self.toCopy = []
+        if copyChroms:
+            self.copyFrom = pyBigWig.open(copyFrom)
+            self.toCopy = [chrom for chrom, size in chromSizes if chrom in copyChroms]
+
+    def add(self, result):
+        self.copyChroms(before=result[0])
+        self.addRuns(result[0], *result[3])
+
+    def copyChroms(self, before=None):
+        """
+        Copies the chromosomes to copy that come before the chromosome
+        before, or all the remaining ones if it is None.
+        """
+        while self.toCopy and (before is None or self.chromOrder[self.toCopy[0]] < self.chromOrder[before]):
+            chrom = self.toCopy.pop(0)
+            if chrom not in self.copyFrom.chroms():
+                continue
+            # in windows of 10 Mb, to keep the number of intervals in memory
+            # bounded. An interval is copied with the window it starts in.
+            for start in range(0, self.chromSizes[chrom], 10000000):
+                end = min(start + 10000000, self.chromSizes[chrom])
+                intervals = [x for x in self.copyFrom.intervals(chrom, start, end) or [] if x[0] >= start]
+                if len(intervals) == 0:
+                    continue
+                starts, ends, values = zip(*intervals)
+                self.bw.addEntries([chrom] * len(starts), list(starts), ends=list(ends), values=list(values))
+
+    def addRuns(self, chrom, starts, ends, values):
+        if len(starts) == 0:
+            return
+        # the 6 digits of the bedgraph files, --significantDigits can
+        # only round the values further
+        values = roundToSignificant(values)
+        # a single chromosome name would mean entries with a fixed span
+        if pyBigWig.numpy:
+            self.bw.addEntries([chrom] * len(starts), starts, ends=ends, values=values)
+        else:
+            self.bw.addEntries([chrom] * len(starts), starts.tolist(), ends=ends.tolist(), values=values.tolist())
+
+    def close(self):
+        self.copyChroms()
+        self.bw.close()
+        if self.copyFrom is not None:
+            self.copyFrom.close()
+
+
+def bedGraphToBigWig(chromSizes, bedGraphFiles, bigWigPath, maxZooms=10):
     """
-    Takes a sorted list of bedgraph files and write them to a single bigWig file using pyBigWig.
-    The order of bedGraphFiles must match that of chromSizes!
+    Takes a sorted list (or iterable) of bedgraph files and write them to a single bigWig file using pyBigWig.
+    The order of bedGraphFiles must match that of chromSizes! Instead of a
+    file name, an element can be the bedgraph lines as bytes. The files are
+    removed once they are read.
     """
     bw = pyBigWig.open(bigWigPath, "w")
     assert bw is not None
-    bw.addHeader(chromSizes, maxZooms=10)
+    bw.addHeader(chromSizes, maxZooms=maxZooms)
     lastChrom = None
     starts = []
     ends = []
     vals = []
     for bg in bedGraphFiles:
-        if bg is not None:
+        if bg is None:
+            continue
+        if isinstance(bg, bytes):
+            lines = bg.decode('ascii').splitlines()
+        else:
             f = open(bg)
-            for line in f:
-                interval = line.split()
-                # Buffer up to a million entries
-                if interval[0] != lastChrom or len(starts) == 1000000:
-                    if lastChrom is not None:
-                        bw.addEntries([lastChrom] * len(starts), starts, ends=ends, values=vals)
-                    lastChrom = interval[0]
-                    starts = [int(interval[1])]
-                    ends = [int(interval[2])]
-                    vals = [float(interval[3])]
-                else:
-                    starts.append(int(interval[1]))
-                    ends.append(int(interval[2]))
-                    vals.append(float(interval[3]))
+            lines = f.readlines()
             f.close()
             os.remove(bg)
+        for line in lines:
+            interval = line.split()
+            # Buffer up to a million entries
+            if interval[0] != lastChrom or len(starts) == 1000000:
+                if lastChrom is not None:
+                    bw.addEntries([lastChrom] * len(starts), starts, ends=ends, values=vals)
+                lastChrom = interval[0]
+                starts = [int(interval[1])]
+                ends = [int(interval[2])]
+                vals = [float(interval[3])]
+            else:
+                starts.append(int(interval[1]))
+                ends.append(int(interval[2]))
+                vals.append(float(interval[3]))
     if len(starts) > 0:
         bw.addEntries([lastChrom] * len(starts), starts, ends=ends, values=vals)
     bw.close()
 
 
-def getGenomeChunkLength(bamHandles, tile_size, mappedList):
+def getGenomeChunkLength(bamHandles, tile_size, mappedList, readsPerChunk=2e6):
     """
     Tries to estimate the length of the genome sent to the workers
     based on the density of reads per bam file and the number
-    of bam files.
+    of bam files, so that a chunk has about readsPerChunk reads.
 
     The chunk length should be a multiple of the tileSize
 
@@ -333,22 +1070,65 @@ def getGenomeChunkLength(bamHandles, tile_size, mappedList):
 
     max_reads_per_bp = max([float(x) / genomeLength for x in mappedList])
 
-    # 2e6 is an empirical estimate
-    genomeChunkLength = int(min(5e6, int(2e6 / (max_reads_per_bp * len(bamHandles)))))
+    # the default of 2e6 reads is an empirical estimate
+    genomeChunkLength = int(min(5e6, int(readsPerChunk / (max_reads_per_bp * len(bamHandles)))))
 
     genomeChunkLength -= genomeChunkLength % tile_size
     return genomeChunkLength
 
 
+def applyTileFunction(func, coverage, args):
+    """
+    Calls the tile function func for all the tiles of the (tiles x samples)
+    coverage array and returns the values as a vector.
+
+    Tile functions take the coverage of one tile and the args dict and
+    return the value of the tile. To be computed without a loop over the
+    tiles, they set their 'vectorized' attribute to a function taking the
+    coverage of all tiles and the args dict and returning all the values.
+
+    >>> applyTileFunction(scaleCoverage, np.array([[1.], [2.]]), {'scaleFactor': 2}).tolist()
+    [2.0, 4.0]
+    >>> applyTileFunction(lambda x, args: x[0] - x[1], np.array([[1., 2.]]), None).tolist()
+    [-1.0]
+    """
+    if hasattr(func, 'vectorized'):
+        values = func.vectorized(coverage, args)
+    else:
+        values = [func(tileCoverage, args) for tileCoverage in coverage]
+    return np.asarray(values, dtype='float64').reshape(len(coverage))
+
+
 def scaleCoverage(tile_coverage, args):
     """
     tileCoverage should be an list with only one element
     """
-    return args['scaleFactor'] * tile_coverage[0]
+    return float(scaleCoverageArray(np.asarray([tile_coverage]), args)[0])
+
+
+def scaleCoverageArray(coverage, args):
+    """
+    scaleCoverage for all the tiles of a (tiles x 1) coverage array at once
+    """
+    return args['scaleFactor'] * np.asarray(coverage, dtype='float64')[:, 0]
+
+
+scaleCoverage.vectorized = scaleCoverageArray
 
 
 def ratio(tile_coverage, args):
     """
     tileCoverage should be an list of two elements
     """
-    return float(tile_coverage[0]) / tile_coverage[1]
+    return float(ratioArray(np.asarray([tile_coverage]), args)[0])
+
+
+def ratioArray(coverage, args):
+    """
+    ratio for all the tiles of a (tiles x 2) coverage array at once
+    """
+    coverage = np.asarray(coverage, dtype='float64')
+    return coverage[:, 0] / coverage[:, 1]
+
+
+ratio.vectorized = ratioArray
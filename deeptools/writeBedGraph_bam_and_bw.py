@@ -1,20 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import os
-import shutil
-import tempfile
 import numpy as np
 import sys
 
-# NGS packages
-import pyBigWig
-
 # own module
 from deeptools import mapReduce
 from deeptools.utilities import getCommonChrNames, toBytes
 from deeptools.writeBedGraph import *
+import deeptools.countReadsPerBin as cr
 from deeptools import bamHandler
+from deeptools.binaryCoverage import openCoverage
 
 old_settings = np.seterr(all='ignore')
 
@@ -31,10 +27,11 @@ def getCoverageFromBigwig(bigwigHandle, chrom, start, end, tileSize,
         return []
     if missingDataAsZero is True:
         coverage[np.isnan(coverage)] = 0
-    # average the values per bin
-    cov = np.array(
-        [np.mean(coverage[x:x + tileSize])
-         for x in range(0, len(coverage), tileSize)])
+    # average the values per bin, the last one can be shorter
+    nFullTiles = len(coverage) // tileSize
+    cov = coverage[:nFullTiles * tileSize].reshape(nFullTiles, tileSize).mean(axis=1)
+    if nFullTiles * tileSize < len(coverage):
+        cov = np.append(cov, np.mean(coverage[nFullTiles * tileSize:]))
     return cov
 
 
@@ -62,91 +59,74 @@ def writeBedGraph_worker(
 
     for indexFile, fileFormat in bamOrBwFileList:
         if fileFormat == 'bam':
-            bamHandle = bamHandler.openBam(indexFile)
+            bamHandle = mapReduce.getFileHandle(bamHandler.openBam, indexFile)
             coverage.append(getCoverageFromBam(
                 bamHandle, chrom, start, end, tileSize,
                 defaultFragmentLength, extendPairedEnds,
                 True))
-            bamHandle.close()
         elif fileFormat == 'bigwig':
-            bigwigHandle = pyBigWig.open(indexFile)
+            bigwigHandle = mapReduce.getFileHandle(openCoverage, indexFile)
             coverage.append(
                 getCoverageFromBigwig(
                     bigwigHandle, chrom, start, end,
                     tileSize, missingDataAsZero))
-            bigwigHandle.close()
-
-    _file = tempfile.NamedTemporaryFile(delete=False)
 
-    previousValue = None
     lengthCoverage = len(coverage[0])
-    for tileIndex in range(lengthCoverage):
-
-        tileCoverage = []
-        for index in range(len(bamOrBwFileList)):
-            if smoothLength > 0:
-                vectorStart, vectorEnd = getSmoothRange(
-                    tileIndex, tileSize, smoothLength, lengthCoverage)
-                tileCoverage.append(
-                    np.mean(coverage[index][vectorStart:vectorEnd]))
-            else:
-                try:
-                    tileCoverage.append(coverage[index][tileIndex])
-                except IndexError:
-                    sys.exit("Chromosome {} probably not in one of the bigwig "
-                             "files. Remove this chromosome from the bigwig file "
-                             "to continue".format(chrom))
-
-        if skipZeroOverZero and np.sum(tileCoverage) == 0:
-            previousValue = None
-            continue
-
-        value = func(tileCoverage, funcArgs)
-
-        if fixedStep:
-            writeStart = start + tileIndex * tileSize
-            writeEnd = min(writeStart + tileSize, end)
-            try:
-                _file.write(toBytes("{0}\t{1}\t{2}\t{3:g}\n".format(chrom, writeStart,
-                                                                    writeEnd, value)))
-            except TypeError:
-                _file.write(toBytes("{}\t{}\t{}\t{}\n".format(chrom, writeStart,
-                                                              writeEnd, value)))
-        else:
-            if previousValue is None:
-                writeStart = start + tileIndex * tileSize
-                writeEnd = min(writeStart + tileSize, end)
-                previousValue = value
-
-            elif previousValue == value:
-                writeEnd = min(writeEnd + tileSize, end)
-
-            elif previousValue != value:
-                if not np.isnan(previousValue):
-                    _file.write(
-                        toBytes("{0}\t{1}\t{2}\t{3:g}\n".format(chrom, writeStart,
-                                                                writeEnd, previousValue)))
-                previousValue = value
-                writeStart = writeEnd
-                writeEnd = min(writeStart + tileSize, end)
-
-    if not fixedStep:
-        # write remaining value if not a nan
-        if previousValue and writeStart != end and \
-                not np.isnan(previousValue):
-            _file.write(toBytes("{0}\t{1}\t{2}\t{3:g}\n".format(chrom, writeStart,
-                                                                end, previousValue)))
-
-    tempFileName = _file.name
-    _file.close()
-    return chrom, start, end, tempFileName
+    for index in range(len(coverage)):
+        if len(coverage[index]) < lengthCoverage:
+            if not smoothLength:
+                sys.exit("Chromosome {} probably not in one of the bigwig "
+                         "files. Remove this chromosome from the bigwig file "
+                         "to continue".format(chrom))
+            # the smoothing averages over the values that exist
+            coverage[index] = np.concatenate([coverage[index],
+                                              np.full(lengthCoverage - len(coverage[index]), np.nan)])
+    coverage = np.column_stack([np.asarray(x[:lengthCoverage], dtype='float64') for x in coverage]) \
+        if lengthCoverage else np.zeros((0, len(coverage)))
+
+    if smoothLength > 0:
+        coverage = cr.CountReadsPerBin([]).getSmoothCoverage(coverage, tileSize, smoothLength)
+
+    kept = np.ones(lengthCoverage, dtype=bool)
+    if skipZeroOverZero:
+        kept = np.sum(coverage, axis=1) != 0
+    values = applyTileFunction(func, coverage, funcArgs)
+    tileStarts = start + np.arange(lengthCoverage) * tileSize
+    tileEnds = np.minimum(tileStarts + tileSize, end)
+
+    line_string = "{0}\t{1}\t{2}\t{3:g}\n"
+    if fixedStep:
+        tiles = np.flatnonzero(kept)
+        lines = toBytes("".join(line_string.format(chrom, writeStart, writeEnd, value) for writeStart, writeEnd, value in
+                                zip(tileStarts[tiles].tolist(), tileEnds[tiles].tolist(), values[tiles].tolist())))
+    else:
+        # runs of equal values between the skipped tiles. A run followed by
+        # a skipped tile is not written, and the last one only if its value
+        # is not zero.
+        nextKept = np.append(kept[1:], False)
+        changes = values[1:] != values[:-1]
+        firstTiles = np.flatnonzero(kept & np.concatenate([[True], ~kept[:-1] | changes]))
+        lastTiles = np.flatnonzero(kept & np.append(~nextKept[:-1] | changes, True))
+        runValues = values[firstTiles]
+        runStarts = tileStarts[firstTiles]
+        runEnds = tileEnds[lastTiles]
+        written = nextKept[lastTiles] & ~np.isnan(runValues)
+        if len(lastTiles) and lastTiles[-1] == lengthCoverage - 1:
+            runEnds[-1] = end
+            written[-1] = runValues[-1] != 0 and not np.isnan(runValues[-1]) and runStarts[-1] != end
+        lines = toBytes("".join(line_string.format(chrom, writeStart, writeEnd, value) for writeStart, writeEnd, value in
+                                zip(runStarts[written].tolist(), runEnds[written].tolist(), runValues[written].tolist())))
+
+    # the lines are sent back to the parent process, which writes them
+    # to the output in genome order
+    return chrom, start, end, lines
 
 
 def writeBedGraph(
         bamOrBwFileList, outputFileName, fragmentLength,
         func, funcArgs, tileSize=25, region=None, blackListFileName=None, numberOfProcessors=1,
         format="bedgraph", extendPairedEnds=True, missingDataAsZero=False,
-        skipZeroOverZero=False, smoothLength=0, fixedStep=False, verbose=False):
+        skipZeroOverZero=False, smoothLength=0, fixedStep=False, verbose=False, maxZooms=10):
     r"""
     Given a list of bamfiles, a function and a function arguments,
     this method writes a bedgraph file (or bigwig) file
@@ -174,7 +154,7 @@ def writeBedGraph(
         chromNamesAndSize = {}
         for fileName, fileFormat in bamOrBwFileList:
             if fileFormat == 'bigwig':
-                fh = pyBigWig.open(fileName)
+                fh = openCoverage(fileName)
             else:
                 continue
 
@@ -208,32 +188,23 @@ def writeBedGraph(
         # in case a region is used, append the tilesize
         region += ":{}".format(tileSize)
 
-    res = mapReduce.mapReduce((tileSize, fragmentLength, bamOrBwFileList,
-                               func, funcArgs, extendPairedEnds, smoothLength,
-                               skipZeroOverZero, missingDataAsZero, fixedStep),
-                              writeBedGraph_wrapper,
-                              chromNamesAndSize,
-                              genomeChunkLength=genomeChunkLength,
-                              region=region,
-                              blackListFileName=blackListFileName,
-                              numberOfProcessors=numberOfProcessors,
-                              verbose=verbose)
-
-    # Determine the sorted order of the temp files
-    chrom_order = dict()
-    for i, _ in enumerate(chromNamesAndSize):
-        chrom_order[_[0]] = i
-    res = [[chrom_order[x[0]], x[1], x[2], x[3]] for x in res]
-    res.sort()
-
+    res = mapReduce.imapReduce((tileSize, fragmentLength, bamOrBwFileList,
+                                func, funcArgs, extendPairedEnds, smoothLength,
+                                skipZeroOverZero, missingDataAsZero, fixedStep),
+                               writeBedGraph_wrapper,
+                               chromNamesAndSize,
+                               genomeChunkLength=genomeChunkLength,
+                               region=region,
+                               blackListFileName=blackListFileName,
+                               numberOfProcessors=numberOfProcessors,
+                               verbose=verbose)
+
+    # the results are streamed in genome order
     if format == 'bedgraph':
         of = open(outputFileName, 'wb')
         for r in res:
             if r is not None:
-                _ = open(r[3], 'rb')
-                shutil.copyfileobj(_, of)
-                _.close()
-                os.remove(r[3])
+                of.write(r[3])
         of.close()
     else:
-        bedGraphToBigWig(chromNamesAndSize, [x[3] for x in res], outputFileName)
+        bedGraphToBigWig(chromNamesAndSize, (x[3] for x in res), outputFileName, maxZooms=maxZooms)